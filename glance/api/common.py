@@ -15,6 +15,7 @@
 
 import errno
 
+from glance.common import wsgi
 from glance.openstack.common import log as logging
 
 LOG = logging.getLogger(__name__)
@@ -22,6 +23,34 @@ LOG = logging.getLogger(__name__)
 
 def size_checked_iter(response, image_meta, expected_size, image_iter,
         notifier):
+    if isinstance(image_iter, wsgi.FileWrapper):
+        return _size_checked_file(response, image_meta, expected_size,
+                                  image_iter, notifier)
+    return _size_checked_iter(response, image_meta, expected_size,
+                              image_iter, notifier)
+
+
+def _size_checked_file(response, image_meta, expected_size, file_wrapper,
+        notifier):
+    """
+    Same as _size_checked_iter, but keeps the file wrapper intact so that
+    the server may still send it with sendfile(2)
+    """
+    def notify_image_sent_hook(env):
+        image_send_notification(file_wrapper.bytes_sent, expected_size,
+                image_meta, response.request, notifier)
+
+    # Add hook to process after response is fully sent
+    if 'eventlet.posthooks' in response.request.environ:
+        response.request.environ['eventlet.posthooks'].append(
+            (notify_image_sent_hook, (), {}))
+
+    file_wrapper.length = expected_size
+    return file_wrapper
+
+
+def _size_checked_iter(response, image_meta, expected_size, image_iter,
+        notifier):
     image_id = image_meta['id']
     bytes_written = 0
 
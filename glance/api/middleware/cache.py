@@ -27,7 +27,9 @@ the local cached copy of the image file is returned.
 import re
 
 import webob
+import webob.exc
 
+from glance.api import policy
 from glance.api.v1 import images
 from glance.common import exception
 from glance.common import utils
@@ -39,11 +41,16 @@ from glance import registry
 
 LOG = logging.getLogger(__name__)
 
-PATTERNS = {
-    ('v1', 'GET'): re.compile(r'^/v1/images/([^\/]+)$'),
-    ('v1', 'DELETE'): re.compile(r'^/v1/images/([^\/]+)$'),
-    ('v2', 'GET'): re.compile(r'^/v2/images/([^\/]+)/file$'),
-    ('v2', 'DELETE'): re.compile(r'^/v2/images/([^\/]+)$')
+# Every URI the cache acts on is matched in a single pass. The method the
+# request is treated as is then looked up by (version, method, is_file).
+ROUTE = re.compile(r'^/(v1|v2)/images/([^\/]+)(/file)?$')
+ROUTES = {
+    ('v1', 'GET', False): 'GET',
+    ('v1', 'DELETE', False): 'DELETE',
+    ('v1', 'PUT', False): 'PUT',
+    ('v2', 'GET', True): 'GET',
+    ('v2', 'DELETE', False): 'DELETE',
+    ('v2', 'PATCH', False): 'PUT',
 }
 
 
@@ -52,6 +59,7 @@ class CacheFilter(wsgi.Middleware):
     def __init__(self, app):
         self.cache = image_cache.ImageCache()
         self.serializer = images.ImageSerializer()
+        self.policy = policy.Enforcer()
         LOG.info(_("Initialized image cache middleware"))
         super(CacheFilter, self).__init__(app)
 
@@ -62,18 +70,27 @@ class CacheFilter(wsgi.Middleware):
         :returns tuple of version and image id if the url is a cacheable,
                  otherwise None
         """
-        for ((version, method), pattern) in PATTERNS.items():
-            match = pattern.match(request.path_info)
-            try:
-                assert request.method == method
-                image_id = match.group(1)
-                # Ensure the image id we got looks like an image id to filter
-                # out a URI like /images/detail. See LP Bug #879136
-                assert image_id != 'detail'
-            except (AttributeError, AssertionError):
-                continue
-            else:
-                return (version, method, image_id)
+        match = ROUTE.match(request.path_info)
+        if match is None:
+            return None
+
+        version, image_id, is_file = match.groups()
+        # Ensure the image id we got looks like an image id to filter
+        # out a URI like /images/detail. See LP Bug #879136
+        if image_id == 'detail':
+            return None
+
+        method = ROUTES.get((version, request.method, is_file is not None))
+        if method is None:
+            return None
+        return (version, method, image_id)
+
+    def _enforce(self, req, action):
+        """Authorize an action against our policies"""
+        try:
+            self.policy.enforce(req.context, action, {})
+        except exception.Forbidden, e:
+            raise webob.exc.HTTPForbidden(explanation=unicode(e), request=req)
 
     def process_request(self, request):
         """
@@ -98,19 +115,59 @@ class CacheFilter(wsgi.Middleware):
             return None
 
         LOG.debug(_("Cache hit for image '%s'"), image_id)
-        image_iterator = self.get_from_cache(image_id)
+        if request.environ.get('wsgi.file_wrapper') is wsgi.FileWrapper:
+            image_iterator = self.get_file_from_cache(image_id)
+        else:
+            image_iterator = self.get_from_cache(image_id)
         method = getattr(self, '_process_%s_request' % version)
 
         try:
             return method(request, image_id, image_iterator)
         except exception.NotFound:
+            image_iterator.close()
             msg = _("Image cache contained image file for image '%s', "
                     "however the registry did not contain metadata for "
                     "that image!" % image_id)
             LOG.error(msg)
+        except Exception:
+            image_iterator.close()
+            raise
+
+    @staticmethod
+    def _is_visible(context, image_meta):
+        """
+        Returns True if the image is known to be visible in this context
+        from its metadata alone. Images that may only be visible through
+        membership are not, as that can only be answered by the registry.
+        """
+        return (context.is_admin or
+                image_meta.get('is_public') or
+                image_meta.get('owner') is None or
+                (context.owner is not None and
+                 context.owner == image_meta.get('owner')))
+
+    def _get_v1_image_meta(self, request, image_id):
+        """
+        Returns the metadata of a cached image, from the metadata stored
+        alongside the cached file if it is fresh and shows the image is
+        visible to the requester, otherwise from the registry.
+        """
+        image_meta = self.cache.get_image_metadata(image_id)
+        if image_meta is not None and self._is_visible(request.context,
+                                                       image_meta):
+            LOG.debug(_("Using cached metadata for image '%s'"), image_id)
+            return image_meta
 
-    def _process_v1_request(self, request, image_id, image_iterator):
         image_meta = registry.get_image_metadata(request.context, image_id)
+        image_meta.pop('location', None)
+        if image_meta['status'] == 'active' and image_meta['size']:
+            self.cache.set_image_metadata(image_id, image_meta)
+        return image_meta
+
+    def _process_v1_request(self, request, image_id, image_iterator):
+        self._enforce(request, 'get_image')
+        self._enforce(request, 'download_image')
+        image_meta = self._get_v1_image_meta(request, image_id)
 
         if not image_meta['size']:
             # override image size metadata with the actual cached
@@ -129,6 +186,8 @@ class CacheFilter(wsgi.Middleware):
         self.db_api.configure_db()
         response = webob.Response(request=request)
         response.app_iter = image_iterator
+        response.headers['Content-Length'] = str(
+                self.cache.get_image_size(image_id))
         return response
 
     def process_response(self, resp):
@@ -163,6 +222,11 @@ class CacheFilter(wsgi.Middleware):
             self.cache.delete_cached_image(image_id)
         return resp
 
+    def _process_PUT_response(self, resp, image_id):
+        # The image's metadata changed, but its data did not
+        self.cache.delete_image_metadata(image_id)
+        return resp
+
     def _process_GET_response(self, resp, image_id):
         image_checksum = resp.headers.get('Content-MD5', None)
 
@@ -173,8 +237,14 @@ class CacheFilter(wsgi.Middleware):
         if not image_checksum:
             LOG.error(_("Checksum header is missing."))
 
+        image_meta = None
+        if 'x-image-meta-id' in resp.headers:
+            # Only API V1 serializes the image metadata into the response,
+            # which is what lets a later cache hit skip the registry
+            image_meta = utils.get_image_meta_from_headers(resp)
+
         resp.app_iter = self.cache.get_caching_iter(image_id, image_checksum,
-                                                    resp.app_iter)
+                                                    resp.app_iter, image_meta)
         return resp
 
     def get_status_code(self, response):
@@ -192,3 +262,21 @@ class CacheFilter(wsgi.Middleware):
             chunks = utils.chunkiter(cache_file)
             for chunk in chunks:
                 yield chunk
+
+    def get_file_from_cache(self, image_id):
+        """
+        Called if cache hit and the server takes a wsgi.FileWrapper, which
+        lets it send the cached file without reading it through Python
+        """
+        reader = self.cache.open_for_read(image_id)
+        image_file = wsgi.FileWrapper(reader.__enter__())
+        image_size = self.cache.get_image_size(image_id)
+
+        def count_hit(image_file):
+            # As with get_from_cache, only an image that was sent in full
+            # counts as a hit
+            if image_file.bytes_sent == image_size:
+                reader.__exit__(None, None, None)
+
+        image_file.add_close_callback(count_hit)
+        return image_file
@@ -44,7 +44,8 @@ from glance import notifier
 from glance.openstack.common import cfg
 import glance.openstack.common.log as logging
 from glance import registry
-from glance.store import (create_stores,
+from glance.store import (copy_within_backend,
+                          create_stores,
                           get_from_backend,
                           get_size_from_backend,
                           schedule_delete_from_backend,
@@ -222,7 +223,8 @@ class Controller(controller.BaseController):
     def _validate_source(source, req):
         """
         External sources (as specified via the location or copy-from headers)
-        are supported only over non-local store types, i.e. S3, Swift, HTTP.
+        are supported only over non-local store types, i.e. S3, Swift, HTTP,
+        and RBD for admins only.
         Note the absence of file:// for security reasons, see LP bug #942118.
         If the above constraint is violated, we reject with 400 "Bad Request".
         """
@@ -230,6 +232,10 @@ class Controller(controller.BaseController):
             for scheme in ['s3', 'swift', 'http']:
                 if source.lower().startswith(scheme):
                     return source
+            # RBD images are read with the store's own credentials, so
+            # only admins may name them
+            if req.context.is_admin and source.lower().startswith('rbd'):
+                return source
             msg = _("External sourcing not supported for store %s") % source
             LOG.error(msg)
             raise HTTPBadRequest(explanation=msg,
@@ -354,11 +360,7 @@ class Controller(controller.BaseController):
         """
 
         copy_from = self._copy_from(req)
-        if copy_from:
-            image_data, image_size = self._get_from_store(req.context,
-                                                          copy_from)
-            image_meta['size'] = image_size or image_meta['size']
-        else:
+        if not copy_from:
             try:
                 req.get_content_type('application/octet-stream')
             except exception.InvalidContentType:
@@ -382,10 +384,25 @@ class Controller(controller.BaseController):
                     "to %(scheme)s store"), locals())
 
         try:
-            location, size, checksum = store.add(
-                image_meta['id'],
-                utils.CooperativeReader(image_data),
-                image_meta['size'])
+            result = None
+            if copy_from:
+                # A copy the store can make itself finishes without the
+                # image data passing through here, but leaves nothing to
+                # check a supplied checksum against
+                if not image_meta.get('checksum'):
+                    result = copy_within_backend(store, image_id,
+                                                 copy_from,
+                                                 image_meta['size'])
+                if result is None:
+                    image_data, image_size = self._get_from_store(
+                        req.context, copy_from)
+                    image_meta['size'] = image_size or image_meta['size']
+
+            if result is None:
+                result = store.add(image_meta['id'],
+                                   utils.CooperativeReader(image_data),
+                                   image_meta['size'])
+            location, size, checksum = result
 
             # Verify any supplied checksum value matches checksum
             # returned from store when adding image
@@ -411,7 +428,14 @@ class Controller(controller.BaseController):
             image_meta = registry.update_image_metadata(req.context,
                                                         image_id,
                                                         update_data)
-            self.notifier.info('image.upload', image_meta)
+
+            # Stores which leave runs of zeros in the image unwritten say
+            # how many bytes of them they skipped
+            payload = image_meta
+            bytes_skipped = getattr(store, 'bytes_skipped', None)
+            if bytes_skipped is not None:
+                payload = dict(image_meta, bytes_skipped=bytes_skipped)
+            self.notifier.info('image.upload', payload)
 
             return location
 
@@ -741,6 +765,7 @@ class Controller(controller.BaseController):
         :raises HttpNotFound if image or any chunk is not available
         :raises HttpUnauthorized if image or any chunk is not
                 deleteable by the requesting user
+        :raises HTTPConflict if the image is in use through its store
         """
         self._enforce(req, 'delete_image')
 
@@ -777,6 +802,14 @@ class Controller(controller.BaseController):
             raise HTTPForbidden(explanation=msg,
                                 request=req,
                                 content_type="text/plain")
+        except exception.InUseByStore, e:
+            msg = ("Image is in use through its store: %(e)s" % locals())
+            for line in msg.split('\n'):
+                LOG.info(line)
+            self.notifier.info('image.delete', msg)
+            raise HTTPConflict(explanation=msg,
+                               request=req,
+                               content_type="text/plain")
         else:
             self.notifier.info('image.delete', image)
 
@@ -924,6 +957,9 @@ class ImageSerializer(wsgi.JSONResponseSerializer):
 
         return response
 
+    def detail(self, response, result):
+        self.stream(response, result, 'images')
+
     def update(self, response, result):
         image_meta = result['image_meta']
         response.body = self.to_json(dict(image=image_meta))
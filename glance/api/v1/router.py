@@ -18,6 +18,7 @@
 
 from glance.api.v1 import images
 from glance.api.v1 import members
+from glance.api.v1 import stats
 from glance.common import wsgi
 
 
@@ -47,4 +48,8 @@ class API(wsgi.Router):
                        action="update_all",
                        conditions=dict(method=["PUT"]))
 
+        stats_resource = stats.create_resource()
+        mapper.connect("/stats", controller=stats_resource, action="index",
+                       conditions=dict(method=["GET"]))
+
         super(API, self).__init__(mapper)
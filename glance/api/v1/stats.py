@@ -0,0 +1,46 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import webob.exc
+
+from glance.common import wsgi
+import glance.registry
+import glance.store
+
+
+class Controller(object):
+
+    def index(self, req):
+        """
+        Returns the statistics of each store which gathers any, such as
+        how full the filesystem store's data directories are, and of this
+        worker's pool of connections to the registry and cache of image
+        metadata. Only admins may see them.
+        """
+        if not req.context.is_admin:
+            raise webob.exc.HTTPForbidden()
+
+        return dict(
+            stores=glance.store.get_store_stats(req.context),
+            registry_connections=glance.registry.get_connection_pool_stats(),
+            metadata_cache=glance.registry.get_metadata_cache_stats())
+
+
+def create_resource():
+    """Store statistics resource factory method."""
+    serializer = wsgi.JSONResponseSerializer()
+    return wsgi.Resource(Controller(), serializer=serializer)
@@ -124,8 +124,11 @@ class ImagesController(object):
         except exception.NotFound as e:
             raise webob.exc.HTTPBadRequest(explanation=unicode(e))
         images = [self._normalize_properties(dict(image)) for image in images]
-        result['images'] = [self._append_tags(req.context, image)
-                            for image in images]
+        tags = self.db_api.image_tag_get_all_by_images(
+                req.context, [image['id'] for image in images])
+        for image in images:
+            image['tags'] = tags[image['id']]
+        result['images'] = images
         return result
 
     def _get_image(self, context, image_id):
@@ -357,7 +360,7 @@ class ResponseSerializer(wsgi.JSONResponseSerializer):
         params.pop('marker', None)
         query = urllib.urlencode(params)
         body = {
-               'images': [self._format_image(i) for i in result['images']],
+               'images': (self._format_image(i) for i in result['images']),
                'first': '/v2/images',
                'schema': '/v2/schemas/images',
         }
@@ -367,8 +370,7 @@ class ResponseSerializer(wsgi.JSONResponseSerializer):
             params['marker'] = result['next_marker']
             next_query = urllib.urlencode(params)
             body['next'] = '/v2/images?%s' % next_query
-        response.body = json.dumps(body)
-        response.content_type = 'application/json'
+        self.stream(response, body, 'images')
 
     def delete(self, response, result):
         response.status_int = 204
@@ -26,6 +26,8 @@ import httplib
 import os
 import re
 import select
+import StringIO
+import time
 import urllib
 import urlparse
 
@@ -35,6 +37,11 @@ except ImportError:
     import socket
     import ssl
 
+try:
+    from eventlet.semaphore import Semaphore
+except ImportError:
+    from threading import Semaphore
+
 try:
     import sendfile
     SENDFILE_SUPPORTED = True
@@ -199,6 +206,141 @@ class HTTPSClientAuthConnection(httplib.HTTPSConnection):
                                         cert_reqs=ssl.CERT_REQUIRED)
 
 
+class PooledResponse(object):
+
+    """
+    Wraps a response whose body has been read in full, so that the
+    connection it arrived on can be handed back to the pool before the
+    caller gets to the body.
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.body = StringIO.StringIO(response.read())
+        self.read = self.body.read
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+
+class ConnectionPool(object):
+
+    """
+    A pool of keep-alive HTTP connections, keyed by connection type,
+    host, port and connection (SSL) settings.
+
+    At most `max_size` idle connections are kept per key, and an idle
+    connection is dropped instead of reused once it has been idle for
+    more than `max_idle_time` seconds or once the server has closed it.
+    If `max_connections` is non-zero, no more than that many connections
+    per key are handed out at once and further callers wait for one to
+    be returned.
+    """
+
+    def __init__(self, max_size=10, max_idle_time=60, max_connections=0):
+        self.max_size = max_size
+        self.max_idle_time = max_idle_time
+        self.max_connections = max_connections
+        self.idle = {}
+        self.checked_out = {}
+        self.semaphores = {}
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'discarded': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+        }
+
+    def _key(self, connection_type, host, port, connect_kwargs):
+        return (connection_type, host, port,
+                tuple(sorted(connect_kwargs.items())))
+
+    def _is_usable(self, connection, last_used):
+        if time.time() - last_used > self.max_idle_time:
+            return False
+        sock = getattr(connection, 'sock', None)
+        if sock is None:
+            # Not connected yet, or closed after a response that asked
+            # for the connection to be closed; httplib will reconnect.
+            return True
+        try:
+            # An idle keep-alive connection should have nothing to read.
+            # If it is readable, the server has closed it (or sent us
+            # something we did not ask for), so it cannot be reused.
+            readable, _, _ = select.select([sock], [], [], 0)
+            return not readable
+        except (select.error, socket.error, ValueError):
+            return False
+
+    def get(self, connection_type, host, port, connect_kwargs):
+        """
+        Returns a tuple of (connection, reused) for the given endpoint,
+        reusing an idle connection if there is a healthy one.
+        """
+        key = self._key(connection_type, host, port, connect_kwargs)
+
+        if self.max_connections:
+            semaphore = self.semaphores.setdefault(
+                key, Semaphore(self.max_connections))
+            if semaphore.locked():
+                self.stats['waits'] += 1
+            start = time.time()
+            semaphore.acquire()
+            self.stats['wait_time'] += time.time() - start
+
+        idle = self.idle.get(key, [])
+        while idle:
+            connection, last_used = idle.pop()
+            if self._is_usable(connection, last_used):
+                self.stats['hits'] += 1
+                self.checked_out[connection] = key
+                return connection, True
+            self.stats['discarded'] += 1
+            connection.close()
+
+        self.stats['misses'] += 1
+        try:
+            connection = connection_type(host, port, **connect_kwargs)
+        except Exception:
+            if self.max_connections:
+                self.semaphores[key].release()
+            raise
+        self.checked_out[connection] = key
+        return connection, False
+
+    def put(self, connection, reusable=True):
+        """
+        Hands a connection obtained from `get` back to the pool. The
+        connection is closed rather than kept if it is not `reusable`
+        or if there are already `max_size` idle connections for its key.
+        """
+        key = self.checked_out.pop(connection)
+        idle = self.idle.setdefault(key, [])
+        if reusable and len(idle) < self.max_size:
+            idle.append((connection, time.time()))
+        else:
+            connection.close()
+
+        if self.max_connections:
+            self.semaphores[key].release()
+
+    def get_stats(self):
+        """
+        Returns the pool's counters, along with the hit rate and the
+        average time spent waiting for a connection.
+        """
+        stats = self.stats.copy()
+        checkouts = stats['hits'] + stats['misses']
+        stats['hit_rate'] = (float(stats['hits']) / checkouts
+                             if checkouts else 0.0)
+        stats['average_wait_time'] = (stats['wait_time'] / checkouts
+                                      if checkouts else 0.0)
+        stats['idle'] = sum(len(idle) for idle in self.idle.values())
+        stats['in_use'] = len(self.checked_out)
+        return stats
+
+
 class BaseClient(object):
 
     """A base client class"""
@@ -230,7 +372,7 @@ class BaseClient(object):
     def __init__(self, host, port=None, timeout=None, use_ssl=False,
                  auth_tok=None, creds=None, doc_root=None, key_file=None,
                  cert_file=None, ca_file=None, insecure=False,
-                 configure_via_auth=True):
+                 configure_via_auth=True, connection_pool=None):
         """
         Creates a new client to some service.
 
@@ -264,6 +406,9 @@ class BaseClient(object):
                          URL returned from the service catalog for the image
                          endpoint will **override** the URL supplied to in
                          the host parameter.
+        :param connection_pool: Optional `ConnectionPool` to take
+                         keep-alive connections from for requests that
+                         do not stream a body to the server.
         """
         self.host = host
         self.port = port or self.DEFAULT_PORT
@@ -273,6 +418,7 @@ class BaseClient(object):
         self.creds = creds or {}
         self.connection = None
         self.configure_via_auth = configure_via_auth
+        self.connection_pool = connection_pool
         # doc_root can be a nullstring, which is valid, and why we
         # cannot simply do doc_root or self.DEFAULT_DOC_ROOT below.
         self.doc_root = (doc_root if doc_root is not None
@@ -499,8 +645,6 @@ class BaseClient(object):
             if 'x-auth-token' not in headers and self.auth_tok:
                 headers['x-auth-token'] = self.auth_tok
 
-            c = connection_type(url.hostname, url.port, **self.connect_kwargs)
-
             def _pushing(method):
                 return method.lower() in ('post', 'put')
 
@@ -527,10 +671,20 @@ class BaseClient(object):
             # on whether the body param is file-like or iterable and
             # the method is PUT or POST
             #
-            if not _pushing(method) or _simple(body):
+            if self.connection_pool is not None and (not _pushing(method) or
+                                                     _simple(body)):
+                # Simple request over a pooled connection...
+                res = self._do_pooled_request(connection_type, url, method,
+                                              path, body, headers)
+            elif not _pushing(method) or _simple(body):
                 # Simple request...
+                c = connection_type(url.hostname, url.port,
+                                    **self.connect_kwargs)
                 c.request(method, path, body, headers)
+                res = c.getresponse()
             elif _filelike(body) or self._iterable(body):
+                c = connection_type(url.hostname, url.port,
+                                    **self.connect_kwargs)
                 c.putrequest(method, path)
 
                 use_sendfile = self._sendable(body)
@@ -549,11 +703,11 @@ class BaseClient(object):
                 else:
                     # otherwise iterate and chunk
                     _chunkbody(c, iter)
+
+                res = c.getresponse()
             else:
                 raise TypeError('Unsupported image type: %s' % body.__class__)
 
-            res = c.getresponse()
-
             def _retry(res):
                 return res.getheader('Retry-After')
 
@@ -588,6 +742,38 @@ class BaseClient(object):
         except (socket.error, IOError), e:
             raise exception.ClientConnectionError(e)
 
+    def _do_pooled_request(self, connection_type, url, method, path, body,
+                           headers):
+        """
+        Issues a simple request over a connection from the connection
+        pool and reads the whole response, so the connection can go back
+        to the pool. A request that fails on a reused connection, which
+        the server may have closed while it sat idle, is retried on
+        another connection if it failed before it was sent in full or
+        if it is safe to repeat, since otherwise the server may already
+        have acted on it.
+        """
+        while True:
+            c, reused = self.connection_pool.get(connection_type,
+                                                 url.hostname, url.port,
+                                                 self.connect_kwargs)
+            reusable = False
+            sent = False
+            try:
+                c.request(method, path, body, headers)
+                sent = True
+                res = PooledResponse(c.getresponse())
+                reusable = not getattr(res, 'will_close', False)
+                return res
+            except (socket.error, IOError, httplib.HTTPException), e:
+                if not reused or (sent and
+                                  method.upper() not in ('GET', 'HEAD')):
+                    raise
+                LOG.debug(_("Request on pooled connection failed, "
+                            "retrying: %s"), e)
+            finally:
+                self.connection_pool.put(c, reusable)
+
     def _seekable(self, body):
         # pipes are not seekable, avoids sendfile() failure on e.g.
         #   cat /path/to/image | glance add ...
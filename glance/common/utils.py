@@ -28,12 +28,18 @@ except ImportError:
     from time import sleep
 
 import functools
+import json
 import os
 import platform
 import subprocess
 import sys
 import uuid
 
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
 import iso8601
 from webob import exc
 
@@ -46,6 +52,22 @@ LOG = logging.getLogger(__name__)
 FEATURE_BLACKLIST = ['content-length', 'content-type', 'x-image-meta-size']
 
 
+def json_loads(s):
+    """
+    Decodes a JSON document, with simplejson's faster decoder when it is
+    installed. Strings are returned as unicode either way.
+
+    :param s: the JSON document, as a str or unicode
+    """
+    if simplejson is None:
+        return json.loads(s)
+    # simplejson returns str rather than unicode for ASCII strings
+    # unless it is given unicode
+    if isinstance(s, str):
+        s = s.decode('utf-8')
+    return simplejson.loads(s)
+
+
 def chunkreadable(iter, chunk_size=65536):
     """
     Wrap a readable iterator with a reader yielding chunks of
@@ -23,7 +23,6 @@ Utility methods for working with WSGI servers
 
 import datetime
 import errno
-import json
 import logging
 import os
 import signal
@@ -33,6 +32,7 @@ import time
 import eventlet
 from eventlet.green import socket, ssl
 import eventlet.greenio
+import eventlet.hubs
 import eventlet.wsgi
 import routes
 import routes.middleware
@@ -42,8 +42,14 @@ import webob.exc
 from glance.common import exception
 from glance.common import utils
 from glance.openstack.common import cfg
+from glance.openstack.common import jsonutils
 import glance.openstack.common.log as os_logging
 
+try:
+    import sendfile
+    SENDFILE_SUPPORTED = True
+except ImportError:
+    SENDFILE_SUPPORTED = False
 
 bind_opts = [
     cfg.StrOpt('bind_host', default='0.0.0.0'),
@@ -65,6 +71,12 @@ CONF.register_opts(bind_opts)
 CONF.register_opts(socket_opts)
 CONF.register_opt(workers_opt)
 
+# Block size used when a FileWrapper is iterated rather than sent
+FILE_WRAPPER_BLKSIZE = 65536
+
+# Number of bytes of a streamed JSON response gathered before each write
+JSON_STREAM_CHUNK_SIZE = 65536
+
 
 class WritableLogger(object):
     """A thin wrapper that responds to `write` and logs."""
@@ -153,6 +165,152 @@ def get_socket(default_port):
     return sock
 
 
+class FileWrapper(object):
+    """
+    The wsgi.file_wrapper offered to applications, as described in PEP 333.
+
+    Iterating over it reads the file in blocks. When an application returns
+    one, the server sends the file straight from the page cache to the
+    socket with sendfile(2) instead, where that is possible.
+    """
+
+    def __init__(self, filelike, blksize=FILE_WRAPPER_BLKSIZE):
+        self.filelike = filelike
+        self.blksize = blksize
+        # If set, the number of bytes the file is expected to hold. Sending
+        # fewer fails, as it would for a backend that disconnects early.
+        self.length = None
+        self.bytes_sent = 0
+        self.close_callbacks = []
+        self.closed = False
+
+    def fileno(self):
+        return self.filelike.fileno()
+
+    def add_close_callback(self, callback):
+        """
+        Registers a callable to be passed this wrapper once the server has
+        finished with it, however far the file was sent
+        """
+        self.close_callbacks.append(callback)
+
+    def _check_length(self):
+        if self.length is not None and self.bytes_sent != self.length:
+            raise IOError(errno.EPIPE,
+                          _("File ended after %(bytes_sent)d of %(length)d "
+                            "bytes") % {'bytes_sent': self.bytes_sent,
+                                        'length': self.length})
+
+    def __iter__(self):
+        while True:
+            chunk = self.filelike.read(self.blksize)
+            if not chunk:
+                break
+            self.bytes_sent += len(chunk)
+            yield chunk
+        self._check_length()
+
+    def sendfile(self, sock):
+        """
+        Sends the rest of the file to a socket with sendfile(2), waiting
+        for the socket to become writable whenever it would block
+
+        :param sock: A connected, non-SSL socket
+        """
+        offset = self.filelike.tell()
+        while True:
+            try:
+                sent = sendfile.sendfile(sock.fileno(), self.fileno(),
+                                         offset, self.blksize)
+            except OSError, e:
+                if e.errno not in (errno.EAGAIN, errno.EBUSY):
+                    raise
+                eventlet.hubs.trampoline(sock.fileno(), write=True)
+                continue
+            if not sent:
+                break
+            offset += sent
+            self.bytes_sent += sent
+        self._check_length()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            for callback in self.close_callbacks:
+                callback(self)
+        finally:
+            if hasattr(self.filelike, 'close'):
+                self.filelike.close()
+
+
+class HttpProtocol(eventlet.wsgi.HttpProtocol):
+    """
+    Offers wsgi.file_wrapper to applications and, on connections that are
+    not SSL wrapped, a way to answer a request with sendfile(2)
+    """
+
+    def get_environ(self):
+        env = eventlet.wsgi.HttpProtocol.get_environ(self)
+        env['wsgi.file_wrapper'] = FileWrapper
+        if SENDFILE_SUPPORTED and not isinstance(self.connection,
+                                                 ssl.SSLSocket):
+            env['glance.sendfile_response'] = self.sendfile_response
+        return env
+
+    def sendfile_response(self, status, headers, file_wrapper):
+        """
+        Writes the response status and headers, then sends the file body
+        with sendfile(2). The connection is closed afterwards, as nothing
+        else knows how much of the response was written.
+        """
+        towrite = ['%s %s\r\n' % (self.protocol_version, status)]
+        for header in headers:
+            towrite.append('%s: %s\r\n' % header)
+        if 'date' not in [header[0].lower() for header in headers]:
+            towrite.append('Date: %s\r\n' % self.date_time_string())
+        towrite.append('Connection: close\r\n\r\n')
+        self.wfile.writelines(towrite)
+        self.wfile.flush()
+        file_wrapper.sendfile(self.connection)
+
+
+def sendfile_application(application, logger):
+    """
+    Wraps a WSGI application so that, when it responds with a FileWrapper
+    and the server offers sendfile(2), the file is sent without being read
+    through Python
+    """
+    def app(environ, start_response):
+        response = []
+
+        def _start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+            return start_response(status, headers, exc_info)
+
+        result = application(environ, _start_response)
+
+        sendfile_response = environ.get('glance.sendfile_response')
+        if (sendfile_response is None or not response or
+                not isinstance(result, FileWrapper)):
+            return result
+
+        status, headers = response
+        if 'content-length' not in [header[0].lower() for header in headers]:
+            return result
+
+        try:
+            sendfile_response(status, headers, result)
+        except (IOError, OSError, socket.error), e:
+            logger.error(_("Failed to send file response: %s") % e)
+        finally:
+            result.close()
+        return eventlet.wsgi.ALREADY_HANDLED
+
+    return app
+
+
 class Server(object):
     """Server class to manage multiple WSGI sockets and applications."""
 
@@ -266,8 +424,10 @@ class Server(object):
         eventlet.patcher.monkey_patch(all=False, socket=True)
         self.pool = eventlet.GreenPool(size=self.threads)
         try:
-            eventlet.wsgi.server(self.sock, self.application,
-                    log=WritableLogger(self.logger), custom_pool=self.pool)
+            eventlet.wsgi.server(self.sock,
+                    sendfile_application(self.application, self.logger),
+                    log=WritableLogger(self.logger), custom_pool=self.pool,
+                    protocol=HttpProtocol)
         except socket.error, err:
             if err[0] != errno.EINVAL:
                 raise
@@ -276,8 +436,11 @@ class Server(object):
     def _single_run(self, application, sock):
         """Start a WSGI server in a new green thread."""
         self.logger.info(_("Starting single process server"))
-        eventlet.wsgi.server(sock, application, custom_pool=self.pool,
-                             log=WritableLogger(self.logger))
+        eventlet.wsgi.server(sock,
+                             sendfile_application(application, self.logger),
+                             custom_pool=self.pool,
+                             log=WritableLogger(self.logger),
+                             protocol=HttpProtocol)
 
 
 class Middleware(object):
@@ -456,7 +619,7 @@ class JSONRequestDeserializer(object):
 
     def from_json(self, datastring):
         try:
-            return json.loads(datastring)
+            return utils.json_loads(datastring)
         except ValueError:
             msg = _('Malformed JSON in request body.')
             raise webob.exc.HTTPBadRequest(explanation=msg)
@@ -470,18 +633,59 @@ class JSONRequestDeserializer(object):
 
 class JSONResponseSerializer(object):
 
+    @staticmethod
+    def _sanitizer(obj):
+        if isinstance(obj, datetime.datetime):
+            return obj.isoformat()
+        return obj
+
     def to_json(self, data):
-        def sanitizer(obj):
-            if isinstance(obj, datetime.datetime):
-                return obj.isoformat()
-            return obj
+        return jsonutils.dumps(data, default=self._sanitizer)
+
+    def to_json_iter(self, data, key):
+        """
+        Serializes a mapping to JSON in pieces rather than in one string.
 
-        return json.dumps(data, default=sanitizer)
+        The sequence under `key`, which may be a generator, is serialized
+        an element at a time, so that only one of its elements need be
+        held at once, and the start of the document is yielded before any
+        of them are made. The rest is yielded in pieces of about
+        JSON_STREAM_CHUNK_SIZE bytes.
+        """
+        yield '{%s: [' % self.to_json(key)
+
+        chunk = []
+        chunk_size = 0
+        separator = ''
+        for element in data[key]:
+            piece = separator + self.to_json(element)
+            separator = ', '
+            chunk.append(piece)
+            chunk_size += len(piece)
+            if chunk_size >= JSON_STREAM_CHUNK_SIZE:
+                yield ''.join(chunk)
+                chunk = []
+                chunk_size = 0
+
+        chunk.append(']')
+        for (k, v) in data.iteritems():
+            if k != key:
+                chunk.append(', %s: %s' % (self.to_json(k), self.to_json(v)))
+        chunk.append('}')
+        yield ''.join(chunk)
 
     def default(self, response, result):
         response.content_type = 'application/json'
         response.body = self.to_json(result)
 
+    def stream(self, response, result, key):
+        """
+        Sets the response's body to the JSON serialization of `result`,
+        streamed as it is made, as to_json_iter makes it
+        """
+        response.content_type = 'application/json'
+        response.app_iter = self.to_json_iter(result, key)
+
 
 class Resource(object):
     """
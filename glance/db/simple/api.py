@@ -132,10 +132,9 @@ def _filter_images(images, filters):
             else:
                 properties = {}
                 for p in image['properties']:
-                    properties = {p['name']: p['value'],
-                                  'deleted': p['deleted']}
-                add = properties.get(key) == value and \
-                                             properties.get('deleted') is False
+                    if p['deleted'] is False:
+                        properties[p['name']] = p['value']
+                add = properties.get(key) == value
             if not add:
                 break
 
@@ -309,6 +308,12 @@ def image_tag_get_all(context, image_id):
     return DATA['tags'].get(image_id, [])
 
 
+@log_call
+def image_tag_get_all_by_images(context, image_ids):
+    return dict((image_id, list(DATA['tags'].get(image_id, [])))
+                for image_id in image_ids)
+
+
 @log_call
 def image_tag_get(context, image_id, value):
     tags = image_tag_get_all(context, image_id)
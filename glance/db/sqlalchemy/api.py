@@ -22,11 +22,14 @@
 Defines interface for DB access
 """
 
+import collections
+import itertools
 import logging
 import time
 
 import sqlalchemy
 import sqlalchemy.orm
+import sqlalchemy.pool
 import sqlalchemy.sql
 
 from glance.common import exception
@@ -39,6 +42,9 @@ from glance.openstack.common import timeutils
 
 _ENGINE = None
 _MAKER = None
+_READ_MAKERS = []
+_READ_MAKER_CYCLE = None
+_POOL_STATS = {}
 _MAX_RETRIES = None
 _RETRY_INTERVAL = None
 BASE = models.BASE
@@ -52,11 +58,35 @@ DISK_FORMATS = ['ami', 'ari', 'aki', 'vhd', 'vmdk', 'raw', 'qcow2', 'vdi',
 STATUSES = ['active', 'saving', 'queued', 'killed', 'pending_delete',
             'deleted']
 
+# Number of images loaded by each query for one page of image_get_all,
+# which keeps the IN clause within what every database accepts
+IMAGE_LOAD_BATCH_SIZE = 500
+
+# Number of leading characters of property values indexed on databases
+# which can't index them whole
+PROPERTY_VALUE_INDEX_PREFIX_LENGTH = 255
+
+# Number of images a property value must be set on for filtering on it
+# to be done by probing each image rather than looking up the value
+PROPERTY_FILTER_SELECTIVE_ROWS = 250
+
 db_opts = [
     cfg.IntOpt('sql_idle_timeout', default=3600),
     cfg.IntOpt('sql_max_retries', default=10),
     cfg.IntOpt('sql_retry_interval', default=1),
     cfg.BoolOpt('db_auto_create', default=False),
+    cfg.IntOpt('sql_pool_size', default=None),
+    cfg.IntOpt('sql_max_overflow', default=None),
+    cfg.IntOpt('sql_pool_timeout', default=None),
+    cfg.IntOpt('sql_ping_interval', default=0),
+    cfg.ListOpt('sql_read_connections', default=[]),
+    cfg.IntOpt('sql_read_after_write_window', default=10,
+               help=_('Seconds after a write to an image for which reads '
+                      'of the image, or on behalf of the tenant which '
+                      'wrote it, go to sql_connection rather than a read '
+                      'replica. Writes are only tracked by the process '
+                      'which made them, so this is best-effort: reads '
+                      'served by other processes may still be stale.')),
     ]
 
 CONF = cfg.CONF
@@ -84,30 +114,134 @@ def ping_listener(dbapi_conn, connection_rec, connection_proxy):
             raise
 
 
+def idle_ping_listener(ping_interval, stats):
+    """
+    Returns a checkout listener which pings MySQL connections, as
+    ping_listener does, only once they have been idle in the pool for
+    `ping_interval` seconds or more, saving a round trip on the checkout
+    of connections which were in use moments ago
+    """
+    def listener(dbapi_conn, connection_rec, connection_proxy):
+        idle_since = connection_rec.info.get('idle_since')
+        if idle_since is None or time.time() - idle_since >= ping_interval:
+            stats['pings'] += 1
+            ping_listener(dbapi_conn, connection_rec, connection_proxy)
+
+    return listener
+
+
+def _idle_since_listener(dbapi_conn, connection_rec, *args):
+    """Notes when a connection was opened or returned to its pool."""
+    if connection_rec is not None:
+        connection_rec.info['idle_since'] = time.time()
+
+
+def _timed_checkout(pool, stats):
+    """
+    Wraps the pool's ways of checking out a connection, both the one
+    sessions use and the one Engine.connect does, to time how long each
+    checkout waited for a connection and count those which timed out
+    """
+    def timed(checkout):
+        def _checkout():
+            start = time.time()
+            try:
+                return checkout()
+            except sqlalchemy.exc.TimeoutError:
+                stats['checkout_timeouts'] += 1
+                raise
+            finally:
+                elapsed = time.time() - start
+                stats['checkout_time'] += elapsed
+                stats['checkout_time_max'] = max(stats['checkout_time_max'],
+                                                 elapsed)
+        return _checkout
+
+    pool.connect = timed(pool.connect)
+    pool.unique_connection = timed(pool.unique_connection)
+
+
+def _create_engine(sql_connection, name):
+    """
+    Create an engine for a connection string, checking that it can
+    connect, and gather statistics on the connections checked out of
+    its pool.
+
+    :param name: The name the engine's pool statistics are kept under
+    """
+    connection_dict = sqlalchemy.engine.url.make_url(sql_connection)
+    engine_args = {'pool_recycle': CONF.sql_idle_timeout,
+                   'echo': False,
+                   'convert_unicode': True
+                   }
+
+    # SQLite connections are kept one per thread, or not pooled at all,
+    # so there is no pool for these to size
+    if 'sqlite' not in connection_dict.drivername:
+        if CONF.sql_pool_size is not None:
+            engine_args['pool_size'] = CONF.sql_pool_size
+        if CONF.sql_max_overflow is not None:
+            engine_args['max_overflow'] = CONF.sql_max_overflow
+        if CONF.sql_pool_timeout is not None:
+            engine_args['pool_timeout'] = CONF.sql_pool_timeout
+
+    engine = sqlalchemy.create_engine(sql_connection, **engine_args)
+
+    stats = {'engine': engine,
+             'checkouts': 0,
+             'overflow_checkouts': 0,
+             'checkout_timeouts': 0,
+             'checkout_time': 0.0,
+             'checkout_time_max': 0.0,
+             'pings': 0,
+             'reads': 0}
+    _POOL_STATS[name] = stats
+
+    if 'mysql' in connection_dict.drivername:
+        if CONF.sql_ping_interval > 0:
+            sqlalchemy.event.listen(engine, 'connect', _idle_since_listener)
+            sqlalchemy.event.listen(engine, 'checkin', _idle_since_listener)
+            sqlalchemy.event.listen(engine, 'checkout', idle_ping_listener(
+                    CONF.sql_ping_interval, stats))
+        else:
+            sqlalchemy.event.listen(engine, 'checkout', ping_listener)
+
+    pool = engine.pool
+
+    def checkout_listener(dbapi_conn, connection_rec, connection_proxy):
+        stats['checkouts'] += 1
+        # The pool has run out of connections kept open between requests
+        # when it has had to open more than pool_size of them
+        if (isinstance(pool, sqlalchemy.pool.QueuePool) and
+            pool.overflow() > 0):
+            stats['overflow_checkouts'] += 1
+
+    sqlalchemy.event.listen(engine, 'checkout', checkout_listener)
+    _timed_checkout(pool, stats)
+
+    engine.connect = wrap_db_error(engine.connect)
+    engine.connect()
+    return engine
+
+
 def configure_db():
     """
     Establish the database, create an engine if needed, and
     register the models.
+
+    An engine is created for each of the read replicas listed in
+    sql_read_connections too, which image_get, image_get_all,
+    image_member_find and image_tag_get_all read from in turn.
     """
     global _ENGINE, sa_logger, _MAX_RETRIES, _RETRY_INTERVAL
+    global _READ_MAKERS, _READ_MAKER_CYCLE
     if not _ENGINE:
         sql_connection = CONF.sql_connection
         _MAX_RETRIES = CONF.sql_max_retries
         _RETRY_INTERVAL = CONF.sql_retry_interval
-        connection_dict = sqlalchemy.engine.url.make_url(sql_connection)
-        engine_args = {'pool_recycle': CONF.sql_idle_timeout,
-                       'echo': False,
-                       'convert_unicode': True
-                       }
 
         try:
-            _ENGINE = sqlalchemy.create_engine(sql_connection, **engine_args)
-
-            if 'mysql' in connection_dict.drivername:
-                sqlalchemy.event.listen(_ENGINE, 'checkout', ping_listener)
-
-            _ENGINE.connect = wrap_db_error(_ENGINE.connect)
-            _ENGINE.connect()
+            _ENGINE = _create_engine(sql_connection, 'primary')
         except Exception, err:
             msg = _("Error configuring registry database with supplied "
                     "sql_connection '%(sql_connection)s'. "
@@ -115,6 +249,24 @@ def configure_db():
             LOG.error(msg)
             raise
 
+        read_makers = []
+        for i, sql_connection in enumerate(CONF.sql_read_connections):
+            name = 'replica-%d' % i
+            try:
+                engine = _create_engine(sql_connection, name)
+            except Exception, err:
+                msg = _("Error configuring registry read replica with "
+                        "supplied sql_read_connections entry "
+                        "'%(sql_connection)s'. Got error:\n%(err)s") % locals()
+                LOG.error(msg)
+                raise
+            read_makers.append((name, sqlalchemy.orm.sessionmaker(
+                    bind=engine, autocommit=True, expire_on_commit=False)))
+        _READ_MAKERS = read_makers
+        _READ_MAKER_CYCLE = itertools.cycle(read_makers)
+        _RECENT_WRITES.clear()
+        _RECENT_WRITE_EXPIRY.clear()
+
         sa_logger = logging.getLogger('sqlalchemy.engine')
         if CONF.debug:
             sa_logger.setLevel(logging.DEBUG)
@@ -154,6 +306,102 @@ def get_session(autocommit=True, expire_on_commit=False):
     return _MAKER()
 
 
+# Times until which reads must go to the primary database, keyed by the
+# tenants and images written to through this process, so that they
+# aren't served by a replica which has yet to catch up with them. Writes
+# made through other processes aren't seen here.
+_RECENT_WRITES = {}
+# The same keys, in the order in which they expire
+_RECENT_WRITE_EXPIRY = collections.deque()
+
+
+def _write_keys(context, image_ids):
+    keys = [('image', image_id) for image_id in image_ids]
+    if getattr(context, 'owner', None) is not None:
+        keys.append(('owner', context.owner))
+    return keys
+
+
+def _expire_recent_writes(now):
+    while _RECENT_WRITE_EXPIRY and _RECENT_WRITE_EXPIRY[0][0] <= now:
+        expires, key = _RECENT_WRITE_EXPIRY.popleft()
+        if _RECENT_WRITES.get(key) == expires:
+            del _RECENT_WRITES[key]
+
+
+def _record_write(context, *image_ids):
+    """
+    Note that the tenant in `context` wrote to the images, so that reads
+    on behalf of it or of the images are made from the primary database
+    for the next sql_read_after_write_window seconds, by this process
+    """
+    if not _READ_MAKERS:
+        return
+
+    now = time.time()
+    _expire_recent_writes(now)
+    expires = now + CONF.sql_read_after_write_window
+    for key in _write_keys(context, image_ids):
+        _RECENT_WRITES[key] = expires
+        _RECENT_WRITE_EXPIRY.append((expires, key))
+
+
+def _get_read_session(context, *image_ids):
+    """
+    Returns a session on the next read replica, or on the primary
+    database if there are none or if the tenant in `context` or any of
+    the images was written to recently through this process
+    """
+    if not _READ_MAKERS:
+        return get_session()
+
+    _expire_recent_writes(time.time())
+    for key in _write_keys(context, image_ids):
+        if key in _RECENT_WRITES:
+            _POOL_STATS['primary']['reads'] += 1
+            return get_session()
+
+    name, maker = _READ_MAKER_CYCLE.next()
+    _POOL_STATS[name]['reads'] += 1
+    return maker()
+
+
+def get_pool_stats():
+    """
+    Returns the connection pool statistics of the primary database and
+    of each read replica, keyed by 'primary' or 'replica-<n>'.
+
+    Each has counters since the database was configured of:
+
+    * checkouts: connections checked out of the pool
+    * overflow_checkouts: checkouts made while the pool had more than
+      sql_pool_size connections open
+    * checkout_timeouts: checkouts which gave up waiting for a connection
+      after sql_pool_timeout seconds
+    * checkout_time, checkout_time_max, checkout_time_avg: the total,
+      longest and mean seconds spent waiting for a connection
+    * pings: connections checked to be alive on checkout
+    * reads: reads routed to the database
+
+    For pools which keep connections open, it has the pool's size, how
+    many of them are checked out or in now and how far it has overflowed
+    too.
+    """
+    pool_stats = {}
+    for name, stats in _POOL_STATS.items():
+        pool = stats['engine'].pool
+        engine_stats = dict((k, v) for (k, v) in stats.items()
+                            if k != 'engine')
+        attempts = stats['checkouts'] + stats['checkout_timeouts']
+        engine_stats['checkout_time_avg'] = (
+                stats['checkout_time'] / attempts if attempts else 0.0)
+        if isinstance(pool, sqlalchemy.pool.QueuePool):
+            for key in ('size', 'checkedin', 'checkedout', 'overflow'):
+                engine_stats[key] = getattr(pool, key)()
+        pool_stats[name] = engine_stats
+    return pool_stats
+
+
 def is_db_connection_error(args):
     """Return True if error in connecting to db."""
     # NOTE(adam_g): This is currently MySQL specific and needs to be extended
@@ -222,20 +470,34 @@ def image_destroy(context, image_id):
         for prop_ref in image_ref.properties:
             image_property_delete(context, prop_ref, session=session)
 
-        for memb_ref in image_member_find(context, image_id=image_id):
+        for memb_ref in image_member_find(context, image_id=image_id,
+                                          session=session):
             image_member_delete(context, memb_ref, session=session)
 
+        _record_write(context, image_id)
         return image_ref
 
 
 def image_get(context, image_id, session=None, force_show_deleted=False):
     """Get an image or raise if it does not exist."""
-    session = session or get_session()
+    return _image_get(context, image_id, session=session,
+                      force_show_deleted=force_show_deleted)
+
+
+def _image_get(context, image_id, session=None, force_show_deleted=False,
+               load_properties=True):
+    """Get an image or raise if it does not exist.
+
+    :param load_properties: False to leave the image's properties to be
+                            loaded only if they are used
+    """
+    session = session or _get_read_session(context, image_id)
 
     try:
-        query = session.query(models.Image).\
-                options(sqlalchemy.orm.joinedload(models.Image.properties)).\
-                filter_by(id=image_id)
+        query = session.query(models.Image).filter_by(id=image_id)
+        if load_properties:
+            query = query.options(
+                    sqlalchemy.orm.joinedload(models.Image.properties))
 
         # filter out deleted images if context disallows it
         if not force_show_deleted and not can_show_deleted(context):
@@ -344,6 +606,13 @@ def paginate_query(query, model, limit, sort_keys, marker=None,
     the lexicographical ordering:
     (k1 > X1) or (k1 == X1 && k2 > X2) or (k1 == X1 && k2 == X2 && k3 > X3)
 
+    When every key is sorted in the same direction and the database
+    understands row values, this is written as (k1, k2, k3) > (X1, X2, X3)
+    instead, which a database can use an index on (k1, k2, k3) to seek to.
+    Either way the redundant k1 >= X1 is added, so that a planner which
+    can't see through the full predicate can still range scan an index
+    on k1 rather than read every row before the marker.
+
     We also have to cope with different sort_directions.
 
     Typically, the id of the last row is used as the client-facing pagination
@@ -400,6 +669,28 @@ def paginate_query(query, model, limit, sort_keys, marker=None,
             v = getattr(marker, sort_key)
             marker_values.append(v)
 
+        model_attr = getattr(model, sort_keys[0])
+        if sort_dirs[0] == 'desc':
+            query = query.filter(model_attr <= marker_values[0])
+        elif sort_dirs[0] == 'asc':
+            query = query.filter(model_attr >= marker_values[0])
+        else:
+            raise ValueError(_("Unknown sort direction, "
+                               "must be 'desc' or 'asc'"))
+
+        if len(set(sort_dirs)) == 1 and _supports_row_values(query):
+            row = sqlalchemy.sql.tuple_(*[getattr(model, sort_key)
+                                          for sort_key in sort_keys])
+            marker_row = sqlalchemy.sql.tuple_(*marker_values)
+            if sort_dirs[0] == 'desc':
+                query = query.filter(row < marker_row)
+            else:
+                query = query.filter(row > marker_row)
+
+            if limit is not None:
+                query = query.limit(limit)
+            return query
+
         # Build up an array of sort criteria as in the docstring
         criteria_list = []
         for i in xrange(0, len(sort_keys)):
@@ -429,6 +720,99 @@ def paginate_query(query, model, limit, sort_keys, marker=None,
     return query
 
 
+def _property_matches(session, name, value):
+    """Returns the criteria for a property row with the given value."""
+    image_properties = models.ImageProperty.__table__
+    match = [image_properties.c.name == name,
+             image_properties.c.value == value,
+             image_properties.c.deleted == False]
+    if (session.bind.dialect.name == 'postgresql' and
+        isinstance(value, basestring)):
+        # PostgreSQL indexes an expression on the value's prefix, which
+        # is only used if the query contains that expression
+        prefix = value[:PROPERTY_VALUE_INDEX_PREFIX_LENGTH]
+        match.append(sqlalchemy.func.substr(
+                image_properties.c.value, 1,
+                PROPERTY_VALUE_INDEX_PREFIX_LENGTH) == prefix)
+    return sqlalchemy.sql.and_(*match)
+
+
+def _selective_properties(session, properties):
+    """
+    Returns those of the properties whose values are set on fewer than
+    PROPERTY_FILTER_SELECTIVE_ROWS images.
+
+    The rows matching each property are counted through the index on
+    (name, value, image_id), stopping at the threshold, so this costs at
+    most that many index entries per property whatever the catalog size.
+    """
+    image_properties = models.ImageProperty.__table__
+    items = properties.items()
+    counts = []
+    for (name, value) in items:
+        matches = sqlalchemy.sql.select([image_properties.c.image_id]).\
+                where(_property_matches(session, name, value)).\
+                limit(PROPERTY_FILTER_SELECTIVE_ROWS).\
+                alias()
+        counts.append(sqlalchemy.sql.select([sqlalchemy.func.count()]).\
+                select_from(matches).\
+                as_scalar())
+
+    row = session.execute(sqlalchemy.sql.select(counts)).fetchone()
+    return dict(item for (item, count) in zip(items, row)
+                if count < PROPERTY_FILTER_SELECTIVE_ROWS)
+
+
+def _image_ids_with_properties(session, properties):
+    """
+    Returns a select of the ids of the images which have all of the given
+    property values.
+
+    Rather than one EXISTS subquery per property, the matching property
+    rows are found together through the index on (name, value, image_id)
+    and grouped by image, keeping the images which matched every property.
+    """
+    image_properties = models.ImageProperty.__table__
+    criteria = [_property_matches(session, name, value)
+                for (name, value) in properties.items()]
+    matched = sqlalchemy.func.count(image_properties.c.name.distinct())
+    return sqlalchemy.sql.select([image_properties.c.image_id]).\
+            where(sqlalchemy.sql.or_(*criteria)).\
+            group_by(image_properties.c.image_id).\
+            having(matched == len(properties))
+
+
+def _filter_by_properties(session, query, properties):
+    """
+    Returns the query filtered to images with all of the given property
+    values.
+
+    Properties with selective values are looked up together, in one
+    grouped semi-join, which is cheap because few rows match them.
+    Properties with common values are left as EXISTS subqueries, which
+    are probed through the (image_id, name) unique index as images are
+    read in sort order and are cheap because most images match them.
+    """
+    selective = _selective_properties(session, properties)
+    if selective:
+        query = query.filter(models.Image.id.in_(
+                _image_ids_with_properties(session, selective)))
+
+    for (name, value) in properties.items():
+        if name not in selective:
+            query = query.filter(models.Image.properties.any(
+                    name=name, value=value, deleted=False))
+    return query
+
+
+def _supports_row_values(query):
+    """Return True if the query's database can compare row values."""
+    dialect = query.session.bind.dialect
+    if dialect.name == 'sqlite':
+        return dialect.dbapi.sqlite_version_info >= (3, 15, 0)
+    return dialect.name in ('mysql', 'postgresql')
+
+
 def image_get_all(context, filters=None, marker=None, limit=None,
                   sort_key='created_at', sort_dir='desc'):
     """
@@ -444,9 +828,10 @@ def image_get_all(context, filters=None, marker=None, limit=None,
     """
     filters = filters or {}
 
-    session = get_session()
-    query = session.query(models.Image).\
-            options(sqlalchemy.orm.joinedload(models.Image.properties))
+    # Find the ids of the page of images first, so that the properties
+    # joined in below don't multiply the rows sorted and skipped over
+    session = _get_read_session(context)
+    query = session.query(models.Image.id)
 
     if 'is_public' in filters and filters['is_public'] is not None:
         the_filter = [models.Image.is_public == filters['is_public']]
@@ -477,10 +862,9 @@ def image_get_all(context, filters=None, marker=None, limit=None,
         if not deleted_filter:
             query = query.filter(models.Image.status != 'killed')
 
-    for (k, v) in filters.pop('properties', {}).items():
-        query = query.filter(models.Image.properties.any(name=k,
-                                                         value=v,
-                                                         deleted=False))
+    properties = filters.pop('properties', {})
+    if properties:
+        query = _filter_by_properties(session, query, properties)
 
     for (k, v) in filters.items():
         if v is not None:
@@ -506,15 +890,32 @@ def image_get_all(context, filters=None, marker=None, limit=None,
 
     marker_image = None
     if marker is not None:
-        marker_image = image_get(context, marker,
-                                 force_show_deleted=showing_deleted)
+        # Only the marker's sort keys are needed, not its properties
+        marker_image = _image_get(context, marker, session=session,
+                                  force_show_deleted=showing_deleted,
+                                  load_properties=False)
+
+    sort_keys = [sort_key]
+    for key in ('created_at', 'id'):
+        if key not in sort_keys:
+            sort_keys.append(key)
 
-    query = paginate_query(query, models.Image, limit,
-                           [sort_key, 'created_at', 'id'],
+    query = paginate_query(query, models.Image, limit, sort_keys,
                            marker=marker_image,
                            sort_dir=sort_dir)
+    image_ids = [row.id for row in query.all()]
 
-    return query.all()
+    # Then load those images along with their properties
+    images = {}
+    for i in xrange(0, len(image_ids), IMAGE_LOAD_BATCH_SIZE):
+        batch = image_ids[i:i + IMAGE_LOAD_BATCH_SIZE]
+        query = session.query(models.Image).\
+                options(sqlalchemy.orm.joinedload(models.Image.properties)).\
+                filter(models.Image.id.in_(batch))
+        for image in query.all():
+            images[image.id] = image
+
+    return [images[image_id] for image_id in image_ids]
 
 
 def _drop_protected_attrs(model_class, values):
@@ -669,6 +1070,7 @@ def _image_update(context, values, image_id, purge_props=False):
         _set_properties_for_image(context, image_ref, properties, purge_props,
                                   session)
 
+    _record_write(context, image_ref.id)
     return image_get(context, image_ref.id)
 
 
@@ -723,6 +1125,7 @@ def _image_property_update(context, prop_ref, values, session=None):
     values["deleted"] = False
     prop_ref.update(values)
     prop_ref.save(session=session)
+    _record_write(context, prop_ref.image_id)
     return prop_ref
 
 
@@ -731,6 +1134,7 @@ def image_property_delete(context, prop_ref, session=None):
     Used internally by image_property_create and image_property_update
     """
     prop_ref.delete(session=session)
+    _record_write(context, prop_ref.image_id)
     return prop_ref
 
 
@@ -752,6 +1156,7 @@ def _image_member_update(context, memb_ref, values, session=None):
     values.setdefault('can_share', False)
     memb_ref.update(values)
     memb_ref.save(session=session)
+    _record_write(context, memb_ref.image_id)
     return memb_ref
 
 
@@ -759,6 +1164,7 @@ def image_member_delete(context, memb_ref, session=None):
     """Delete an ImageMember object"""
     session = session or get_session()
     memb_ref.delete(session=session)
+    _record_write(context, memb_ref.image_id)
     return memb_ref
 
 
@@ -768,7 +1174,10 @@ def image_member_find(context, image_id=None, member=None, session=None):
     :param image_id: identifier of image entity
     :param member: tenant to which membership has been granted
     """
-    session = session or get_session()
+    if image_id is not None:
+        session = session or _get_read_session(context, image_id)
+    else:
+        session = session or _get_read_session(context)
 
     # Note lack of permissions check; this function is called from
     # is_image_visible(), so avoid recursive calls
@@ -816,6 +1225,7 @@ def image_tag_create(context, image_id, value, session=None):
     session = session or get_session()
     tag_ref = models.ImageTag(image_id=image_id, value=value)
     tag_ref.save(session=session)
+    _record_write(context, image_id)
     return tag_ref['value']
 
 
@@ -832,13 +1242,34 @@ def image_tag_delete(context, image_id, value, session=None):
         raise exception.NotFound()
 
     tag_ref.delete(session=session)
+    _record_write(context, image_id)
 
 
 def image_tag_get_all(context, image_id, session=None):
     """Get a list of tags for a specific image."""
-    session = session or get_session()
+    session = session or _get_read_session(context, image_id)
     tags = session.query(models.ImageTag).\
                    filter_by(image_id=image_id).\
                    filter_by(deleted=False).\
                    all()
     return [tag['value'] for tag in tags]
+
+
+def image_tag_get_all_by_images(context, image_ids, session=None):
+    """
+    Get the tags of each of a list of images, without a query per image.
+
+    :returns: a dict of image id to the list of that image's tags
+    """
+    session = session or _get_read_session(context, *image_ids)
+    tags = dict((image_id, []) for image_id in image_ids)
+    for i in xrange(0, len(image_ids), IMAGE_LOAD_BATCH_SIZE):
+        batch = image_ids[i:i + IMAGE_LOAD_BATCH_SIZE]
+        query = session.query(models.ImageTag.image_id,
+                              models.ImageTag.value).\
+                        filter(models.ImageTag.image_id.in_(batch)).\
+                        filter_by(deleted=False).\
+                        order_by(models.ImageTag.id)
+        for (image_id, value) in query.all():
+            tags[image_id].append(value)
+    return tags
@@ -0,0 +1,50 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import schema
+
+
+def define_indexes(meta):
+    images = schema.Table('images', meta, autoload=True)
+
+    # Serve the default listing, newest first, as a range scan which
+    # stops after one page instead of sorting every undeleted image
+    created_at = schema.Index('ix_images_deleted_created_at_id',
+                              images.c.deleted,
+                              images.c.created_at,
+                              images.c.id)
+
+    # Serve changes-since listings, which include deleted images
+    updated_at = schema.Index('ix_images_updated_at_id',
+                              images.c.updated_at,
+                              images.c.id)
+
+    return [created_at, updated_at]
+
+
+def upgrade(migrate_engine):
+    meta = schema.MetaData()
+    meta.bind = migrate_engine
+    for index in define_indexes(meta):
+        index.create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    meta = schema.MetaData()
+    meta.bind = migrate_engine
+    for index in define_indexes(meta):
+        index.drop(migrate_engine)
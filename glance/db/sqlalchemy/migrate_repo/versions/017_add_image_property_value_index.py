@@ -0,0 +1,56 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import schema
+
+
+INDEX_NAME = 'ix_image_properties_name_value_image_id'
+
+# Number of leading characters of property values indexed by MySQL and
+# PostgreSQL, which can't index TEXT columns whole
+VALUE_PREFIX_LENGTH = 255
+
+
+def upgrade(migrate_engine):
+    meta = schema.MetaData()
+    meta.bind = migrate_engine
+    image_properties = schema.Table('image_properties', meta, autoload=True)
+
+    if migrate_engine.name == 'mysql':
+        migrate_engine.execute(
+            'CREATE INDEX %s ON image_properties (name, value(%d), image_id)'
+            % (INDEX_NAME, VALUE_PREFIX_LENGTH))
+    elif migrate_engine.name == 'postgresql':
+        migrate_engine.execute(
+            'CREATE INDEX %s ON image_properties '
+            '(name, substr(value, 1, %d), image_id)'
+            % (INDEX_NAME, VALUE_PREFIX_LENGTH))
+    else:
+        index = schema.Index(INDEX_NAME,
+                             image_properties.c.name,
+                             image_properties.c.value,
+                             image_properties.c.image_id)
+        index.create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    meta = schema.MetaData()
+    meta.bind = migrate_engine
+    image_properties = schema.Table('image_properties', meta, autoload=True)
+
+    index = schema.Index(INDEX_NAME, image_properties.c.name)
+    index.drop(migrate_engine)
@@ -34,6 +34,9 @@ image_cache_opts = [
     cfg.IntOpt('image_cache_max_size', default=10 * (1024 ** 3)),  # 10 GB
     cfg.IntOpt('image_cache_stall_time', default=86400),  # 24 hours
     cfg.StrOpt('image_cache_dir'),
+    cfg.BoolOpt('image_cache_metadata_sidecar', default=False),
+    cfg.IntOpt('image_cache_metadata_max_age', default=300),
+    cfg.StrOpt('image_cache_eviction_policy', default='lru'),
     ]
 
 CONF = cfg.CONF
@@ -155,36 +158,35 @@ class ImageCache(object):
         """
         self.driver.delete_queued_image(image_id)
 
-    def prune(self):
+    def prune(self, dry_run=False):
         """
-        Removes all cached image files above the cache's maximum
-        size. Returns a tuple containing the total number of cached
-        files removed and the total size of all pruned image files.
+        Removes cached image files, in the order set by the configured
+        eviction policy, until the cache is within its maximum size.
+        Returns a tuple containing the total number of cached files
+        removed and the total size of all pruned image files.
+
+        :param dry_run: If True, only report what would be pruned
         """
         max_size = CONF.image_cache_max_size
-        current_size = self.driver.get_cache_size()
-        if max_size > current_size:
+        policy = CONF.image_cache_eviction_policy
+        LOG.debug(_("Pruning image cache to max size of %(max_size)d "
+                    "using the %(policy)s policy") % locals())
+
+        pruned = self.driver.evict_until(max_size, policy=policy,
+                                         dry_run=dry_run)
+        if not pruned:
             LOG.debug(_("Image cache has free space, skipping prune..."))
             return (0, 0)
 
-        overage = current_size - max_size
-        LOG.debug(_("Image cache currently %(overage)d bytes over max "
-                    "size. Starting prune to max size of %(max_size)d ") %
-                     locals())
-
-        total_bytes_pruned = 0
-        total_files_pruned = 0
-        entry = self.driver.get_least_recently_accessed()
-        while entry and current_size > max_size:
-            image_id, size = entry
-            LOG.debug(_("Pruning '%(image_id)s' to free %(size)d bytes"),
-                      {'image_id': image_id, 'size': size})
-            self.driver.delete_cached_image(image_id)
-            total_bytes_pruned = total_bytes_pruned + size
-            total_files_pruned = total_files_pruned + 1
-            current_size = current_size - size
-            entry = self.driver.get_least_recently_accessed()
+        for image_id, size in pruned:
+            if dry_run:
+                msg = _("Would prune '%(image_id)s' to free %(size)d bytes")
+            else:
+                msg = _("Pruned '%(image_id)s' to free %(size)d bytes")
+            LOG.debug(msg, {'image_id': image_id, 'size': size})
 
+        total_files_pruned = len(pruned)
+        total_bytes_pruned = sum(size for image_id, size in pruned)
         LOG.debug(_("Pruning finished pruning. "
                     "Pruned %(total_files_pruned)d and "
                     "%(total_bytes_pruned)d.") % locals())
@@ -208,7 +210,8 @@ class ImageCache(object):
         """
         return self.driver.queue_image(image_id)
 
-    def get_caching_iter(self, image_id, image_checksum, image_iter):
+    def get_caching_iter(self, image_id, image_checksum, image_iter,
+                         image_meta=None):
         """
         Returns an iterator that caches the contents of an image
         while the image contents are read through the supplied
@@ -218,6 +221,8 @@ class ImageCache(object):
         :param image_checksum: checksum expected to be generated while
                                iterating over image data
         :param image_iter: Iterator that will read image contents
+        :param image_meta: Optional image metadata to store alongside the
+                           cached image file once it is complete
         """
         if not self.driver.is_cacheable(image_id):
             return image_iter
@@ -243,6 +248,9 @@ class ImageCache(object):
                             "of image %s." % image_id)
                     raise exception.GlanceException(msg)
 
+                if image_meta is not None:
+                    self.set_image_metadata(image_id, image_meta)
+
             except Exception:
                 LOG.exception(_("Exception encountered while tee'ing "
                                 "image '%s' into cache. Continuing "
@@ -307,6 +315,39 @@ class ImageCache(object):
         """
         return self.driver.get_image_size(image_id)
 
+    def get_image_metadata(self, image_id):
+        """
+        Return the image metadata stored alongside the cached image file
+        for an image with supplied identifier, or None if metadata
+        sidecars are disabled or there is no fresh record of it.
+
+        :param image_id: Image ID
+        """
+        if not CONF.image_cache_metadata_sidecar:
+            return None
+        return self.driver.get_image_metadata(
+                image_id, max_age=CONF.image_cache_metadata_max_age)
+
+    def set_image_metadata(self, image_id, image_meta):
+        """
+        Store image metadata alongside the cached image file for an
+        image with supplied identifier, if metadata sidecars are enabled.
+
+        :param image_id: Image ID
+        :param image_meta: Mapping of image metadata
+        """
+        if CONF.image_cache_metadata_sidecar:
+            self.driver.set_image_metadata(image_id, image_meta)
+
+    def delete_image_metadata(self, image_id):
+        """
+        Removes the metadata stored alongside the cached image file for an
+        image with supplied identifier, leaving the image file cached.
+
+        :param image_id: Image ID
+        """
+        self.driver.delete_image_metadata(image_id)
+
     def get_queued_images(self):
         """
         Returns a list of image IDs that are in the queue. The
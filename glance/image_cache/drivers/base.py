@@ -19,7 +19,11 @@
 Base attribute driver class
 """
 
+import json
+import os
 import os.path
+import tempfile
+import time
 
 from glance.common import exception
 from glance.common import utils
@@ -30,6 +34,27 @@ LOG = logging.getLogger(__name__)
 
 CONF = cfg.CONF
 
+# Orders in which cached images are evicted. Each maps a record about a
+# cached image, as returned by get_cached_images(), to a sort key, and
+# images are evicted lowest key first:
+#   lru  - least recently accessed first
+#   lfu  - fewest hits first, then least recently accessed
+#   gdsf - fewest hits per byte first, then least recently accessed. This
+#          is Greedy-Dual-Size-Frequency with a uniform cost, using
+#          recency in place of its aging term
+EVICTION_POLICIES = {
+    'lru': lambda image: image['last_accessed'],
+    'lfu': lambda image: (image['hits'], image['last_accessed']),
+    'gdsf': lambda image: (float(image['hits'] + 1) / max(image['size'], 1),
+                           image['last_accessed']),
+}
+
+
+def check_eviction_policy(policy):
+    if policy not in EVICTION_POLICIES:
+        msg = _("Unknown image cache eviction policy '%s'") % policy
+        raise exception.Invalid(msg)
+
 
 class Driver(object):
 
@@ -61,8 +86,10 @@ class Driver(object):
         self.incomplete_dir = os.path.join(self.base_dir, 'incomplete')
         self.invalid_dir = os.path.join(self.base_dir, 'invalid')
         self.queue_dir = os.path.join(self.base_dir, 'queue')
+        self.metadata_dir = os.path.join(self.base_dir, 'metadata')
 
-        dirs = [self.incomplete_dir, self.invalid_dir, self.queue_dir]
+        dirs = [self.incomplete_dir, self.invalid_dir, self.queue_dir,
+                self.metadata_dir]
 
         for path in dirs:
             utils.safe_mkdirs(path)
@@ -170,6 +197,34 @@ class Driver(object):
         """
         raise NotImplementedError
 
+    def evict_until(self, target_size, policy='lru', dry_run=False):
+        """
+        Removes cached images, in the order the eviction policy ranks them,
+        until the cache holds no more than `target_size` bytes. Returns a
+        list of (image_id, size) tuples for the images removed.
+
+        :param target_size: Size in bytes to shrink the cache to
+        :param policy: Name of one of the EVICTION_POLICIES
+        :param dry_run: If True, only report the images that would be
+                        removed
+        """
+        check_eviction_policy(policy)
+        current_size = self.get_cache_size()
+        victims = []
+        if current_size > target_size:
+            images = sorted(self.get_cached_images(),
+                            key=EVICTION_POLICIES[policy])
+            for image in images:
+                if current_size <= target_size:
+                    break
+                victims.append((image['image_id'], image['size']))
+                current_size -= image['size']
+
+        if not dry_run:
+            for image_id, size in victims:
+                self.delete_cached_image(image_id)
+        return victims
+
     def open_for_write(self, image_id):
         """
         Open a file for writing the image file for an image
@@ -216,3 +271,75 @@ class Driver(object):
         into the queue.
         """
         raise NotImplementedError
+
+    def get_metadata_filepath(self, image_id):
+        """
+        This crafts an absolute path to the metadata sidecar of an entry
+
+        :param image_id: Image ID
+        """
+        return os.path.join(self.metadata_dir, str(image_id))
+
+    def get_image_metadata(self, image_id, max_age=None):
+        """
+        Return the image metadata stored alongside the cached image file
+        for an image with supplied identifier, or None if there is no
+        usable record of it.
+
+        A record is unusable if it is older than `max_age` seconds or if
+        the size it records no longer matches the cached image file.
+
+        :param image_id: Image ID
+        :param max_age: Maximum age in seconds of the record
+        """
+        path = self.get_metadata_filepath(image_id)
+        try:
+            if max_age is not None:
+                if os.path.getmtime(path) < time.time() - max_age:
+                    return None
+            with open(path) as metadata_file:
+                image_meta = json.load(metadata_file)
+            if image_meta.get('size') != self.get_image_size(image_id):
+                return None
+        except (IOError, OSError, ValueError):
+            return None
+        return image_meta
+
+    def set_image_metadata(self, image_id, image_meta):
+        """
+        Store image metadata alongside the cached image file for an
+        image with supplied identifier. The record is written to a
+        temporary file of its own and renamed into place, so readers
+        never see a partial record, nor writers each other's.
+
+        :param image_id: Image ID
+        :param image_meta: Mapping of image metadata
+        """
+        path = self.get_metadata_filepath(image_id)
+        fd, tmp_path = tempfile.mkstemp(dir=self.metadata_dir,
+                                        prefix='.%s.' % image_id)
+        try:
+            with os.fdopen(fd, 'w') as metadata_file:
+                json.dump(image_meta, metadata_file)
+            os.rename(tmp_path, path)
+        except Exception:
+            utils.safe_remove(tmp_path)
+            raise
+
+    def delete_image_metadata(self, image_id):
+        """
+        Removes the metadata stored alongside the cached image file for an
+        image with supplied identifier, if there is any
+
+        :param image_id: Image ID
+        """
+        path = self.get_metadata_filepath(image_id)
+        if os.path.exists(path):
+            os.unlink(path)
+
+    def delete_all_image_metadata(self):
+        """
+        Removes the metadata stored alongside every cached image file
+        """
+        for fname in os.listdir(self.metadata_dir):
+            os.unlink(os.path.join(self.metadata_dir, fname))
@@ -25,7 +25,7 @@ import os
 import stat
 import time
 
-from eventlet import sleep, timeout
+from eventlet import semaphore, sleep, timeout
 import sqlite3
 
 from glance.common import exception
@@ -37,6 +37,7 @@ LOG = logging.getLogger(__name__)
 
 sqlite_opts = [
     cfg.StrOpt('image_cache_sqlite_db', default='cache.db'),
+    cfg.IntOpt('image_cache_sqlite_hit_flush_interval', default=5),
     ]
 
 CONF = cfg.CONF
@@ -44,6 +45,13 @@ CONF.register_opts(sqlite_opts)
 
 DEFAULT_SQL_CALL_TIMEOUT = 2
 
+# The ORDER BY clause implementing each of base.EVICTION_POLICIES
+EVICTION_ORDER = {
+    'lru': 'last_accessed',
+    'lfu': 'hits, last_accessed',
+    'gdsf': '(hits + 1.0) / MAX(size, 1), last_accessed',
+}
+
 
 class SqliteConnection(sqlite3.Connection):
 
@@ -71,6 +79,10 @@ class SqliteConnection(sqlite3.Connection):
         return self._timeout(lambda: sqlite3.Connection.execute(
                                         self, *args, **kwargs))
 
+    def executemany(self, *args, **kwargs):
+        return self._timeout(lambda: sqlite3.Connection.executemany(
+                                        self, *args, **kwargs))
+
     def commit(self):
         return self._timeout(lambda: sqlite3.Connection.commit(self))
 
@@ -96,6 +108,15 @@ class Driver(base.Driver):
         """
         super(Driver, self).configure()
 
+        # Each process keeps a single connection to the database, shared
+        # by its greenthreads one at a time, along with the hits it has
+        # yet to write to the database
+        self.db_lock = semaphore.Semaphore()
+        self.db_conn = None
+        self.db_pid = None
+        self.pending_hits = {}
+        self.last_hits_flush = time.time()
+
         # Create the SQLite database that will hold our cache attributes
         self.initialize_db()
 
@@ -105,6 +126,9 @@ class Driver(base.Driver):
         try:
             conn = sqlite3.connect(self.db_path, check_same_thread=False,
                                    factory=SqliteConnection)
+            # Write-ahead logging lets readers carry on while another
+            # process writes. The journal mode is stored in the database.
+            conn.execute('PRAGMA journal_mode = WAL')
             conn.executescript("""
                 CREATE TABLE IF NOT EXISTS cached_images (
                     image_id TEXT PRIMARY KEY,
@@ -129,8 +153,6 @@ class Driver(base.Driver):
         """
         sizes = []
         for path in self.get_cache_files(self.base_dir):
-            if path == self.db_path:
-                continue
             file_info = os.stat(path)
             sizes.append(file_info[stat.ST_SIZE])
         return sum(sizes)
@@ -144,6 +166,7 @@ class Driver(base.Driver):
         if not self.is_cached(image_id):
             return 0
 
+        self.flush_hits()
         hits = 0
         with self.get_db() as db:
             cur = db.execute("""SELECT hits FROM cached_images
@@ -157,6 +180,7 @@ class Driver(base.Driver):
         Returns a list of records about cached images.
         """
         LOG.debug(_("Gathering cached image entries."))
+        self.flush_hits()
         with self.get_db() as db:
             cur = db.execute("""SELECT
                              image_id, hits, last_accessed, last_modified, size
@@ -209,6 +233,7 @@ class Driver(base.Driver):
         Removes all cached image files and any attributes about the images
         """
         deleted = 0
+        self.delete_all_image_metadata()
         with self.get_db() as db:
             for path in self.get_cache_files(self.base_dir):
                 delete_cached_file(path)
@@ -225,6 +250,7 @@ class Driver(base.Driver):
         """
         path = self.get_image_filepath(image_id)
         with self.get_db() as db:
+            self.delete_image_metadata(image_id)
             delete_cached_file(path)
             db.execute("""DELETE FROM cached_images WHERE image_id = ?""",
                        (image_id, ))
@@ -269,6 +295,7 @@ class Driver(base.Driver):
         Return a tuple containing the image_id and size of the least recently
         accessed cached file, or None if no cached files.
         """
+        self.flush_hits()
         with self.get_db() as db:
             cur = db.execute("""SELECT image_id FROM cached_images
                              ORDER BY last_accessed LIMIT 1""")
@@ -278,6 +305,52 @@ class Driver(base.Driver):
         file_info = os.stat(path)
         return image_id, file_info[stat.ST_SIZE]
 
+    def evict_until(self, target_size, policy='lru', dry_run=False):
+        """
+        Removes cached images, in the order the eviction policy ranks them,
+        until the cache holds no more than `target_size` bytes. The images
+        to remove are chosen with a single ordered query and their records
+        removed in a single transaction, before their files, so a failed
+        write never leaves records of missing files behind. Returns a list
+        of (image_id, size) tuples for the images removed.
+
+        :param target_size: Size in bytes to shrink the cache to
+        :param policy: Name of one of the eviction policies
+        :param dry_run: If True, only report the images that would be
+                        removed
+        """
+        base.check_eviction_policy(policy)
+        current_size = self.get_cache_size()
+        victims = []
+        if current_size <= target_size:
+            return victims
+
+        self.flush_hits()
+
+        with self.get_db() as db:
+            cur = db.execute("""SELECT image_id, size FROM cached_images
+                             ORDER BY %s""" % EVICTION_ORDER[policy])
+            for image_id, size in cur:
+                if current_size <= target_size:
+                    break
+                victims.append((image_id, size))
+                current_size -= size
+            cur.close()
+
+            if dry_run or not victims:
+                return victims
+
+            db.executemany("""DELETE FROM cached_images
+                           WHERE image_id = ?""",
+                           [(image_id,) for image_id, size in victims])
+            db.commit()
+
+            for image_id, size in victims:
+                self.delete_image_metadata(image_id)
+                delete_cached_file(self.get_image_filepath(image_id))
+            return victims
+        return []
+
     @contextmanager
     def open_for_write(self, image_id):
         """
@@ -352,36 +425,97 @@ class Driver(base.Driver):
         path = self.get_image_filepath(image_id)
         with open(path, 'rb') as cache_file:
             yield cache_file
+        self.record_hit(image_id)
+
+    def _check_pid(self):
+        # Neither the connection nor the pending hits of a parent process
+        # belong to a forked child
+        if self.db_pid != os.getpid():
+            self.db_conn = None
+            self.db_pid = os.getpid()
+            self.pending_hits = {}
+
+    def record_hit(self, image_id):
+        """
+        Counts a hit on a cached image. Hits are kept in memory and written
+        to the database in batches, at most every
+        image_cache_sqlite_hit_flush_interval seconds, which keeps a write
+        transaction off the path of every cache hit.
+
+        :param image_id: Image ID
+        """
+        self._check_pid()
         now = time.time()
-        with self.get_db() as db:
-            db.execute("""UPDATE cached_images
-                       SET hits = hits + 1, last_accessed = ?
-                       WHERE image_id = ?""",
-                       (now, image_id))
-            db.commit()
+        hits, last_accessed = self.pending_hits.get(image_id, (0, 0))
+        self.pending_hits[image_id] = (hits + 1, now)
 
-    @contextmanager
-    def get_db(self):
+        interval = CONF.image_cache_sqlite_hit_flush_interval
+        if now - self.last_hits_flush >= interval:
+            self.flush_hits()
+
+    def flush_hits(self):
+        """
+        Writes the hits counted since the last flush to the database, in a
+        single transaction. Hits which could not be written are kept for
+        the next flush.
         """
-        Returns a context manager that produces a database connection that
-        self-closes and calls rollback if an error occurs while using the
-        database connection
-        """
-        conn = sqlite3.connect(self.db_path, check_same_thread=False,
-                               factory=SqliteConnection)
-        conn.row_factory = sqlite3.Row
-        conn.text_factory = str
-        conn.execute('PRAGMA synchronous = NORMAL')
-        conn.execute('PRAGMA count_changes = OFF')
-        conn.execute('PRAGMA temp_store = MEMORY')
+        self._check_pid()
+        pending_hits, self.pending_hits = self.pending_hits, {}
+        self.last_hits_flush = time.time()
+        if not pending_hits:
+            return
+
+        flushed = False
         try:
-            yield conn
-        except sqlite3.DatabaseError, e:
-            msg = _("Error executing SQLite call. Got error: %s") % e
-            LOG.error(msg)
-            conn.rollback()
+            with self.get_db() as db:
+                db.executemany("""UPDATE cached_images
+                               SET hits = hits + ?, last_accessed = ?
+                               WHERE image_id = ?""",
+                               [(hits, last_accessed, image_id)
+                                for image_id, (hits, last_accessed)
+                                in pending_hits.iteritems()])
+                db.commit()
+                flushed = True
         finally:
-            conn.close()
+            if not flushed:
+                for image_id, (hits, accessed) in pending_hits.iteritems():
+                    more_hits, last_accessed = self.pending_hits.get(
+                        image_id, (0, 0))
+                    self.pending_hits[image_id] = (
+                        hits + more_hits, max(accessed, last_accessed))
+
+    def _get_connection(self):
+        self._check_pid()
+        if self.db_conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                                   factory=SqliteConnection)
+            conn.row_factory = sqlite3.Row
+            conn.text_factory = str
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            conn.execute('PRAGMA count_changes = OFF')
+            conn.execute('PRAGMA temp_store = MEMORY')
+            self.db_conn = conn
+        return self.db_conn
+
+    @contextmanager
+    def get_db(self):
+        """
+        Returns a context manager that produces this process's database
+        connection, held exclusively for the duration, and calls rollback
+        if an error occurs while using the database connection.
+
+        The connection stays open between uses, so the schema is read and
+        statements are prepared only once per process.
+        """
+        with self.db_lock:
+            conn = self._get_connection()
+            try:
+                yield conn
+            except sqlite3.DatabaseError, e:
+                msg = _("Error executing SQLite call. Got error: %s") % e
+                LOG.error(msg)
+                conn.rollback()
 
     def queue_image(self, image_id):
         """
@@ -457,9 +591,11 @@ class Driver(base.Driver):
 
         :param basepath: Directory to look in for cache files
         """
+        db_files = (self.db_path, self.db_path + '-wal',
+                    self.db_path + '-shm')
         for fname in os.listdir(basepath):
             path = os.path.join(basepath, fname)
-            if path != self.db_path and os.path.isfile(path):
+            if path not in db_files and os.path.isfile(path):
                 yield path
 
 
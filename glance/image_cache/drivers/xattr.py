@@ -51,12 +51,20 @@ $image_cache_dir/
   incomplete/
   invalid/
   queue/
+  index/
+
+The index directory holds a journal of the images added to, read from and
+removed from the cache. Every process sharing the cache directory replays
+it to know the size of the cache and which image was least recently
+accessed, without walking and stat'ing every cached file.
 """
 
 from __future__ import absolute_import
 from contextlib import contextmanager
 import datetime
 import errno
+import fcntl
+import heapq
 import os
 import stat
 import time
@@ -64,6 +72,7 @@ import time
 import xattr
 
 from glance.common import exception
+from glance.common import utils
 from glance.image_cache.drivers import base
 from glance.openstack.common import cfg
 import glance.openstack.common.log as logging
@@ -73,6 +82,192 @@ LOG = logging.getLogger(__name__)
 
 CONF = cfg.CONF
 
+# The journal is rewritten once it holds this many times more records than
+# there are images in the cache, plus the slack below
+JOURNAL_COMPACT_RATIO = 4
+JOURNAL_COMPACT_SLACK = 1000
+
+
+class CacheIndex(object):
+
+    """
+    Index of the cached images, their sizes and the time each was last
+    accessed, persisted as an append-only journal.
+
+    Records are appended under a shared lock, so any number of processes
+    may write at once. Each process replays only the records it has not
+    seen yet, which keeps the total size available in constant time and
+    the least recently accessed image at the top of a heap. The journal
+    is periodically compacted to a snapshot under an exclusive lock.
+    """
+
+    def __init__(self, index_dir, scan):
+        """
+        :param index_dir: Directory holding the journal
+        :param scan: Callable returning (image_id, size, last_accessed)
+                     for every cached image, used to build the journal
+                     when there is none
+        """
+        self.journal_path = os.path.join(index_dir, 'journal')
+        self.lock_path = os.path.join(index_dir, 'lock')
+        self.scan = scan
+        self._reset()
+
+    def _reset(self):
+        self.entries = {}
+        self.heap = []
+        self.total_size = 0
+        self.records = 0
+        self.offset = 0
+        self.inode = None
+
+    @contextmanager
+    def _lock(self, operation):
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), operation)
+            yield
+        finally:
+            lock_file.close()
+
+    def _append(self, record):
+        if not os.path.exists(self.journal_path):
+            self._build()
+        with self._lock(fcntl.LOCK_SH):
+            fd = os.open(self.journal_path,
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+            try:
+                os.write(fd, record)
+            finally:
+                os.close(fd)
+
+    def _apply(self, record):
+        fields = record.split(' ')
+        op = fields[0]
+        if op == 'C':
+            self.entries = {}
+            self.heap = []
+            self.total_size = 0
+            self.records += 1
+            return
+
+        image_id = fields[1]
+        if op == 'A':
+            self._discard(image_id)
+            size, last_accessed = int(fields[2]), float(fields[3])
+            self.entries[image_id] = [size, last_accessed]
+            self.total_size += size
+            heapq.heappush(self.heap, (last_accessed, image_id))
+        elif op == 'R' and image_id in self.entries:
+            last_accessed = float(fields[2])
+            self.entries[image_id][1] = last_accessed
+            heapq.heappush(self.heap, (last_accessed, image_id))
+        elif op == 'D':
+            self._discard(image_id)
+        self.records += 1
+
+    def _discard(self, image_id):
+        # Heap entries for the image are dropped lazily, once they surface
+        entry = self.entries.pop(image_id, None)
+        if entry is not None:
+            self.total_size -= entry[0]
+
+    def _write_snapshot(self, entries):
+        tmp_path = self.journal_path + '.tmp'
+        with open(tmp_path, 'w') as snapshot:
+            for image_id, size, last_accessed in entries:
+                snapshot.write('A %s %d %f\n' % (image_id, size,
+                                                  last_accessed))
+        os.rename(tmp_path, self.journal_path)
+
+    def _build(self):
+        with self._lock(fcntl.LOCK_EX):
+            if not os.path.exists(self.journal_path):
+                LOG.info(_("Building image cache index"))
+                self._write_snapshot(self.scan())
+
+    def _replay(self):
+        with open(self.journal_path) as journal:
+            inode = os.fstat(journal.fileno()).st_ino
+            if inode != self.inode:
+                # The journal was compacted, so start from its snapshot
+                self._reset()
+                self.inode = inode
+            journal.seek(self.offset)
+            data = journal.read()
+
+        # Leave any partly written record for the next replay
+        end = data.rfind('\n') + 1
+        for record in data[:end].splitlines():
+            self._apply(record)
+        self.offset += end
+
+    def refresh(self):
+        """
+        Replays any records appended to the journal since the last refresh
+        """
+        if not os.path.exists(self.journal_path):
+            self._build()
+        self._replay()
+
+        if self.records > (JOURNAL_COMPACT_RATIO * len(self.entries) +
+                           JOURNAL_COMPACT_SLACK):
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrites the journal as a snapshot of the images it indexes
+        """
+        with self._lock(fcntl.LOCK_EX):
+            self._replay()
+            self._write_snapshot([(image_id, size, last_accessed)
+                                  for image_id, (size, last_accessed)
+                                  in self.entries.iteritems()])
+        self._reset()
+        self._replay()
+
+    def add(self, image_id, size):
+        self._append('A %s %d %f\n' % (image_id, size, time.time()))
+
+    def access(self, image_id):
+        self._append('R %s %f\n' % (image_id, time.time()))
+
+    def remove(self, image_id):
+        self._append('D %s\n' % image_id)
+
+    def clear(self):
+        self._append('C\n')
+
+    def get_total_size(self):
+        self.refresh()
+        return self.total_size
+
+    def iter_least_recently_accessed(self):
+        """
+        Yields (image_id, size) for each indexed image, least recently
+        accessed first
+        """
+        self.refresh()
+        heap = list(self.heap)
+        seen = set()
+        while heap:
+            last_accessed, image_id = heapq.heappop(heap)
+            entry = self.entries.get(image_id)
+            if (entry is not None and entry[1] == last_accessed and
+                    image_id not in seen):
+                seen.add(image_id)
+                yield image_id, entry[0]
+
+    def get_least_recently_accessed(self):
+        self.refresh()
+        while self.heap:
+            last_accessed, image_id = self.heap[0]
+            entry = self.entries.get(image_id)
+            if entry is not None and entry[1] == last_accessed:
+                return image_id, entry[0]
+            heapq.heappop(self.heap)
+        return None
+
 
 class Driver(base.Driver):
 
@@ -117,15 +312,25 @@ class Driver(base.Driver):
             if os.path.exists(fake_image_filepath):
                 os.unlink(fake_image_filepath)
 
-    def get_cache_size(self):
+        index_dir = os.path.join(self.base_dir, 'index')
+        utils.safe_mkdirs(index_dir)
+        self.index = CacheIndex(index_dir, self._scan_cached_images)
+
+    def _scan_cached_images(self):
         """
-        Returns the total size in bytes of the image cache.
+        Returns (image_id, size, last_accessed) for every cached image,
+        taken from the files themselves
         """
-        sizes = []
         for path in get_all_regular_files(self.base_dir):
             file_info = os.stat(path)
-            sizes.append(file_info[stat.ST_SIZE])
-        return sum(sizes)
+            yield (os.path.basename(path), file_info[stat.ST_SIZE],
+                   file_info[stat.ST_ATIME])
+
+    def get_cache_size(self):
+        """
+        Returns the total size in bytes of the image cache.
+        """
+        return self.index.get_total_size()
 
     def get_hit_count(self, image_id):
         """
@@ -205,9 +410,11 @@ class Driver(base.Driver):
         Removes all cached image files and any attributes about the images
         """
         deleted = 0
+        self.delete_all_image_metadata()
         for path in get_all_regular_files(self.base_dir):
             delete_cached_file(path)
             deleted += 1
+        self.index.clear()
         return deleted
 
     def delete_cached_image(self, image_id):
@@ -217,7 +424,9 @@ class Driver(base.Driver):
         :param image_id: Image ID
         """
         path = self.get_image_filepath(image_id)
+        self.delete_image_metadata(image_id)
         delete_cached_file(path)
+        self.index.remove(image_id)
 
     def delete_all_queued_images(self):
         """
@@ -243,18 +452,37 @@ class Driver(base.Driver):
         Return a tuple containing the image_id and size of the least recently
         accessed cached file, or None if no cached files.
         """
-        stats = []
-        for path in get_all_regular_files(self.base_dir):
-            file_info = os.stat(path)
-            stats.append((file_info[stat.ST_ATIME],  # access time
-                          file_info[stat.ST_SIZE],   # size in bytes
-                          path))                     # absolute path
+        return self.index.get_least_recently_accessed()
+
+    def evict_until(self, target_size, policy='lru', dry_run=False):
+        """
+        Removes cached images, in the order the eviction policy ranks them,
+        until the cache holds no more than `target_size` bytes. LRU
+        eviction is answered from the index without touching the cached
+        files. Returns a list of (image_id, size) tuples for the images
+        removed.
+
+        :param target_size: Size in bytes to shrink the cache to
+        :param policy: Name of one of the eviction policies
+        :param dry_run: If True, only report the images that would be
+                        removed
+        """
+        if policy != 'lru':
+            return super(Driver, self).evict_until(target_size, policy,
+                                                   dry_run)
 
-        if not stats:
-            return None
+        current_size = self.index.get_total_size()
+        victims = []
+        for image_id, size in self.index.iter_least_recently_accessed():
+            if current_size <= target_size:
+                break
+            victims.append((image_id, size))
+            current_size -= size
 
-        stats.sort()
-        return os.path.basename(stats[0][2]), stats[0][1]
+        if not dry_run:
+            for image_id, size in victims:
+                self.delete_cached_image(image_id)
+        return victims
 
     @contextmanager
     def open_for_write(self, image_id):
@@ -278,6 +506,7 @@ class Driver(base.Driver):
                          dict(incomplete_path=incomplete_path,
                               final_path=final_path))
             os.rename(incomplete_path, final_path)
+            self.index.add(image_id, os.path.getsize(final_path))
 
             # Make sure that we "pop" the image from the queue...
             if self.is_queued(image_id):
@@ -324,6 +553,7 @@ class Driver(base.Driver):
             yield cache_file
         path = self.get_image_filepath(image_id)
         inc_xattr(path, 'hits', 1)
+        self.index.access(image_id)
 
     def queue_image(self, image_id):
         """
@@ -20,9 +20,23 @@ Prunes the Image Cache
 """
 
 from glance.image_cache import base
+from glance.openstack.common import cfg
+import glance.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+dry_run_opt = cfg.BoolOpt('dry_run', default=False,
+                          help='Report what would be pruned, without '
+                               'removing anything from the cache')
+
+CONF = cfg.CONF
+CONF.register_cli_opt(dry_run_opt)
 
 
 class Pruner(base.CacheApp):
 
     def run(self):
-        self.cache.prune()
+        files, size = self.cache.prune(dry_run=CONF.dry_run)
+        if CONF.dry_run:
+            LOG.info(_("Pruning would remove %(files)d cached images "
+                       "and free %(size)d bytes") % locals())
@@ -19,11 +19,14 @@
 Registry API
 """
 
+import contextlib
 import os
 
+from glance.common import client as base_client
 from glance.common import exception
 from glance.openstack.common import cfg
 import glance.openstack.common.log as logging
+from glance.registry import cache
 from glance.registry import client
 
 LOG = logging.getLogger(__name__)
@@ -38,6 +41,11 @@ registry_client_opts = [
     cfg.StrOpt('registry_client_cert_file'),
     cfg.StrOpt('registry_client_ca_file'),
     cfg.StrOpt('metadata_encryption_key'),
+    cfg.IntOpt('registry_client_pool_size', default=10),
+    cfg.IntOpt('registry_client_pool_max_idle_time', default=60),
+    cfg.IntOpt('registry_client_pool_max_connections', default=0),
+    cfg.IntOpt('registry_metadata_cache_size', default=0),
+    cfg.IntOpt('registry_metadata_cache_ttl', default=5),
     ]
 registry_client_ctx_opts = [
     cfg.StrOpt('admin_user'),
@@ -57,6 +65,8 @@ _CLIENT_CREDS = None
 _CLIENT_HOST = None
 _CLIENT_PORT = None
 _CLIENT_KWARGS = {}
+_CONNECTION_POOL = None
+_METADATA_CACHE = None
 # AES key used to encrypt 'location' metadata
 _METADATA_ENCRYPTION_KEY = None
 
@@ -66,6 +76,7 @@ def configure_registry_client():
     Sets up a registry client for use in registry lookups
     """
     global _CLIENT_KWARGS, _CLIENT_HOST, _CLIENT_PORT, _METADATA_ENCRYPTION_KEY
+    global _CONNECTION_POOL, _METADATA_CACHE
     try:
         host, port = CONF.registry_host, CONF.registry_port
     except cfg.ConfigFileValueError:
@@ -87,6 +98,17 @@ def configure_registry_client():
         'ca_file': CONF.registry_client_ca_file
         }
 
+    # Connections are pooled per process. Pools are created lazily, once
+    # a worker handles its first request, so that forked workers never
+    # share sockets.
+    _CONNECTION_POOL = None
+
+    _METADATA_CACHE = None
+    if CONF.registry_metadata_cache_size > 0:
+        _METADATA_CACHE = cache.MetadataCache(
+            CONF.registry_metadata_cache_size,
+            CONF.registry_metadata_cache_ttl)
+
 
 def configure_registry_admin_creds():
     global _CLIENT_CREDS
@@ -107,11 +129,62 @@ def configure_registry_admin_creds():
     }
 
 
+def get_connection_pool():
+    """
+    Returns this process's pool of connections to the registry, or None
+    if connection pooling is disabled
+    """
+    global _CONNECTION_POOL
+    if _CONNECTION_POOL is None and CONF.registry_client_pool_size > 0:
+        _CONNECTION_POOL = base_client.ConnectionPool(
+            max_size=CONF.registry_client_pool_size,
+            max_idle_time=CONF.registry_client_pool_max_idle_time,
+            max_connections=CONF.registry_client_pool_max_connections)
+    return _CONNECTION_POOL
+
+
+def get_connection_pool_stats():
+    """
+    Returns the hit rate and wait time statistics of this process's pool
+    of connections to the registry
+    """
+    pool = get_connection_pool()
+    return pool.get_stats() if pool else {}
+
+
+def get_metadata_cache_stats():
+    """
+    Returns the hit and miss counters of this process's image metadata
+    cache
+    """
+    return _METADATA_CACHE.get_stats() if _METADATA_CACHE else {}
+
+
+def _invalidate_metadata(image_id):
+    if _METADATA_CACHE is not None:
+        _METADATA_CACHE.invalidate(image_id)
+
+
+@contextlib.contextmanager
+def _writing_metadata(image_id):
+    """
+    Drops an image's cached metadata before a write to the registry and
+    again once the write is over, since a read which races the write can
+    cache the old metadata again
+    """
+    _invalidate_metadata(image_id)
+    try:
+        yield
+    finally:
+        _invalidate_metadata(image_id)
+
+
 def get_registry_client(cxt):
     global _CLIENT_CREDS, _CLIENT_KWARGS, _CLIENT_HOST, _CLIENT_PORT
     global _METADATA_ENCRYPTION_KEY
     kwargs = _CLIENT_KWARGS.copy()
     kwargs['auth_tok'] = cxt.auth_tok
+    kwargs['connection_pool'] = get_connection_pool()
     if _CLIENT_CREDS:
         kwargs['creds'] = _CLIENT_CREDS
     return client.RegistryClient(_CLIENT_HOST, _CLIENT_PORT,
@@ -129,8 +202,17 @@ def get_images_detail(context, **kwargs):
 
 
 def get_image_metadata(context, image_id):
+    if _METADATA_CACHE is not None:
+        image_meta = _METADATA_CACHE.get(context, image_id)
+        if image_meta is not None:
+            return image_meta
+
     c = get_registry_client(context)
-    return c.get_image(image_id)
+    image_meta = c.get_image(image_id)
+
+    if _METADATA_CACHE is not None:
+        _METADATA_CACHE.set(context, image_id, image_meta)
+    return image_meta
 
 
 def add_image_metadata(context, image_meta):
@@ -142,14 +224,16 @@ def add_image_metadata(context, image_meta):
 def update_image_metadata(context, image_id, image_meta,
                           purge_props=False):
     LOG.debug(_("Updating image metadata for image %s..."), image_id)
-    c = get_registry_client(context)
-    return c.update_image(image_id, image_meta, purge_props)
+    with _writing_metadata(image_id):
+        c = get_registry_client(context)
+        return c.update_image(image_id, image_meta, purge_props)
 
 
 def delete_image_metadata(context, image_id):
     LOG.debug(_("Deleting image metadata for image %s..."), image_id)
-    c = get_registry_client(context)
-    return c.delete_image(image_id)
+    with _writing_metadata(image_id):
+        c = get_registry_client(context)
+        return c.delete_image(image_id)
 
 
 def get_image_members(context, image_id):
@@ -163,15 +247,18 @@ def get_member_images(context, member_id):
 
 
 def replace_members(context, image_id, member_data):
-    c = get_registry_client(context)
-    return c.replace_members(image_id, member_data)
+    with _writing_metadata(image_id):
+        c = get_registry_client(context)
+        return c.replace_members(image_id, member_data)
 
 
 def add_member(context, image_id, member_id, can_share=None):
-    c = get_registry_client(context)
-    return c.add_member(image_id, member_id, can_share=can_share)
+    with _writing_metadata(image_id):
+        c = get_registry_client(context)
+        return c.add_member(image_id, member_id, can_share=can_share)
 
 
 def delete_member(context, image_id, member_id):
-    c = get_registry_client(context)
-    return c.delete_member(image_id, member_id)
+    with _writing_metadata(image_id):
+        c = get_registry_client(context)
+        return c.delete_member(image_id, member_id)
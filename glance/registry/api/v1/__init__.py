@@ -20,6 +20,7 @@ import routes
 from glance.common import wsgi
 from glance.registry.api.v1 import images
 from glance.registry.api.v1 import members
+from glance.registry.api.v1 import stats
 
 
 class API(wsgi.Router):
@@ -44,4 +45,8 @@ class API(wsgi.Router):
                        controller=members_resource,
                        action="index_shared_images")
 
+        stats_resource = stats.create_resource()
+        mapper.connect("/stats", controller=stats_resource, action="index",
+                       conditions=dict(method=["GET"]))
+
         super(API, self).__init__(mapper)
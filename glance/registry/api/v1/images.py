@@ -19,6 +19,8 @@
 Reference implementation registry server WSGI controller
 """
 
+import datetime
+
 from webob import exc
 
 from glance.common import exception
@@ -49,6 +51,18 @@ SUPPORTED_SORT_DIRS = ('asc', 'desc')
 
 SUPPORTED_PARAMS = ('limit', 'marker', 'sort_key', 'sort_dir')
 
+# The image attributes returned by the registry, worked out once rather
+# than for every image serialized
+IMAGE_ATTRS = tuple(sorted(glance.db.IMAGE_ATTRS))
+
+# Image attributes which are formatted as ISO 8601 strings as each image's
+# dict is made, so that the response serializer needn't call back into
+# Python for every one of them
+DATETIME_ATTRS = ('created_at', 'updated_at', 'deleted_at')
+
+# The image property attributes read when serializing an image
+PROPERTY_ATTRS = ('name', 'value', 'deleted')
+
 
 class Controller(object):
 
@@ -91,10 +105,7 @@ class Controller(object):
 
         results = []
         for image in images:
-            result = {}
-            for field in DISPLAY_FIELDS_IN_INDEX:
-                result[field] = image[field]
-            results.append(result)
+            results.append(_loaded_attrs(image, DISPLAY_FIELDS_IN_INDEX))
         return dict(images=results)
 
     def detail(self, req):
@@ -112,7 +123,9 @@ class Controller(object):
         params = self._get_query_params(req)
 
         images = self._get_images(req.context, **params)
-        image_dicts = [make_image_dict(i) for i in images]
+        # Each image's dict is made as it is serialized, rather than all
+        # of them up front
+        image_dicts = (make_image_dict(i) for i in images)
         return dict(images=image_dicts)
 
     def _get_query_params(self, req):
@@ -403,30 +416,60 @@ class Controller(object):
                                content_type='text/plain')
 
 
+def _loaded_attrs(obj, attrs):
+    """
+    Returns the named attributes of a database model as a dict, read from
+    its loaded state without going through the model's instrumented
+    attributes. Mapped columns which are not loaded, having been expired
+    or deferred, are read through the model, which loads them. Drivers
+    which return plain dicts have the named keys they hold returned.
+    """
+    loaded = getattr(obj, '__dict__', None)
+    if loaded is None:
+        return dict((a, obj[a]) for a in attrs if a in obj)
+
+    values = {}
+    for a in attrs:
+        if a in loaded:
+            values[a] = loaded[a]
+        elif a in obj.__table__.columns:
+            values[a] = getattr(obj, a)
+    return values
+
+
 def make_image_dict(image):
     """
     Create a dict representation of an image which we can use to
     serialize the image.
     """
-
-    def _fetch_attrs(d, attrs):
-        return dict([(a, d[a]) for a in attrs
-                    if a in d.keys()])
+    image_dict = _loaded_attrs(image, IMAGE_ATTRS)
+    for a in DATETIME_ATTRS:
+        value = image_dict.get(a)
+        if isinstance(value, datetime.datetime):
+            image_dict[a] = value.isoformat()
 
     # TODO(sirp): should this be a dict, or a list of dicts?
     # A plain dict is more convenient, but list of dicts would provide
     # access to created_at, etc
-    properties = dict((p['name'], p['value'])
-                      for p in image['properties'] if not p['deleted'])
-
-    image_dict = _fetch_attrs(image, glance.db.IMAGE_ATTRS)
+    properties = {}
+    for prop in image['properties']:
+        prop = _loaded_attrs(prop, PROPERTY_ATTRS)
+        if not prop['deleted']:
+            properties[prop['name']] = prop['value']
 
     image_dict['properties'] = properties
     return image_dict
 
 
+class ImageSerializer(wsgi.JSONResponseSerializer):
+    """Streams detailed image listings, which can be large."""
+
+    def detail(self, response, result):
+        self.stream(response, result, 'images')
+
+
 def create_resource():
     """Images resource factory method."""
     deserializer = wsgi.JSONRequestDeserializer()
-    serializer = wsgi.JSONResponseSerializer()
+    serializer = ImageSerializer()
     return wsgi.Resource(Controller(), deserializer, serializer)
@@ -0,0 +1,47 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import webob.exc
+
+from glance.common import wsgi
+import glance.db
+
+
+class Controller(object):
+
+    def __init__(self):
+        self.db_api = glance.db.get_api()
+        self.db_api.configure_db()
+
+    def index(self, req):
+        """
+        Returns the statistics of the registry's database connection
+        pools, as gathered by the database driver, if it gathers any.
+        Only admins may see them.
+        """
+        if not req.context.is_admin:
+            raise webob.exc.HTTPForbidden()
+
+        get_pool_stats = getattr(self.db_api, 'get_pool_stats', None)
+        db_pools = get_pool_stats() if get_pool_stats else {}
+        return dict(db_pools=db_pools)
+
+
+def create_resource():
+    """Registry statistics resource factory method."""
+    serializer = wsgi.JSONResponseSerializer()
+    return wsgi.Resource(Controller(), serializer=serializer)
@@ -0,0 +1,144 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack, LLC
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+In-process read-through cache of image metadata fetched from the registry
+"""
+
+import copy
+import time
+
+
+class MetadataCache(object):
+
+    """
+    A size-bounded LRU cache of image metadata with a time-to-live.
+
+    Entries are keyed by image id and by the parts of the request context
+    that decide which images are visible, so one tenant is never served
+    metadata that was fetched on behalf of another. Only metadata for
+    `active` images is stored, since any other status is about to change.
+    """
+
+    def __init__(self, max_size, ttl):
+        """
+        :param max_size: Maximum number of entries to hold
+        :param ttl: Number of seconds an entry may be served for
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = {}
+        self.image_keys = {}
+        # Sentinel of a circular doubly linked list, in order of use.
+        # Each link is [prev, next, key].
+        self.root = []
+        self.root[:] = [self.root, self.root, None]
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'invalidations': 0,
+        }
+
+    @staticmethod
+    def _key(context, image_id):
+        return (image_id, context.is_admin, context.owner)
+
+    def _unlink(self, link):
+        prev, next, _key = link
+        prev[1] = next
+        next[0] = prev
+
+    def _link_most_recent(self, link):
+        last = self.root[0]
+        link[0] = last
+        link[1] = self.root
+        last[1] = self.root[0] = link
+
+    def _remove(self, key):
+        link, _expires, _image_meta = self.entries.pop(key)
+        self._unlink(link)
+        image_id = key[0]
+        keys = self.image_keys.get(image_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.image_keys[image_id]
+
+    def get(self, context, image_id):
+        """
+        Returns a copy of the cached metadata for the image as seen by
+        `context`, or None if there is no fresh entry for it
+        """
+        key = self._key(context, image_id)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.stats['misses'] += 1
+            return None
+
+        link, expires, image_meta = entry
+        if expires < time.time():
+            self._remove(key)
+            self.stats['misses'] += 1
+            return None
+
+        self._unlink(link)
+        self._link_most_recent(link)
+        self.stats['hits'] += 1
+        return copy.deepcopy(image_meta)
+
+    def set(self, context, image_id, image_meta):
+        """
+        Stores the metadata for the image as seen by `context`, if the
+        image is active
+        """
+        if image_meta.get('status') != 'active':
+            return
+
+        key = self._key(context, image_id)
+        if key in self.entries:
+            self._remove(key)
+
+        while len(self.entries) >= self.max_size:
+            self._remove(self.root[1][2])
+            self.stats['evictions'] += 1
+
+        link = [None, None, key]
+        self._link_most_recent(link)
+        self.entries[key] = (link, time.time() + self.ttl,
+                             copy.deepcopy(image_meta))
+        self.image_keys.setdefault(image_id, set()).add(key)
+
+    def invalidate(self, image_id):
+        """
+        Drops every cached entry for the image, whichever context it was
+        fetched for
+        """
+        for key in list(self.image_keys.get(image_id, [])):
+            self._remove(key)
+            self.stats['invalidations'] += 1
+
+    def get_stats(self):
+        """
+        Returns the cache's counters, along with its hit rate and size
+        """
+        stats = self.stats.copy()
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = (float(stats['hits']) / lookups
+                             if lookups else 0.0)
+        stats['size'] = len(self.entries)
+        return stats
@@ -24,6 +24,7 @@ import json
 
 from glance.common.client import BaseClient
 from glance.common import crypt
+from glance.common import utils
 import glance.openstack.common.log as logging
 from glance.registry.api.v1 import images
 
@@ -50,8 +51,7 @@ class RegistryClient(BaseClient):
 
     def decrypt_metadata(self, image_metadata):
         if (self.metadata_encryption_key is not None
-            and 'location' in image_metadata.keys()
-            and image_metadata['location'] is not None):
+            and image_metadata.get('location') is not None):
             location = crypt.urlsafe_decrypt(self.metadata_encryption_key,
                                              image_metadata['location'])
             image_metadata['location'] = location
@@ -59,8 +59,7 @@ class RegistryClient(BaseClient):
 
     def encrypt_metadata(self, image_metadata):
         if (self.metadata_encryption_key is not None
-            and 'location' in image_metadata.keys()
-            and image_metadata['location'] is not None):
+            and image_metadata.get('location') is not None):
             location = crypt.urlsafe_encrypt(self.metadata_encryption_key,
                                              image_metadata['location'], 64)
             image_metadata['location'] = location
@@ -78,7 +77,7 @@ class RegistryClient(BaseClient):
         """
         params = self._extract_params(kwargs, images.SUPPORTED_PARAMS)
         res = self.do_request("GET", "/images", params=params)
-        image_list = json.loads(res.read())['images']
+        image_list = utils.json_loads(res.read())['images']
         for image in image_list:
             image = self.decrypt_metadata(image)
         return image_list
@@ -111,7 +110,7 @@ class RegistryClient(BaseClient):
         """
         params = self._extract_params(kwargs, images.SUPPORTED_PARAMS)
         res = self.do_request("GET", "/images/detail", params=params)
-        image_list = json.loads(res.read())['images']
+        image_list = utils.json_loads(res.read())['images']
         for image in image_list:
             image = self.decrypt_metadata(image)
         return image_list
@@ -119,7 +118,7 @@ class RegistryClient(BaseClient):
     def get_image(self, image_id):
         """Returns a mapping of image metadata from Registry"""
         res = self.do_request("GET", "/images/%s" % image_id)
-        data = json.loads(res.read())['image']
+        data = utils.json_loads(res.read())['image']
         return self.decrypt_metadata(data)
 
     def add_image(self, image_metadata):
@@ -139,7 +138,7 @@ class RegistryClient(BaseClient):
 
         res = self.do_request("POST", "/images", body=body, headers=headers)
         # Registry returns a JSONified dict(image=image_info)
-        data = json.loads(res.read())
+        data = utils.json_loads(res.read())
         image = data['image']
         return self.decrypt_metadata(image)
 
@@ -163,7 +162,7 @@ class RegistryClient(BaseClient):
 
         res = self.do_request("PUT", "/images/%s" % image_id, body=body,
                               headers=headers)
-        data = json.loads(res.read())
+        data = utils.json_loads(res.read())
         image = data['image']
         return self.decrypt_metadata(image)
 
@@ -172,20 +171,20 @@ class RegistryClient(BaseClient):
         Deletes Registry's information about an image
         """
         res = self.do_request("DELETE", "/images/%s" % image_id)
-        data = json.loads(res.read())
+        data = utils.json_loads(res.read())
         image = data['image']
         return image
 
     def get_image_members(self, image_id):
         """Returns a list of membership associations from Registry"""
         res = self.do_request("GET", "/images/%s/members" % image_id)
-        data = json.loads(res.read())['members']
+        data = utils.json_loads(res.read())['members']
         return data
 
     def get_member_images(self, member_id):
         """Returns a list of membership associations from Registry"""
         res = self.do_request("GET", "/shared-images/%s" % member_id)
-        data = json.loads(res.read())['shared_images']
+        data = utils.json_loads(res.read())['shared_images']
         return data
 
     def replace_members(self, image_id, member_data):
@@ -15,16 +15,20 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
 import os
 import sys
 import time
 
+import eventlet
+
 from glance.common import exception
 from glance.common import utils
 from glance.openstack.common import cfg
 from glance.openstack.common import importutils
 import glance.openstack.common.log as logging
 from glance import registry
+from glance.store import base
 from glance.store import location
 
 LOG = logging.getLogger(__name__)
@@ -140,6 +144,46 @@ class Indexable(object):
         return self.size
 
 
+def iter_ranges_concurrently(fetch, size, range_size, concurrency):
+    """
+    Return an iterator over the bytes of an object of known size that
+    fetches it as a series of byte ranges, keeping up to `concurrency`
+    range requests in flight.
+
+    Ranges are yielded strictly in order. A range is only requested once
+    there is room for it in the reorder buffer, so at most `concurrency`
+    ranges, or `concurrency` * `range_size` bytes, are held in memory at
+    any time regardless of how quickly the caller consumes the data.
+
+    :param fetch: callable taking (start, end) inclusive byte offsets and
+                  returning the data in that range as a string
+    :param size: total size of the object in bytes
+    :param range_size: number of bytes to request per range
+    :param concurrency: maximum number of ranges to fetch at once
+    """
+    ranges = ((start, min(start + range_size, size) - 1)
+              for start in xrange(0, size, range_size))
+    pending = collections.deque()
+
+    def _fill():
+        while len(pending) < concurrency:
+            try:
+                start, end = ranges.next()
+            except StopIteration:
+                return
+            pending.append(eventlet.spawn(fetch, start, end))
+
+    _fill()
+    try:
+        while pending:
+            data = pending.popleft().wait()
+            _fill()
+            yield data
+    finally:
+        for gt in pending:
+            gt.kill()
+
+
 def _get_store_class(store_entry):
     store_cls = None
     try:
@@ -254,10 +298,29 @@ def get_store_from_location(uri):
     return loc.store_name
 
 
+def check_delete_from_backend(context, uri):
+    """
+    Raises InUseByStore if the image at uri can't be deleted from its
+    backend, which would otherwise only be found once the image has been
+    marked deleted.
+    """
+    try:
+        store = get_store_from_uri(context, uri)
+    except UnsupportedBackend:
+        return
+    loc = location.get_location_from_uri(uri)
+    store.check_delete(loc)
+
+
 def schedule_delete_from_backend(uri, context, image_id, **kwargs):
     """
     Given a uri and a time, schedule the deletion of an image.
+
+    :raises `glance.common.exception.InUseByStore` if the image is in use
+            through its backend, in which case nothing is changed
     """
+    check_delete_from_backend(context, uri)
+
     if not CONF.delayed_delete:
         registry.update_image_metadata(context, image_id,
                                        {'status': 'deleted'})
@@ -298,6 +361,40 @@ def add_to_backend(context, scheme, image_id, data, size):
     return store.add(image_id, data, size)
 
 
+def copy_within_backend(store, image_id, uri, size):
+    """
+    Has `store` copy the image at `uri` to a new image itself, without
+    the image data passing through Glance, if it holds the image at `uri`
+    and can. Returns the same as `store.add` does, or None if the image
+    must be read and added instead.
+    """
+    loc = location.get_location_from_uri(uri)
+    if loc.store_name not in store.get_schemes():
+        return None
+    try:
+        return store.copy(image_id, loc, size)
+    except NotImplementedError:
+        LOG.debug(_("Store can't copy image at %s itself, reading it "
+                    "instead") % loc.store_name)
+        return None
+
+
+def get_store_stats(context):
+    """
+    Returns the statistics of each registered store which gathers any,
+    keyed by the first scheme it handles
+    """
+    stats = {}
+    store_classes = set(info['store_class']
+                        for info in location.SCHEME_TO_CLS_MAP.values())
+    for store_class in store_classes:
+        if store_class.get_stats == base.Store.get_stats:
+            continue
+        store = store_class(context)
+        stats[store.get_schemes()[0]] = store.get_stats()
+    return stats
+
+
 def set_acls(context, location_uri, public=False, read_tenants=[],
              write_tenants=[]):
     scheme = get_store_from_location(location_uri)
@@ -44,6 +44,7 @@ class Store(object):
                     "Disabling add method.")
             LOG.error(msg)
             self.add = self.add_disabled
+            self.copy = self.add_disabled
 
     def configure(self):
         """
@@ -126,6 +127,28 @@ class Store(object):
         """
         raise NotImplementedError
 
+    def copy(self, image_id, location, image_size):
+        """
+        Copies an image this store already holds elsewhere to a new image
+        with the supplied identifier, within the backend storage system so
+        that none of the image data passes through Glance, and returns an
+        `glance.store.ImageAddResult` object as `add` does. The checksum
+        in it is None if the backend can't tell it without the data being
+        read.
+
+        :param image_id: The opaque image identifier
+        :param location: `glance.store.location.Location` object of the
+                         image to copy, which this store handles
+        :param image_size: The size of the image to copy, in bytes
+
+        :retval `glance.store.ImageAddResult` object
+        :raises `glance.common.exception.Duplicate` if the image already
+                existed
+        :raises NotImplementedError if the store can't copy that image
+                without reading it, in which case it should be added
+        """
+        raise NotImplementedError
+
     def delete(self, location):
         """
         Takes a `glance.store.location.Location` object that indicates
@@ -137,6 +160,26 @@ class Store(object):
         """
         raise NotImplementedError
 
+    def check_delete(self, location):
+        """
+        Checks that the image at the supplied location can be deleted,
+        before anything is changed to delete it. Stores whose images can
+        always be deleted needn't check anything.
+
+        :location `glance.store.location.Location` object, supplied
+                  from glance.store.location.get_location_from_uri()
+        :raises `glance.exception.InUseByStore` if the image is in use
+                through the store and can't be deleted
+        """
+        pass
+
+    def get_stats(self):
+        """
+        Returns a dict of statistics about the backend storage system,
+        such as how full it is.
+        """
+        raise NotImplementedError
+
     def set_acls(self, location, public=False, read_tenants=[],
                  write_tenants=[]):
         """
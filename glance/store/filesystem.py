@@ -19,9 +19,14 @@
 A simple filesystem-backed store
 """
 
+import ctypes
+import ctypes.util
 import errno
 import hashlib
+import math
 import os
+import random
+import sys
 import urlparse
 
 from glance.common import exception
@@ -36,8 +41,138 @@ LOG = logging.getLogger(__name__)
 
 datadir_opt = cfg.StrOpt('filesystem_store_datadir')
 
+filesystem_opts = [
+    cfg.MultiStrOpt('filesystem_store_datadirs', default=[]),
+    cfg.StrOpt('filesystem_store_placement', default='free_space'),
+    cfg.BoolOpt('filesystem_store_preallocate', default=False),
+    cfg.IntOpt('filesystem_store_write_size', default=64),
+    cfg.BoolOpt('filesystem_store_fsync', default=False),
+    cfg.IntOpt('filesystem_store_sync_interval', default=0),
+    cfg.BoolOpt('filesystem_store_drop_cache', default=False),
+    ]
+
 CONF = cfg.CONF
 CONF.register_opt(datadir_opt)
+CONF.register_opts(filesystem_opts)
+
+# Writes are made in whole multiples of this many bytes, but the last
+BLOCK_SIZE = 4096
+
+POSIX_FADV_DONTNEED = 4
+
+
+def _libc_function(*names):
+    """
+    Returns the first of the named functions which the C library has, or
+    None, for those the os module doesn't offer
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except (OSError, TypeError):
+        return None
+    for name in names:
+        func = getattr(libc, name, None)
+        if func is not None:
+            return func
+    return None
+
+
+_posix_fallocate = _libc_function('posix_fallocate64', 'posix_fallocate')
+if _posix_fallocate is not None:
+    _posix_fallocate.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+
+_posix_fadvise = _libc_function('posix_fadvise64', 'posix_fadvise')
+if _posix_fadvise is not None:
+    _posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                               ctypes.c_int]
+
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+
+def _preallocate(fd, size):
+    """
+    Allocates `size` bytes of disk to a file at once, so that it isn't
+    fragmented as it is written
+
+    :raises IOError if there isn't room for it
+    """
+    if _posix_fallocate is None:
+        return
+    err = _posix_fallocate(fd, 0, size)
+    if err in (errno.ENOSPC, errno.EFBIG):
+        raise IOError(err, os.strerror(err))
+    elif err:
+        LOG.debug(_("Unable to preallocate %(size)d bytes: %(error)s") %
+                  {'size': size, 'error': os.strerror(err)})
+
+
+def _drop_cache(fd, offset, length):
+    """
+    Asks for the data already written to disk in a range of a file to be
+    dropped from the page cache. A `length` of 0 means to the end.
+    """
+    if _posix_fadvise is not None:
+        _posix_fadvise(fd, offset, length, POSIX_FADV_DONTNEED)
+
+
+def _parse_datadir(entry):
+    """
+    Splits a filesystem_store_datadirs entry, `<path>[:<weight>]`, into
+    its path and weight, which is 1 if not given
+    """
+    path, sep, weight = entry.rpartition(':')
+    if sep and weight.isdigit():
+        return path, int(weight)
+    return entry, 1
+
+
+def _disk_usage(path):
+    """Returns the total and free bytes of the filesystem holding path."""
+    st = os.statvfs(path)
+    return st.f_blocks * st.f_frsize, st.f_bavail * st.f_frsize
+
+
+def _hash_score(image_id, path, weight):
+    """
+    Scores a directory for an image by weighted rendezvous hashing, so
+    that each image has a fixed first choice of directory, directories
+    are chosen in proportion to their weights, and adding or removing one
+    only moves the images which would choose it
+    """
+    digest = hashlib.md5('%s:%s' % (image_id, path)).hexdigest()
+    # A number uniformly distributed in the open interval (0, 1)
+    point = (int(digest[:13], 16) + 0.5) / 16 ** 13
+    return weight / -math.log(point)
+
+
+def _fsync_dir(path):
+    """Makes the entries of a directory durable, as after a rename."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_chunks(chunks, write_size):
+    """
+    Joins or splits chunks of data into pieces whose sizes are multiples
+    of `write_size`, but the last, so that they're written in large
+    writes which start on block boundaries
+    """
+    pending = []
+    pending_len = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_len += len(chunk)
+        if pending_len >= write_size:
+            data = ''.join(pending)
+            end = pending_len - pending_len % write_size
+            yield data[:end]
+            pending = [data[end:]]
+            pending_len -= end
+    if pending_len:
+        yield ''.join(pending)
 
 
 class StoreLocation(glance.store.location.StoreLocation):
@@ -112,25 +247,48 @@ class Store(glance.store.base.Store):
         this method. If the store was not able to successfully configure
         itself, it should raise `exception.BadStoreConfiguration`
         """
-        self.datadir = CONF.filesystem_store_datadir
-        if self.datadir is None:
+        if CONF.filesystem_store_datadirs:
+            self.datadirs = [_parse_datadir(entry)
+                             for entry in CONF.filesystem_store_datadirs]
+        elif CONF.filesystem_store_datadir is not None:
+            self.datadirs = [(CONF.filesystem_store_datadir, 1)]
+        else:
             reason = (_("Could not find %s in configuration options.") %
                       'filesystem_store_datadir')
             LOG.error(reason)
             raise exception.BadStoreConfiguration(store_name="filesystem",
                                                   reason=reason)
 
-        if not os.path.exists(self.datadir):
-            msg = _("Directory to write image files does not exist "
-                    "(%s). Creating.") % self.datadir
-            LOG.info(msg)
-            try:
-                os.makedirs(self.datadir)
-            except IOError:
-                reason = _("Unable to create datadir: %s") % self.datadir
-                LOG.error(reason)
-                raise exception.BadStoreConfiguration(store_name="filesystem",
-                                                      reason=reason)
+        self.placement = CONF.filesystem_store_placement
+        if self.placement not in ('free_space', 'hash'):
+            reason = (_("Unknown filesystem_store_placement %s") %
+                      self.placement)
+            LOG.error(reason)
+            raise exception.BadStoreConfiguration(store_name="filesystem",
+                                                  reason=reason)
+
+        for datadir, weight in self.datadirs:
+            if not os.path.exists(datadir):
+                msg = _("Directory to write image files does not exist "
+                        "(%s). Creating.") % datadir
+                LOG.info(msg)
+                try:
+                    os.makedirs(datadir)
+                except (IOError, OSError):
+                    reason = _("Unable to create datadir: %s") % datadir
+                    LOG.error(reason)
+                    raise exception.BadStoreConfiguration(
+                        store_name="filesystem", reason=reason)
+
+        self.preallocate = CONF.filesystem_store_preallocate
+        # The config file has filesystem_store_write_size in KB, which is
+        # rounded up to whole blocks
+        write_size = max(1, CONF.filesystem_store_write_size) * 1024
+        self.write_size = -(-write_size // BLOCK_SIZE) * BLOCK_SIZE
+        self.fsync = CONF.filesystem_store_fsync
+        # ...and filesystem_store_sync_interval in MB
+        self.sync_interval = CONF.filesystem_store_sync_interval * 1024 * 1024
+        self.drop_cache = CONF.filesystem_store_drop_cache
 
     def get(self, location):
         """
@@ -143,9 +301,9 @@ class Store(glance.store.base.Store):
         :raises `glance.exception.NotFound` if image does not exist
         """
         loc = location.store_location
-        filepath = loc.path
-        if not os.path.exists(filepath):
-            raise exception.NotFound(_("Image file %s not found") % filepath)
+        filepath = self._find_image_file(loc.path)
+        if filepath is None:
+            raise exception.NotFound(_("Image file %s not found") % loc.path)
         else:
             msg = _("Found image at %s. Returning in ChunkedFile.") % filepath
             LOG.debug(msg)
@@ -163,15 +321,86 @@ class Store(glance.store.base.Store):
         :raises Forbidden if cannot delete because of permissions
         """
         loc = location.store_location
-        fn = loc.path
-        if os.path.exists(fn):
+        fn = self._find_image_file(loc.path)
+        if fn is not None:
             try:
                 LOG.debug(_("Deleting image at %(fn)s") % locals())
                 os.unlink(fn)
             except OSError:
                 raise exception.Forbidden(_("You cannot delete file %s") % fn)
         else:
-            raise exception.NotFound(_("Image file %s does not exist") % fn)
+            raise exception.NotFound(_("Image file %s does not exist") %
+                                     loc.path)
+
+    def _find_image_file(self, filepath):
+        """
+        Returns the path of an image file, which is looked for under the
+        same name in each data directory if it isn't where its location
+        says, as after being moved to another one, or None if not found
+        """
+        if os.path.exists(filepath):
+            return filepath
+        filename = os.path.basename(filepath)
+        for datadir, weight in getattr(self, 'datadirs', []):
+            path = os.path.join(datadir, filename)
+            if os.path.exists(path):
+                LOG.debug(_("Image file %(filepath)s found at %(path)s") %
+                          locals())
+                return path
+        return None
+
+    def _choose_datadir(self, image_id, image_size):
+        """
+        Chooses the data directory to write an image to from those with
+        a weight and room for it, as filesystem_store_placement says:
+
+        free_space -- at random, in proportion to weight times free space,
+                      so concurrent uploads are spread over the directories
+                      while the emptiest fill fastest
+        hash       -- by hashing the image identifier, in proportion to
+                      weight alone
+
+        :raises `glance.common.exception.StorageFull` if none has room
+        """
+        candidates = []
+        for datadir, weight in self.datadirs:
+            if weight <= 0:
+                continue
+            total, free = _disk_usage(datadir)
+            if free >= image_size:
+                candidates.append((datadir, weight, free))
+        if not candidates:
+            raise exception.StorageFull()
+
+        if self.placement == 'hash':
+            return max(candidates,
+                       key=lambda c: _hash_score(image_id, c[0], c[1]))[0]
+
+        shares = [weight * free for (datadir, weight, free) in candidates]
+        if not sum(shares):
+            shares = [weight for (datadir, weight, free) in candidates]
+        point = random.uniform(0, sum(shares))
+        for (datadir, weight, free), share in zip(candidates, shares):
+            if share and point < share:
+                return datadir
+            point -= share
+        return [c[0] for c, share in zip(candidates, shares) if share][-1]
+
+    def get_stats(self):
+        """
+        Returns the placement policy and the weight and utilization of
+        each data directory
+        """
+        datadirs = []
+        for datadir, weight in getattr(self, 'datadirs', []):
+            total, free = _disk_usage(datadir)
+            datadirs.append({'path': datadir,
+                             'weight': weight,
+                             'total_bytes': total,
+                             'free_bytes': free,
+                             'used_bytes': total - free})
+        return {'placement': getattr(self, 'placement', None),
+                'datadirs': datadirs}
 
     def add(self, image_id, image_file, image_size):
         """
@@ -190,39 +419,84 @@ class Store(glance.store.base.Store):
         :note By default, the backend writes the image data to a file
               `/<DATADIR>/<ID>`, where <DATADIR> is the value of
               the filesystem_store_datadir configuration option and <ID>
-              is the supplied image ID.
+              is the supplied image ID. With several
+              filesystem_store_datadirs, <DATADIR> is chosen from them
+              for each image. It is written under a temporary name
+              first, and renamed once complete, so that the file is
+              never seen partly written.
         """
 
-        filepath = os.path.join(self.datadir, str(image_id))
-
-        if os.path.exists(filepath):
-            raise exception.Duplicate(_("Image file %s already exists!")
-                                      % filepath)
+        for datadir, weight in self.datadirs:
+            filepath = os.path.join(datadir, str(image_id))
+            if os.path.exists(filepath):
+                raise exception.Duplicate(_("Image file %s already exists!")
+                                          % filepath)
 
-        checksum = hashlib.md5()
-        bytes_written = 0
+        datadir = self._choose_datadir(image_id, image_size)
+        filepath = os.path.join(datadir, str(image_id))
+        tmp_filepath = os.path.join(datadir, '.%s.tmp' % image_id)
         try:
-            with open(filepath, 'wb') as f:
-                for buf in utils.chunkreadable(image_file,
-                                              ChunkedFile.CHUNKSIZE):
-                    bytes_written += len(buf)
-                    checksum.update(buf)
-                    f.write(buf)
-        except IOError as e:
-            if e.errno in [errno.EFBIG, errno.ENOSPC]:
-                try:
-                    os.unlink(filepath)
-                except Exception:
-                    msg = _('Unable to remove partial image data for image %s')
-                    LOG.error(msg % image_id)
-                raise exception.StorageFull()
-            elif e.errno == errno.EACCES:
-                raise exception.StorageWriteDenied()
-            else:
-                raise
-
-        checksum_hex = checksum.hexdigest()
+            bytes_written, checksum_hex = self._write(tmp_filepath,
+                                                      image_file,
+                                                      image_size)
+            os.rename(tmp_filepath, filepath)
+            if self.fsync:
+                _fsync_dir(datadir)
+        except Exception:
+            exc_info = sys.exc_info()
+            try:
+                os.unlink(tmp_filepath)
+            except Exception:
+                msg = _('Unable to remove partial image data for image %s')
+                LOG.error(msg % image_id)
+            e = exc_info[1]
+            if isinstance(e, IOError):
+                if e.errno in [errno.EFBIG, errno.ENOSPC]:
+                    raise exception.StorageFull()
+                elif e.errno == errno.EACCES:
+                    raise exception.StorageWriteDenied()
+            raise exc_info[0], exc_info[1], exc_info[2]
 
         LOG.debug(_("Wrote %(bytes_written)d bytes to %(filepath)s with "
                     "checksum %(checksum_hex)s") % locals())
         return ('file://%s' % filepath, bytes_written, checksum_hex)
+
+    def _write(self, filepath, image_file, image_size):
+        """
+        Writes image data to a file, as the filesystem_store_* options
+        say, and returns the number of bytes written and their checksum
+        """
+        checksum = hashlib.md5()
+        bytes_written = 0
+        bytes_synced = 0
+        with open(filepath, 'wb') as f:
+            fd = f.fileno()
+            if self.preallocate and image_size > 0:
+                _preallocate(fd, image_size)
+
+            chunks = utils.chunkreadable(image_file, ChunkedFile.CHUNKSIZE)
+            for buf in _write_chunks(chunks, self.write_size):
+                bytes_written += len(buf)
+                checksum.update(buf)
+                f.write(buf)
+                if (self.sync_interval and
+                    bytes_written - bytes_synced >= self.sync_interval):
+                    f.flush()
+                    _fdatasync(fd)
+                    if self.drop_cache:
+                        _drop_cache(fd, bytes_synced,
+                                    bytes_written - bytes_synced)
+                    bytes_synced = bytes_written
+
+            f.flush()
+            if self.preallocate and image_size > bytes_written:
+                # Less was uploaded than was allocated for
+                f.truncate(bytes_written)
+            if self.fsync:
+                os.fsync(fd)
+            elif self.drop_cache:
+                _fdatasync(fd)
+            if self.drop_cache:
+                _drop_cache(fd, bytes_synced, 0)
+
+        return bytes_written, checksum.hexdigest()
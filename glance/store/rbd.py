@@ -20,11 +20,16 @@
 from __future__ import absolute_import
 from __future__ import with_statement
 
+import collections
+import contextlib
 import hashlib
 import math
 import urllib
 import urlparse
 
+import eventlet
+from eventlet import tpool
+
 from glance.common import exception
 from glance.openstack.common import cfg
 import glance.openstack.common.log as logging
@@ -44,13 +49,22 @@ DEFAULT_USER = None    # let librados decide based on the Ceph conf file
 DEFAULT_CHUNKSIZE = 4  # in MiB
 DEFAULT_SNAPNAME = 'snap'
 
+# Granularity, in bytes, at which runs of zeros in uploaded image data are
+# found and left unwritten
+ZERO_BLOCK_SIZE = 64 * 1024
+
 LOG = logging.getLogger(__name__)
 
+# Cluster connections shared by every request this process serves, keyed
+# by Ceph conf file and user
+_RADOS_CONNECTIONS = {}
+
 rbd_opts = [
     cfg.IntOpt('rbd_store_chunk_size', default=DEFAULT_CHUNKSIZE),
     cfg.StrOpt('rbd_store_pool', default=DEFAULT_POOL),
     cfg.StrOpt('rbd_store_user', default=DEFAULT_USER),
     cfg.StrOpt('rbd_store_ceph_conf', default=DEFAULT_CONFFILE),
+    cfg.IntOpt('rbd_store_io_window', default=0),
     ]
 
 CONF = cfg.CONF
@@ -109,6 +123,197 @@ class StoreLocation(glance.store.location.StoreLocation):
             raise exception.BadStoreUri(message=reason)
 
 
+def _nonzero_extents(data, block_size=ZERO_BLOCK_SIZE):
+    """
+    Returns the (offset, length) of each run of `block_size` blocks of
+    `data` which aren't all zeros, in order, so that the rest needn't be
+    written to a newly created image, which reads as zeros anyway
+    """
+    zeros = '\0' * block_size
+    extents = []
+    start = None
+    for offset in xrange(0, len(data), block_size):
+        block_length = min(block_size, len(data) - offset)
+        if data.startswith(zeros[:block_length], offset):
+            if start is not None:
+                extents.append((start, offset - start))
+                start = None
+        elif start is None:
+            start = offset
+    if start is not None:
+        extents.append((start, len(data) - start))
+    return extents
+
+
+def _submit(window, func, *args):
+    """
+    Calls func, or when `window` is greater than zero, starts calling it
+    in a native thread so that the call neither blocks the other green
+    threads nor waits for the ones before it, returning the green thread
+    """
+    if window > 0:
+        return eventlet.spawn(tpool.execute, func, *args)
+    return func(*args)
+
+
+def _wait_quietly(pending):
+    """Waits for calls still in flight when giving up on the rest."""
+    for call in pending:
+        if isinstance(call, eventlet.greenthread.GreenThread):
+            try:
+                call.wait()
+            except Exception:
+                pass
+
+
+def _result(call):
+    """Returns what a call returned, once it has finished."""
+    if isinstance(call, eventlet.greenthread.GreenThread):
+        return call.wait()
+    return call
+
+
+def _write_sparse(image, image_file, image_size, chunk_size, checksum,
+                  window=0):
+    """
+    Writes `image_size` bytes read from `image_file` to an RBD image in
+    `chunk_size` pieces, skipping the runs of zeros in them
+
+    :param window: The number of writes to keep in flight at once, in
+                   native threads, while the next are read from
+                   `image_file`, or 0 to make each write in turn
+    :retval The number of bytes of zeros which weren't written
+    """
+    pending = collections.deque()
+    bytes_skipped = 0
+    bytes_left = image_size
+    try:
+        while bytes_left > 0:
+            length = min(chunk_size, bytes_left)
+            data = image_file.read(length)
+            offset = image_size - bytes_left
+            written = 0
+            for (start, extent_length) in _nonzero_extents(data):
+                if len(pending) >= window > 0:
+                    pending.popleft().wait()
+                call = _submit(window, image.write,
+                               data[start:start + extent_length],
+                               offset + start)
+                if window > 0:
+                    pending.append(call)
+                written += extent_length
+            bytes_skipped += len(data) - written
+            bytes_left -= length
+            checksum.update(data)
+
+        while pending:
+            pending.popleft().wait()
+    finally:
+        _wait_quietly(pending)
+    return bytes_skipped
+
+
+def _allocated_extents(image, size):
+    """
+    Returns the sorted (offset, length) of the extents of an RBD image
+    which hold data, or None if librbd can't say which those are
+    """
+    if not hasattr(image, 'diff_iterate'):
+        return None
+
+    extents = []
+
+    def _extent(offset, length, exists):
+        if exists:
+            extents.append((offset, length))
+
+    try:
+        image.diff_iterate(0, size, None, _extent)
+    except rbd.Error, e:
+        LOG.debug(_("Unable to find the allocated extents of an RBD "
+                    "image, reading all of it: %s") % e)
+        return None
+    extents.sort()
+    return extents
+
+
+def _read_sparse(image, size, chunk_size, window=0):
+    """
+    Reads an RBD image in `chunk_size` pieces, yielding zeros rather
+    than reading the pieces which hold no data at all
+
+    :param window: The number of reads to keep in flight at once, in
+                   native threads, ahead of the piece being yielded, or 0
+                   to make each read only once the last has been yielded
+    """
+    extents = _allocated_extents(image, size)
+    zeros = None
+    i = 0
+    pending = collections.deque()
+    try:
+        for offset in xrange(0, size, chunk_size):
+            length = min(chunk_size, size - offset)
+
+            if extents is not None:
+                # Skip past the extents which end before this piece
+                while (i < len(extents) and
+                       extents[i][0] + extents[i][1] <= offset):
+                    i += 1
+
+            if (extents is None or
+                (i < len(extents) and extents[i][0] < offset + length)):
+                pending.append(_submit(window, image.read, offset, length))
+            else:
+                if zeros is None:
+                    zeros = '\0' * chunk_size
+                pending.append(zeros[:length])
+
+            if len(pending) > window:
+                yield _result(pending.popleft())
+
+        while pending:
+            yield _result(pending.popleft())
+    finally:
+        _wait_quietly(pending)
+
+
+def _get_rados(conf_file, user):
+    """
+    Returns the process's connection to the Ceph cluster as `user`,
+    connecting the first time it is asked for
+    """
+    key = (conf_file, user)
+    conn = _RADOS_CONNECTIONS.get(key)
+    if conn is None:
+        conn = rados.Rados(conffile=conf_file, rados_id=user)
+        conn.connect()
+        _RADOS_CONNECTIONS[key] = conn
+    return conn
+
+
+@contextlib.contextmanager
+def _open_ioctx(conf_file, user, pool):
+    """
+    Opens an I/O context on `pool` through the shared cluster connection,
+    closing it again afterwards. If the connection has gone bad it is
+    replaced with a new one, once.
+    """
+    try:
+        conn = _get_rados(conf_file, user)
+        ioctx = conn.open_ioctx(pool)
+    except rados.Error:
+        # Requests still using the old connection keep it alive, so it
+        # isn't shut down here
+        LOG.warn(_("Reconnecting to the Ceph cluster"))
+        _RADOS_CONNECTIONS.pop((conf_file, user), None)
+        conn = _get_rados(conf_file, user)
+        ioctx = conn.open_ioctx(pool)
+    try:
+        yield (conn, ioctx)
+    finally:
+        ioctx.close()
+
+
 class ImageIterator(object):
     """
     Reads data from an RBD image, one chunk at a time.
@@ -120,22 +325,25 @@ class ImageIterator(object):
         self.user = store.user
         self.conf_file = store.conf_file
         self.chunk_size = store.chunk_size
+        self.io_window = store.io_window
 
     def __iter__(self):
         try:
-            with rados.Rados(conffile=self.conf_file,
-                             rados_id=self.user) as conn:
-                with conn.open_ioctx(self.pool) as ioctx:
-                    with rbd.Image(ioctx, self.name) as image:
-                        img_info = image.stat()
-                        size = img_info['size']
-                        bytes_left = size
-                        while bytes_left > 0:
-                            length = min(self.chunk_size, bytes_left)
-                            data = image.read(size - bytes_left, length)
-                            bytes_left -= len(data)
+            with _open_ioctx(self.conf_file, self.user,
+                             self.pool) as (conn, ioctx):
+                with rbd.Image(ioctx, self.name) as image:
+                    img_info = image.stat()
+                    size = img_info['size']
+                    reader = _read_sparse(image, size, self.chunk_size,
+                                          self.io_window)
+                    try:
+                        for data in reader:
                             yield data
-                        raise StopIteration()
+                    finally:
+                        # Wait for the reads still in flight before the
+                        # image is closed under them
+                        reader.close()
+                    raise StopIteration()
         except rbd.ImageNotFound:
             raise exception.NotFound(
                 _('RBD image %s does not exist') % self.name)
@@ -164,6 +372,7 @@ class Store(glance.store.base.Store):
             self.pool = str(CONF.rbd_store_pool)
             self.user = str(CONF.rbd_store_user)
             self.conf_file = str(CONF.rbd_store_ceph_conf)
+            self.io_window = CONF.rbd_store_io_window
         except cfg.ConfigFileValueError, e:
             reason = _("Error in store configuration: %s") % e
             LOG.error(reason)
@@ -183,6 +392,26 @@ class Store(glance.store.base.Store):
         loc = location.store_location
         return (ImageIterator(str(loc.image), self), None)
 
+    def get_size(self, location):
+        """
+        Takes a `glance.store.location.Location` object that indicates
+        where to find the image file, and returns the image_size (or 0
+        if unavailable)
+
+        :param location `glance.store.location.Location` object, supplied
+                        from glance.store.location.get_location_from_uri()
+        """
+        loc = location.store_location
+        snapshot = str(loc.snapshot) if loc.snapshot else None
+        try:
+            with _open_ioctx(self.conf_file, self.user,
+                             str(loc.pool or self.pool)) as (conn, ioctx):
+                with rbd.Image(ioctx, str(loc.image),
+                               snapshot=snapshot) as image:
+                    return image.stat()['size']
+        except Exception:
+            return 0
+
     def _create_image(self, fsid, ioctx, name, size, order):
         """
         Create an rbd image. If librbd supports it,
@@ -215,39 +444,145 @@ class Store(glance.store.base.Store):
         :param image_file: The image data to write, as a file-like object
         :param image_size: The size of the image data to write, in bytes
 
+        Runs of zeros in the image data aren't written, leaving those
+        parts of the RBD image thin. How many bytes of them there were is
+        left in `bytes_skipped`.
+
         :retval `glance.store.ImageAddResult` object
         :raises `glance.common.exception.Duplicate` if the image already
                 existed
         """
         checksum = hashlib.md5()
         image_name = str(image_id)
-        with rados.Rados(conffile=self.conf_file, rados_id=self.user) as conn:
+        with _open_ioctx(self.conf_file, self.user,
+                         self.pool) as (conn, ioctx):
             fsid = None
             if hasattr(conn, 'get_fsid'):
                 fsid = conn.get_fsid()
-            with conn.open_ioctx(self.pool) as ioctx:
+            order = int(math.log(self.chunk_size, 2))
+            LOG.debug('creating image %s with order %d',
+                      image_name, order)
+            try:
+                location = self._create_image(fsid, ioctx, image_name,
+                                              image_size, order)
+            except rbd.ImageExists:
+                raise exception.Duplicate(
+                    _('RBD image %s already exists') % image_id)
+            with rbd.Image(ioctx, image_name) as image:
+                self.bytes_skipped = _write_sparse(image, image_file,
+                                                   image_size,
+                                                   self.chunk_size,
+                                                   checksum,
+                                                   self.io_window)
+                LOG.debug(_("Wrote image %(image_name)s, leaving "
+                            "%(bytes_skipped)d bytes of zeros "
+                            "unwritten") %
+                          {'image_name': image_name,
+                           'bytes_skipped': self.bytes_skipped})
+                if location.snapshot:
+                    image.create_snap(location.snapshot)
+                    image.protect_snap(location.snapshot)
+
+        return (location.get_uri(), image_size, checksum.hexdigest())
+
+    def copy(self, image_id, location, image_size):
+        """
+        Clones the protected snapshot of an RBD image in the same cluster
+        to a new copy-on-write image with the supplied identifier, which
+        shares the snapshot's data rather than copying it, and returns an
+        `glance.store.ImageAddResult` object whose checksum is None
+
+        The image cloned from can't be deleted while the clone exists,
+        which `check_delete` reports.
+
+        :param image_id: The opaque image identifier
+        :param location: `glance.store.location.Location` object of the
+                         image to clone
+        :param image_size: The size of the image to clone, in bytes
+
+        :retval `glance.store.ImageAddResult` object
+        :raises `glance.common.exception.Duplicate` if the image already
+                existed
+        :raises NotImplementedError if the image has no snapshot to clone
+                or is in another cluster
+        """
+        loc = location.store_location
+        if not (loc.snapshot and hasattr(rbd, 'RBD_FEATURE_LAYERING')):
+            raise NotImplementedError
+
+        image_name = str(image_id)
+        with _open_ioctx(self.conf_file, self.user,
+                         str(loc.pool)) as (conn, parent_ioctx):
+            if (not hasattr(conn, 'get_fsid') or
+                conn.get_fsid() != loc.fsid):
+                raise NotImplementedError
+            with _open_ioctx(self.conf_file, self.user,
+                             self.pool) as (conn, ioctx):
                 order = int(math.log(self.chunk_size, 2))
-                LOG.debug('creating image %s with order %d',
-                          image_name, order)
+                LOG.debug(_("Cloning image %(image_name)s from "
+                            "%(parent)s@%(snapshot)s") %
+                          {'image_name': image_name,
+                           'parent': loc.image,
+                           'snapshot': loc.snapshot})
                 try:
-                    location = self._create_image(fsid, ioctx, image_name,
-                                                  image_size, order)
+                    rbd.RBD().clone(parent_ioctx, str(loc.image),
+                                    str(loc.snapshot), ioctx, image_name,
+                                    features=rbd.RBD_FEATURE_LAYERING,
+                                    order=order)
                 except rbd.ImageExists:
                     raise exception.Duplicate(
                         _('RBD image %s already exists') % image_id)
+                except rbd.ImageNotFound:
+                    raise exception.NotFound(
+                        _('RBD image %s does not exist') % loc.image)
+                except rbd.InvalidArgument:
+                    # The snapshot isn't protected, so can't be cloned
+                    raise NotImplementedError
+
                 with rbd.Image(ioctx, image_name) as image:
-                    bytes_left = image_size
-                    while bytes_left > 0:
-                        length = min(self.chunk_size, bytes_left)
-                        data = image_file.read(length)
-                        image.write(data, image_size - bytes_left)
-                        bytes_left -= length
-                        checksum.update(data)
-                    if location.snapshot:
-                        image.create_snap(location.snapshot)
-                        image.protect_snap(location.snapshot)
+                    size = image.stat()['size']
+                    image.create_snap(DEFAULT_SNAPNAME)
+                    image.protect_snap(DEFAULT_SNAPNAME)
 
-        return (location.get_uri(), image_size, checksum.hexdigest())
+        clone_location = StoreLocation({'fsid': loc.fsid,
+                                        'pool': self.pool,
+                                        'image': image_name,
+                                        'snapshot': DEFAULT_SNAPNAME})
+        return (clone_location.get_uri(), size, None)
+
+    def check_delete(self, location):
+        """
+        Checks that no RBD image has been cloned from the snapshot of the
+        image at the supplied location, since the snapshot, and so the
+        image, can't be deleted while clones of it exist
+
+        :location `glance.store.location.Location` object, supplied
+                  from glance.store.location.get_location_from_uri()
+        :raises `glance.exception.InUseByStore` if the image has clones
+        """
+        loc = location.store_location
+        if not loc.snapshot:
+            return
+
+        with _open_ioctx(self.conf_file, self.user,
+                         self.pool) as (conn, ioctx):
+            try:
+                with rbd.Image(ioctx, str(loc.image),
+                               snapshot=str(loc.snapshot)) as image:
+                    if not hasattr(image, 'list_children'):
+                        return
+                    children = image.list_children()
+            except rbd.ImageNotFound:
+                # Left for delete to report
+                return
+
+        if children:
+            LOG.error(_("snapshot %(image)s@%(snapshot)s can't be deleted "
+                        "while it has clones: %(children)s") %
+                      {'image': loc.image, 'snapshot': loc.snapshot,
+                       'children': ', '.join('%s/%s' % child
+                                             for child in children)})
+            raise exception.InUseByStore()
 
     def delete(self, location):
         """
@@ -261,25 +596,25 @@ class Store(glance.store.base.Store):
         """
         loc = location.store_location
 
-        with rados.Rados(conffile=self.conf_file, rados_id=self.user) as conn:
-            with conn.open_ioctx(self.pool) as ioctx:
-                if loc.snapshot:
-                    with rbd.Image(ioctx, loc.image) as image:
-                        try:
-                            image.unprotect_snap(loc.snapshot)
-                        except rbd.ImageBusy:
-                            log_msg = _("snapshot %s@%s could not be "
-                                        "unprotected because it is in use")
-                            LOG.error(log_msg % (loc.image, loc.snapshot))
-                            raise exception.InUseByStore()
-                        image.remove_snap(loc.snapshot)
-                try:
-                    rbd.RBD().remove(ioctx, str(loc.image))
-                except rbd.ImageNotFound:
-                    raise exception.NotFound(
-                        _('RBD image %s does not exist') % loc.image)
-                except rbd.ImageBusy:
-                    log_msg = _("image %s could not be removed"
-                                "because it is in use")
-                    LOG.error(log_msg % loc.image)
-                    raise exception.InUseByStore()
+        with _open_ioctx(self.conf_file, self.user,
+                         self.pool) as (conn, ioctx):
+            if loc.snapshot:
+                with rbd.Image(ioctx, loc.image) as image:
+                    try:
+                        image.unprotect_snap(loc.snapshot)
+                    except rbd.ImageBusy:
+                        log_msg = _("snapshot %s@%s could not be "
+                                    "unprotected because it is in use")
+                        LOG.error(log_msg % (loc.image, loc.snapshot))
+                        raise exception.InUseByStore()
+                    image.remove_snap(loc.snapshot)
+            try:
+                rbd.RBD().remove(ioctx, str(loc.image))
+            except rbd.ImageNotFound:
+                raise exception.NotFound(
+                    _('RBD image %s does not exist') % loc.image)
+            except rbd.ImageBusy:
+                log_msg = _("image %s could not be removed"
+                            "because it is in use")
+                LOG.error(log_msg % loc.image)
+                raise exception.InUseByStore()
@@ -20,9 +20,13 @@
 import hashlib
 import httplib
 import re
+import StringIO
+import sys
 import tempfile
 import urlparse
 
+import eventlet
+
 from glance.common import exception
 from glance.common import utils
 from glance.openstack.common import cfg
@@ -33,6 +37,20 @@ import glance.store.location
 
 LOG = logging.getLogger(__name__)
 
+DEFAULT_LARGE_OBJECT_SIZE = 100  # 100M
+DEFAULT_LARGE_OBJECT_CHUNK_SIZE = 10  # 10M
+DEFAULT_LARGE_OBJECT_CONCURRENCY = 4
+MIN_LARGE_OBJECT_CHUNK_SIZE = 5  # 5M, the smallest part S3 accepts
+MAX_LARGE_OBJECT_PARTS = 10000  # The most parts S3 accepts in an upload
+# The parts of an image of unknown size double in size every this many
+LARGE_OBJECT_PARTS_PER_DOUBLING = 1000
+DEFAULT_DOWNLOAD_CONCURRENCY = 1
+DEFAULT_DOWNLOAD_CHUNK_SIZE = 16  # 16M
+ONE_MB = 1024 * 1024
+
+# The largest object S3 copies in one request
+MAX_COPY_OBJECT_SIZE = 5 * 1024 * ONE_MB
+
 s3_opts = [
     cfg.StrOpt('s3_store_host'),
     cfg.StrOpt('s3_store_access_key', secret=True),
@@ -40,6 +58,16 @@ s3_opts = [
     cfg.StrOpt('s3_store_bucket'),
     cfg.StrOpt('s3_store_object_buffer_dir'),
     cfg.BoolOpt('s3_store_create_bucket_on_put', default=False),
+    cfg.IntOpt('s3_store_large_object_size',
+               default=DEFAULT_LARGE_OBJECT_SIZE),
+    cfg.IntOpt('s3_store_large_object_chunk_size',
+               default=DEFAULT_LARGE_OBJECT_CHUNK_SIZE),
+    cfg.IntOpt('s3_store_large_object_concurrency',
+               default=DEFAULT_LARGE_OBJECT_CONCURRENCY),
+    cfg.IntOpt('s3_store_download_concurrency',
+               default=DEFAULT_DOWNLOAD_CONCURRENCY),
+    cfg.IntOpt('s3_store_download_chunk_size',
+               default=DEFAULT_DOWNLOAD_CHUNK_SIZE),
     ]
 
 CONF = cfg.CONF
@@ -207,6 +235,11 @@ class Store(glance.store.base.Store):
     def get_schemes(self):
         return ('s3', 's3+http', 's3+https')
 
+    def configure(self):
+        self.download_concurrency = CONF.s3_store_download_concurrency
+        _download_chunk_size = CONF.s3_store_download_chunk_size
+        self.download_chunk_size = _download_chunk_size * ONE_MB
+
     def configure_add(self):
         """
         Configure the Store to use the stored configuration options
@@ -236,6 +269,19 @@ class Store(glance.store.base.Store):
 
         self.s3_store_object_buffer_dir = CONF.s3_store_object_buffer_dir
 
+        _obj_size = CONF.s3_store_large_object_size
+        self.large_object_size = _obj_size * ONE_MB
+        _obj_chunk_size = CONF.s3_store_large_object_chunk_size
+        if _obj_chunk_size < MIN_LARGE_OBJECT_CHUNK_SIZE:
+            reason = _("s3_store_large_object_chunk_size must be at "
+                       "least %d MB") % MIN_LARGE_OBJECT_CHUNK_SIZE
+            LOG.error(reason)
+            raise exception.BadStoreConfiguration(store_name="s3",
+                                                  reason=reason)
+        self.large_object_chunk_size = _obj_chunk_size * ONE_MB
+        self.large_object_concurrency = max(
+            1, CONF.s3_store_large_object_concurrency)
+
     def _option_get(self, param):
         result = getattr(CONF, param)
         if not result:
@@ -260,6 +306,23 @@ class Store(glance.store.base.Store):
 
         key.BufferSize = self.CHUNKSIZE
 
+        if (self.download_concurrency > 1 and
+            key.size > self.download_chunk_size):
+            class RangeIndexable(glance.store.Indexable):
+                def another(self):
+                    try:
+                        return self.wrapped.next()
+                    except StopIteration:
+                        return ''
+
+            def _fetch(start, end):
+                return get_key_range(key, start, end)
+
+            ranges = glance.store.iter_ranges_concurrently(
+                _fetch, key.size, self.download_chunk_size,
+                self.download_concurrency)
+            return (RangeIndexable(ranges, key.size), key.size)
+
         class ChunkedIndexable(glance.store.Indexable):
             def another(self):
                 return (self.wrapped.fp.read(ChunkedFile.CHUNKSIZE)
@@ -361,6 +424,17 @@ class Store(glance.store.base.Store):
                 'obj_name': obj_name})
         LOG.debug(msg)
 
+        if image_size == 0 or image_size >= self.large_object_size:
+            # The image is large, or of unknown size, so stream it to
+            # S3 as a multipart upload rather than spooling it to disk.
+            size, checksum_hex = self._add_multipart(bucket_obj, obj_name,
+                                                     image_file, image_size)
+
+            LOG.debug(_("Wrote %(size)d bytes to S3 key named %(obj_name)s "
+                        "with checksum %(checksum_hex)s") % locals())
+
+            return (loc.get_uri(), size, checksum_hex)
+
         key = bucket_obj.new_key(obj_name)
 
         # We need to wrap image_file, which is a reference to the
@@ -401,6 +475,167 @@ class Store(glance.store.base.Store):
 
         return (loc.get_uri(), size, checksum_hex)
 
+    def _part_size(self, image_size, part_num):
+        """
+        Returns the size of part `part_num` of a multipart upload of an
+        image of `image_size` bytes, or of unknown size if 0, so that
+        the image fits in the parts S3 allows.
+        """
+        if image_size:
+            return max(self.large_object_chunk_size,
+                       (image_size + MAX_LARGE_OBJECT_PARTS - 1) //
+                       MAX_LARGE_OBJECT_PARTS)
+        return self.large_object_chunk_size * 2 ** (
+            (part_num - 1) // LARGE_OBJECT_PARTS_PER_DOUBLING)
+
+    def _add_multipart(self, bucket_obj, obj_name, image_file, image_size):
+        """
+        Streams an image to S3 as a multipart upload, straight from
+        `image_file`, with up to ``s3_store_large_object_concurrency``
+        parts of ``s3_store_large_object_chunk_size`` being uploaded at
+        once. Only the parts in flight are held in memory.
+
+        Larger parts are used when the image would otherwise take more
+        parts than S3 allows, and when the size of the image is unknown
+        its parts grow as the upload goes on.
+
+        If any part fails, the multipart upload is aborted so S3 frees
+        the parts already stored, and the error is raised.
+
+        :retval tuple of (bytes written, md5 hexdigest of the image data)
+        """
+        checksum = hashlib.md5()
+        pool = eventlet.GreenPool(self.large_object_concurrency)
+        failures = []
+
+        mpu = bucket_obj.initiate_multipart_upload(obj_name)
+
+        def _upload_part(part_num, data):
+            try:
+                mpu.upload_part_from_file(StringIO.StringIO(data), part_num)
+                LOG.debug(_("Wrote part %(part_num)d of length %(length)d "
+                            "of S3 key named %(obj_name)s") %
+                          {'part_num': part_num, 'length': len(data),
+                           'obj_name': obj_name})
+            except Exception, e:
+                failures.append(e)
+
+        try:
+            size = 0
+            part_num = 1
+            pieces = []
+            buffered = 0
+            part_size = self._part_size(image_size, part_num)
+            read_size = min(self.CHUNKSIZE, self.large_object_chunk_size)
+            for chunk in utils.chunkreadable(image_file, read_size):
+                checksum.update(chunk)
+                size += len(chunk)
+                pieces.append(chunk)
+                buffered += len(chunk)
+                if buffered >= part_size:
+                    # Blocks until fewer than the maximum number of
+                    # parts are in flight.
+                    pool.spawn_n(_upload_part, part_num, ''.join(pieces))
+                    part_num += 1
+                    part_size = self._part_size(image_size, part_num)
+                    pieces = []
+                    buffered = 0
+                    if failures:
+                        break
+
+            # The final part may be smaller than the others, and an
+            # upload always needs at least one part, even if empty.
+            if not failures and (pieces or part_num == 1):
+                pool.spawn_n(_upload_part, part_num, ''.join(pieces))
+
+            pool.waitall()
+            if failures:
+                raise failures[0]
+
+            mpu.complete_upload()
+        except Exception:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            LOG.error(_("Failed to upload S3 key named %s, aborting the "
+                        "multipart upload") % obj_name)
+            pool.waitall()
+            try:
+                mpu.cancel_upload()
+            except Exception, e:
+                LOG.warn(_("Failed to abort the multipart upload of S3 key "
+                           "named %(obj_name)s: %(e)s") % locals())
+            raise exc_type, exc_value, exc_traceback
+
+        return size, checksum.hexdigest()
+
+    def copy(self, image_id, location, image_size):
+        """
+        Copies an object S3 holds for the same access key to a new object
+        with the supplied identifier, with a server-side copy, and returns
+        an `glance.store.ImageAddResult` object. The checksum in it is
+        None if the object was uploaded in parts, as its ETag isn't the
+        MD5 of its contents then.
+
+        :param image_id: The opaque image identifier
+        :param location: `glance.store.location.Location` object of the
+                         image to copy
+        :param image_size: The size of the image to copy, in bytes
+
+        :retval `glance.store.ImageAddResult` object
+        :raises `glance.common.exception.Duplicate` if the image already
+                existed
+        :raises NotImplementedError if the image's location doesn't
+                carry the store's own credentials or is too large to
+                copy in one request
+        """
+        from boto.s3.connection import S3Connection
+
+        src_loc = location.store_location
+        loc = StoreLocation({'scheme': self.scheme,
+                             'bucket': self.bucket,
+                             'key': image_id,
+                             's3serviceurl': self.full_s3_host,
+                             'accesskey': self.access_key,
+                             'secretkey': self.secret_key})
+        # The copy is made with the store's own credentials, so the
+        # location must carry all of them
+        if (src_loc.accesskey != loc.accesskey or
+            src_loc.secretkey != loc.secretkey or
+            src_loc.s3serviceurl != loc.s3serviceurl):
+            raise NotImplementedError
+
+        s3_conn = S3Connection(loc.accesskey, loc.secretkey,
+                               host=loc.s3serviceurl,
+                               is_secure=(loc.scheme == 's3+https'))
+
+        src_key = get_key(get_bucket(s3_conn, src_loc.bucket), src_loc.key)
+        if src_key.size > MAX_COPY_OBJECT_SIZE:
+            raise NotImplementedError
+
+        create_bucket_if_missing(self.bucket, s3_conn)
+
+        bucket_obj = get_bucket(s3_conn, self.bucket)
+        obj_name = str(image_id)
+
+        key = bucket_obj.get_key(obj_name)
+        if key and key.exists():
+            raise exception.Duplicate(_("S3 already has an image with "
+                                        "key %s") % obj_name)
+
+        msg = _("Copying image object in S3 from (bucket=%(src_bucket)s, "
+                "key=%(src_obj_name)s) to (bucket=%(bucket)s, "
+                "key=%(obj_name)s)") % ({'src_bucket': src_loc.bucket,
+                'src_obj_name': src_loc.key, 'bucket': self.bucket,
+                'obj_name': obj_name})
+        LOG.debug(msg)
+
+        bucket_obj.copy_key(obj_name, src_loc.bucket, src_loc.key)
+
+        checksum_hex = (src_key.etag or '').strip('"')
+        if not re.match('^[0-9a-f]{32}$', checksum_hex):
+            checksum_hex = None
+
+        return (loc.get_uri(), src_key.size, checksum_hex)
+
     def delete(self, location):
         """
         Takes a `glance.store.location.Location` object that indicates
@@ -510,3 +745,21 @@ def get_key(bucket, obj):
         LOG.error(msg)
         raise exception.NotFound(msg)
     return key
+
+
+def get_key_range(key, start, end):
+    """
+    Read a byte range of a key
+
+    :param key: The ``boto.s3.key.Key`` to read from
+    :param start: Offset of the first byte to read
+    :param end: Offset of the last byte to read
+    :retval The data in the range, as a string
+    """
+    from boto.s3.key import Key
+
+    # Each range is read through its own Key, since a Key holds on to the
+    # response it is currently reading from.
+    range_key = Key(key.bucket, key.name)
+    headers = {'Range': 'bytes=%d-%d' % (start, end)}
+    return range_key.get_contents_as_string(headers=headers)
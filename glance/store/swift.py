@@ -22,9 +22,13 @@ from __future__ import absolute_import
 import hashlib
 import httplib
 import math
+import re
 import urllib
 import urlparse
 
+import eventlet
+import eventlet.semaphore
+
 from glance.common import auth
 from glance.common import exception
 from glance.openstack.common import cfg
@@ -43,6 +47,11 @@ LOG = logging.getLogger(__name__)
 DEFAULT_CONTAINER = 'glance'
 DEFAULT_LARGE_OBJECT_SIZE = 5 * 1024  # 5GB
 DEFAULT_LARGE_OBJECT_CHUNK_SIZE = 200  # 200M
+DEFAULT_LARGE_OBJECT_CONCURRENCY = 1
+DEFAULT_LARGE_OBJECT_BUFFER_SIZE = 1024  # 1GB
+DEFAULT_LARGE_OBJECT_SEGMENT_RETRIES = 3
+DEFAULT_DOWNLOAD_CONCURRENCY = 1
+DEFAULT_DOWNLOAD_CHUNK_SIZE = 16  # 16M
 ONE_MB = 1000 * 1024
 
 swift_opts = [
@@ -57,6 +66,16 @@ swift_opts = [
                default=DEFAULT_LARGE_OBJECT_SIZE),
     cfg.IntOpt('swift_store_large_object_chunk_size',
                default=DEFAULT_LARGE_OBJECT_CHUNK_SIZE),
+    cfg.IntOpt('swift_store_large_object_concurrency',
+               default=DEFAULT_LARGE_OBJECT_CONCURRENCY),
+    cfg.IntOpt('swift_store_large_object_buffer_size',
+               default=DEFAULT_LARGE_OBJECT_BUFFER_SIZE),
+    cfg.IntOpt('swift_store_large_object_segment_retries',
+               default=DEFAULT_LARGE_OBJECT_SEGMENT_RETRIES),
+    cfg.IntOpt('swift_store_download_concurrency',
+               default=DEFAULT_DOWNLOAD_CONCURRENCY),
+    cfg.IntOpt('swift_store_download_chunk_size',
+               default=DEFAULT_DOWNLOAD_CHUNK_SIZE),
     cfg.BoolOpt('swift_store_create_container_on_put', default=False),
     cfg.BoolOpt('swift_store_multi_tenant', default=False),
     cfg.ListOpt('swift_store_admin_tenants', default=[]),
@@ -219,6 +238,9 @@ class Store(glance.store.base.Store):
         self.auth_version = self._option_get('swift_store_auth_version')
         self.storage_url = None
         self.token = None
+        self.download_concurrency = CONF.swift_store_download_concurrency
+        _download_chunk_size = CONF.swift_store_download_chunk_size
+        self.download_chunk_size = _download_chunk_size * ONE_MB
 
     def configure_add(self):
         """
@@ -253,6 +275,12 @@ class Store(glance.store.base.Store):
             self.large_object_size = _obj_size * ONE_MB
             _obj_chunk_size = CONF.swift_store_large_object_chunk_size
             self.large_object_chunk_size = _obj_chunk_size * ONE_MB
+            self.large_object_concurrency = \
+                    CONF.swift_store_large_object_concurrency
+            _buffer_size = CONF.swift_store_large_object_buffer_size
+            self.large_object_buffer_size = _buffer_size * ONE_MB
+            self.large_object_segment_retries = \
+                    CONF.swift_store_large_object_segment_retries
         except cfg.ConfigFileValueError, e:
             reason = _("Error in configuration conf: %s") % e
             LOG.error(reason)
@@ -284,7 +312,25 @@ class Store(glance.store.base.Store):
         loc = location.store_location
         swift_conn = self._swift_connection_for_location(loc)
 
+        class ResponseIndexable(glance.store.Indexable):
+            def another(self):
+                try:
+                    return self.wrapped.next()
+                except StopIteration:
+                    return ''
+
         try:
+            if self.download_concurrency > 1:
+                # Find out how big the object is, so that it can be read
+                # as a number of byte ranges in parallel. Ranged reads of
+                # a manifest object are served from its segments by Swift.
+                resp_headers = swift_conn.head_object(container=loc.container,
+                                                      obj=loc.obj)
+                length = resp_headers.get('content-length')
+                if int(length or 0) > self.download_chunk_size:
+                    resp_body = self._get_ranges(swift_conn, loc, int(length))
+                    return (ResponseIndexable(resp_body, length), length)
+
             (resp_headers, resp_body) = swift_conn.get_object(
                 container=loc.container, obj=loc.obj,
                 resp_chunk_size=self.CHUNKSIZE)
@@ -296,16 +342,50 @@ class Store(glance.store.base.Store):
             else:
                 raise
 
-        class ResponseIndexable(glance.store.Indexable):
-            def another(self):
-                try:
-                    return self.wrapped.next()
-                except StopIteration:
-                    return ''
-
         length = resp_headers.get('content-length')
         return (ResponseIndexable(resp_body, length), length)
 
+    def _get_ranges(self, swift_conn, loc, size):
+        """
+        Returns an iterator over the object's data which keeps up to
+        ``swift_store_download_concurrency`` ranged GETs of
+        ``swift_store_download_chunk_size`` bytes in flight, each over
+        its own HTTP connection.
+
+        :param swift_conn: An authenticated Swift connection
+        :param loc: The `StoreLocation` of the object
+        :param size: The size of the object in bytes
+        """
+        connections = []
+
+        def _fetch(start, end):
+            # A kept-alive connection may have been closed by the server
+            # since it was last used, so give each range one more try on
+            # a new connection before giving up.
+            for attempt in (1, 2):
+                if connections:
+                    http_conn = connections.pop()
+                else:
+                    http_conn = swiftclient.client.http_connection(
+                        swift_conn.url)
+                try:
+                    data = get_object_range(http_conn, swift_conn.token,
+                                            loc.container, loc.obj,
+                                            start, end)
+                    connections.append(http_conn)
+                    return data
+                except (swiftclient.ClientException, httplib.HTTPException,
+                        IOError), e:
+                    if attempt == 2:
+                        raise
+                    msg = _("Failed to read bytes %(start)d-%(end)d of "
+                            "%(obj)s from Swift, retrying: %(e)s")
+                    LOG.warn(msg % {'start': start, 'end': end,
+                                    'obj': loc.obj, 'e': e})
+
+        return glance.store.iter_ranges_concurrently(
+            _fetch, size, self.download_chunk_size, self.download_concurrency)
+
     def get_size(self, location):
         """
         Takes a `glance.store.location.Location` object that indicates
@@ -458,7 +538,6 @@ class Store(glance.store.base.Store):
                                                  content_length=image_size)
             else:
                 # Write the image into Swift in chunks.
-                chunk_id = 1
                 if image_size > 0:
                     total_chunks = str(int(
                         math.ceil(float(image_size) /
@@ -471,41 +550,15 @@ class Store(glance.store.base.Store):
                                 "segmented object to Swift."))
                     total_chunks = '?'
 
-                checksum = hashlib.md5()
-                combined_chunks_size = 0
-                while True:
-                    chunk_size = self.large_object_chunk_size
-                    if image_size == 0:
-                        content_length = None
-                    else:
-                        left = image_size - combined_chunks_size
-                        if left == 0:
-                            break
-                        if chunk_size > left:
-                            chunk_size = left
-                        content_length = chunk_size
-
-                    chunk_name = "%s-%05d" % (obj_name, chunk_id)
-                    reader = ChunkReader(image_file, checksum, chunk_size)
-                    chunk_etag = swift_conn.put_object(
-                        container, chunk_name, reader,
-                        content_length=content_length)
-                    bytes_read = reader.bytes_read
-                    msg = _("Wrote chunk %(chunk_name)s (%(chunk_id)d/"
-                            "%(total_chunks)s) of length %(bytes_read)d "
-                            "to Swift returning MD5 of content: "
-                            "%(chunk_etag)s")
-                    LOG.debug(msg % locals())
-
-                    if bytes_read == 0:
-                        # Delete the last chunk, because it's of zero size.
-                        # This will happen if image_size == 0.
-                        LOG.debug(_("Deleting final zero-length chunk"))
-                        swift_conn.delete_object(container, chunk_name)
-                        break
-
-                    chunk_id += 1
-                    combined_chunks_size += bytes_read
+                if self.large_object_concurrency > 1:
+                    combined_chunks_size, checksum = \
+                            self._add_segments_concurrently(
+                                swift_conn, container, obj_name,
+                                image_file, image_size, total_chunks)
+                else:
+                    combined_chunks_size, checksum = self._add_segments(
+                            swift_conn, container, obj_name, image_file,
+                            image_size, total_chunks)
 
                 # In the case we have been given an unknown image size,
                 # set the image_size to the total size of the combined chunks.
@@ -543,6 +596,263 @@ class Store(glance.store.base.Store):
             LOG.error(msg)
             raise glance.store.BackendException(msg)
 
+    def _add_segments(self, swift_conn, container, obj_name, image_file,
+                      image_size, total_chunks):
+        """
+        Writes the image to Swift as a series of segments, one at a time,
+        streaming each segment straight from `image_file`.
+
+        :retval tuple of (bytes written, md5 of the image data)
+        """
+        checksum = hashlib.md5()
+        combined_chunks_size = 0
+        chunk_id = 1
+        while True:
+            chunk_size = self.large_object_chunk_size
+            if image_size == 0:
+                content_length = None
+            else:
+                left = image_size - combined_chunks_size
+                if left == 0:
+                    break
+                if chunk_size > left:
+                    chunk_size = left
+                content_length = chunk_size
+
+            chunk_name = "%s-%05d" % (obj_name, chunk_id)
+            reader = ChunkReader(image_file, checksum, chunk_size)
+            chunk_etag = swift_conn.put_object(
+                container, chunk_name, reader,
+                content_length=content_length)
+            bytes_read = reader.bytes_read
+            msg = _("Wrote chunk %(chunk_name)s (%(chunk_id)d/"
+                    "%(total_chunks)s) of length %(bytes_read)d "
+                    "to Swift returning MD5 of content: "
+                    "%(chunk_etag)s")
+            LOG.debug(msg % locals())
+
+            if bytes_read == 0:
+                # Delete the last chunk, because it's of zero size.
+                # This will happen if image_size == 0.
+                LOG.debug(_("Deleting final zero-length chunk"))
+                swift_conn.delete_object(container, chunk_name)
+                break
+
+            chunk_id += 1
+            combined_chunks_size += bytes_read
+
+        return combined_chunks_size, checksum
+
+    def _add_segments_concurrently(self, swift_conn, container, obj_name,
+                                   image_file, image_size, total_chunks):
+        """
+        Writes the image to Swift as a series of segments, keeping up to
+        ``swift_store_large_object_concurrency`` segment PUTs in flight.
+
+        Each segment is read into one of a bounded number of in-memory
+        buffers, so the memory used is capped by
+        ``swift_store_large_object_buffer_size``. The image is read
+        sequentially, so the whole-image MD5 is computed in order. A
+        failed segment is retried on its own, up to
+        ``swift_store_large_object_segment_retries`` times. If a segment
+        still cannot be written, every segment already written is deleted
+        and the error is raised, so no manifest is ever written for a
+        partial image.
+
+        :retval tuple of (bytes written, md5 of the image data)
+        """
+        chunk_size = self.large_object_chunk_size
+        num_buffers = max(1, min(self.large_object_concurrency,
+                                 self.large_object_buffer_size / chunk_size))
+        buffers = eventlet.semaphore.Semaphore(num_buffers)
+        pool = eventlet.GreenPool(num_buffers)
+        connections = [swift_conn]
+        written = []
+        failures = []
+
+        def _put_segment(chunk_id, chunk_name, data):
+            if connections:
+                conn = connections.pop()
+            else:
+                conn = self._make_swift_connection(
+                    self.full_auth_address, self.user, self.key,
+                    storage_url=self.storage_url, token=self.token)
+            etag = hashlib.md5(data).hexdigest()
+            bytes_read = len(data)
+            try:
+                attempt = 0
+                while True:
+                    try:
+                        chunk_etag = conn.put_object(
+                            container, chunk_name, data,
+                            content_length=bytes_read, etag=etag)
+                        break
+                    except (swiftclient.ClientException, IOError), e:
+                        if (attempt >= self.large_object_segment_retries or
+                            getattr(e, 'http_status', None) ==
+                                httplib.CONFLICT):
+                            raise
+                        attempt += 1
+                        msg = _("Failed to write chunk %(chunk_name)s to "
+                                "Swift (attempt %(attempt)d), retrying: "
+                                "%(e)s")
+                        LOG.warn(msg % locals())
+                        conn = self._make_swift_connection(
+                            self.full_auth_address, self.user, self.key,
+                            storage_url=self.storage_url, token=self.token)
+                written.append(chunk_name)
+                connections.append(conn)
+                msg = _("Wrote chunk %(chunk_name)s (%(chunk_id)d/"
+                        "%(total_chunks)s) of length %(bytes_read)d "
+                        "to Swift returning MD5 of content: "
+                        "%(chunk_etag)s")
+                LOG.debug(msg % {'chunk_name': chunk_name,
+                                 'chunk_id': chunk_id,
+                                 'total_chunks': total_chunks,
+                                 'bytes_read': bytes_read,
+                                 'chunk_etag': chunk_etag})
+            except Exception, e:
+                failures.append(e)
+            finally:
+                buffers.release()
+
+        checksum = hashlib.md5()
+        combined_chunks_size = 0
+        chunk_id = 1
+        while not failures:
+            read_size = chunk_size
+            if image_size > 0:
+                read_size = min(read_size, image_size - combined_chunks_size)
+                if read_size == 0:
+                    break
+
+            # Wait for a free buffer before reading the next segment
+            buffers.acquire()
+            reader = ChunkReader(image_file, checksum, read_size)
+            pieces = []
+            while reader.bytes_read < read_size:
+                piece = reader.read(self.CHUNKSIZE)
+                if not piece:
+                    break
+                pieces.append(piece)
+            if not pieces:
+                buffers.release()
+                break
+
+            chunk_name = "%s-%05d" % (obj_name, chunk_id)
+            pool.spawn_n(_put_segment, chunk_id, chunk_name, ''.join(pieces))
+            chunk_id += 1
+            combined_chunks_size += reader.bytes_read
+
+        pool.waitall()
+
+        if failures:
+            for chunk_name in written:
+                try:
+                    swift_conn.delete_object(container, chunk_name)
+                except Exception:
+                    msg = _("Failed to delete chunk %(chunk_name)s after "
+                            "an aborted upload")
+                    LOG.warn(msg % locals())
+            raise failures[0]
+
+        return combined_chunks_size, checksum
+
+    def _in_same_account(self, loc):
+        """
+        Whether images can be copied from `loc` without the data. The copy
+        is made with the store's own credentials, so the location must
+        carry all of them, or in multi-tenant mode none, leaving Swift to
+        check the requester's token.
+        """
+        def _host_and_path(url):
+            return re.sub('^https?://', '', url or '').strip('/')
+
+        if self.multi_tenant:
+            user, key, auth_or_store_url = None, None, self.storage_url
+        else:
+            user, key, auth_or_store_url = (self.user, self.key,
+                                            self.auth_address)
+        return (loc.user == user and loc.key == key and
+                _host_and_path(loc.auth_or_store_url) ==
+                _host_and_path(auth_or_store_url))
+
+    def copy(self, image_id, location, image_size):
+        """
+        Copies an object in the same Swift account to a new object with
+        the supplied identifier, with a server-side copy, and returns an
+        `glance.store.ImageAddResult` object
+
+        :param image_id: The opaque image identifier
+        :param location: `glance.store.location.Location` object of the
+                         image to copy
+        :param image_size: The size of the image to copy, in bytes
+
+        :retval `glance.store.ImageAddResult` object
+        :raises `glance.common.exception.Duplicate` if the image already
+                existed
+        :raises NotImplementedError if the image is in another account or
+                is a large object, whose segments would be shared
+        """
+        loc = location.store_location
+        if not self._in_same_account(loc):
+            raise NotImplementedError
+
+        swift_conn = self._make_swift_connection(
+            self.full_auth_address, self.user, self.key,
+            storage_url=self.storage_url, token=self.token)
+
+        try:
+            headers = swift_conn.head_object(loc.container, loc.obj)
+        except swiftclient.ClientException, e:
+            if e.http_status == httplib.NOT_FOUND:
+                uri = location.get_store_uri()
+                raise exception.NotFound(_("Swift could not find image at "
+                                         "uri %(uri)s") % locals())
+            raise
+        if headers.get('x-object-manifest'):
+            raise NotImplementedError
+
+        obj_name = str(image_id)
+        if self.multi_tenant:
+            container = self.container + '_' + obj_name
+            auth_or_store_url = self.storage_url
+        else:
+            container = self.container
+            auth_or_store_url = self.auth_address
+
+        create_container_if_missing(container, swift_conn)
+
+        new_location = StoreLocation({'scheme': self.scheme,
+                                      'container': container,
+                                      'obj': obj_name,
+                                      'auth_or_store_url': auth_or_store_url,
+                                      'user': self.user,
+                                      'key': self.key})
+
+        LOG.debug(_("Copying image object '%(container)s/%(obj)s' to "
+                    "'%(obj_name)s' in Swift") %
+                  {'container': loc.container, 'obj': loc.obj,
+                   'obj_name': obj_name})
+        copy_from = '/%s/%s' % (urllib.quote(loc.container),
+                                urllib.quote(loc.obj))
+        try:
+            obj_etag = swift_conn.put_object(
+                container, obj_name, None,
+                headers={'X-Copy-From': copy_from})
+        except swiftclient.ClientException, e:
+            if e.http_status == httplib.CONFLICT:
+                raise exception.Duplicate(_("Swift already has an image at "
+                                          "location %s") %
+                                          new_location.get_uri())
+            msg = (_("Failed to copy object in Swift.\n"
+                     "Got error from Swift: %(e)s") % locals())
+            LOG.error(msg)
+            raise glance.store.BackendException(msg)
+
+        size = int(headers.get('content-length', image_size))
+        return (new_location.get_uri(), size, obj_etag)
+
     def delete(self, location):
         """
         Takes a `glance.store.location.Location` object that indicates
@@ -654,6 +964,46 @@ class ChunkReader(object):
         return result
 
 
+def get_object_range(http_conn, token, container, name, start, end):
+    """
+    Reads a byte range of an object from Swift.
+
+    :param http_conn: A (parsed url, HTTP connection) tuple as returned by
+                      ``swiftclient.http_connection``
+    :param token: The auth token to send, if any
+    :param container: Name of the container holding the object
+    :param name: Name of the object
+    :param start: Offset of the first byte to read
+    :param end: Offset of the last byte to read
+    :retval The data in the range, as a string
+    :raises ``swiftclient.ClientException`` if the range could not be read
+    """
+    parsed, conn = http_conn
+    path = '%s/%s/%s' % (parsed.path.rstrip('/'), urllib.quote(container),
+                         urllib.quote(name))
+    headers = {'Range': 'bytes=%d-%d' % (start, end)}
+    if token:
+        headers['X-Auth-Token'] = token
+    conn.request('GET', path, '', headers)
+    resp = conn.getresponse()
+    body = resp.read()
+    if resp.status < 200 or resp.status >= 300:
+        raise swiftclient.ClientException('Object GET failed',
+                                          http_path=path,
+                                          http_status=resp.status,
+                                          http_reason=resp.reason)
+    if len(body) != end - start + 1:
+        # The server ignored the Range header, or the connection was
+        # cut short; either way this is not the data we asked for.
+        raise swiftclient.ClientException('Object GET returned %d bytes '
+                                          'for a range of %d bytes' %
+                                          (len(body), end - start + 1),
+                                          http_path=path,
+                                          http_status=resp.status,
+                                          http_reason=resp.reason)
+    return body
+
+
 def create_container_if_missing(container, swift_conn):
     """
     Creates a missing container in Swift if the
@@ -191,6 +191,23 @@ class BaseTestCase(object):
                              filters={'properties': {'poo': 'bear'}})
         self.assertEquals(len(images), 0)
 
+    def test_image_get_all_with_filter_multiple_properties(self):
+        for (image_id, name, value) in ((UUID1, 'os_distro', 'ubuntu'),
+                                        (UUID1, 'arch', 'x86_64'),
+                                        (UUID2, 'os_distro', 'ubuntu'),
+                                        (UUID2, 'arch', 'i686'),
+                                        (UUID3, 'arch', 'x86_64')):
+            fixture = {'name': name, 'value': value, 'image_id': image_id}
+            self.db_api.image_property_create(self.context, fixture)
+
+        filters = {'properties': {'os_distro': 'ubuntu', 'arch': 'x86_64'}}
+        images = self.db_api.image_get_all(self.context, filters=filters)
+        self.assertEquals([UUID1], [i['id'] for i in images])
+
+        filters = {'properties': {'os_distro': 'ubuntu'}}
+        images = self.db_api.image_get_all(self.context, filters=filters)
+        self.assertEquals(set([UUID1, UUID2]), set(i['id'] for i in images))
+
     def test_image_get_all_with_filter_undefined_property(self):
         images = self.db_api.image_get_all(self.context,
                                       filters={'poo': 'bear'})
@@ -307,6 +324,15 @@ class BaseTestCase(object):
         tag = self.db_api.image_tag_create(self.context, UUID1, 'snap')
         self.assertEqual('snap', tag)
 
+    def test_image_tag_get_all_by_images(self):
+        self.db_api.image_tag_create(self.context, UUID1, 'snap')
+        self.db_api.image_tag_create(self.context, UUID1, 'snarf')
+        self.db_api.image_tag_create(self.context, UUID2, 'snarf')
+
+        tags = self.db_api.image_tag_get_all_by_images(self.context,
+                                                       [UUID1, UUID3])
+        self.assertEqual({UUID1: ['snap', 'snarf'], UUID3: []}, tags)
+
     def test_image_tag_get_all(self):
         self.db_api.image_tag_create(self.context, UUID1, 'snap')
         self.db_api.image_tag_create(self.context, UUID1, 'snarf')
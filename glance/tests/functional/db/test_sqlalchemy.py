@@ -14,10 +14,17 @@
 #    under the License.
 
 
+import os
+import time
+
+import stubout
+
+import glance.context
 import glance.db.sqlalchemy.api
 from glance.db.sqlalchemy import models as db_models
 import glance.tests.functional.db as tests
 from glance.tests.unit import base
+from glance.tests import utils as test_utils
 
 
 class TestSqlalchemyDriver(base.IsolatedUnitTest, tests.BaseTestCase):
@@ -36,3 +43,135 @@ class TestSqlalchemyDriver(base.IsolatedUnitTest, tests.BaseTestCase):
     def reset(self):
         db_models.unregister_models(self.db_api._ENGINE)
         db_models.register_models(self.db_api._ENGINE)
+
+
+class TestSqlalchemyDriverWithoutRowValues(TestSqlalchemyDriver):
+    """
+    Runs the same tests paginating with the expanded marker predicate used
+    on databases without row values, loading each page an image at a time
+    and filtering on properties as if every value were common
+    """
+
+    def configure(self):
+        super(TestSqlalchemyDriverWithoutRowValues, self).configure()
+        self.stubs.Set(self.db_api, '_supports_row_values',
+                       lambda query: False)
+        self.stubs.Set(self.db_api, 'IMAGE_LOAD_BATCH_SIZE', 1)
+        self.stubs.Set(self.db_api, 'PROPERTY_FILTER_SELECTIVE_ROWS', 0)
+
+
+class TestSqlalchemyDriverWithReadReplica(TestSqlalchemyDriver):
+    """
+    Runs the same tests with reads routed to a replica, which is the
+    primary database reached through a second engine
+    """
+
+    def configure(self):
+        self.db_api = glance.db.sqlalchemy.api
+        for name in ('_ENGINE', '_MAKER', '_READ_MAKER_CYCLE'):
+            self.stubs.Set(self.db_api, name, None)
+        self.stubs.Set(self.db_api, '_READ_MAKERS', [])
+        self.stubs.Set(self.db_api, '_POOL_STATS', {})
+        self.stubs.Set(self.db_api, '_RECENT_WRITES', {})
+        self.stubs.Set(self.db_api, '_RECENT_WRITE_EXPIRY',
+                       self.db_api.collections.deque())
+
+        sql_connection = 'sqlite:///%s' % os.path.join(self.test_dir,
+                                                        'glance.sqlite')
+        self.config(sql_connection=sql_connection,
+                    sql_read_connections=[sql_connection],
+                    verbose=False,
+                    debug=False)
+        self.db_api.configure_db()
+
+    def _forget_writes(self):
+        self.db_api._RECENT_WRITES.clear()
+        self.db_api._RECENT_WRITE_EXPIRY.clear()
+
+    def _reads(self):
+        stats = self.db_api.get_pool_stats()
+        return stats['primary']['reads'], stats['replica-0']['reads']
+
+    def test_reads_routed_to_replica(self):
+        ctxt = glance.context.RequestContext(tenant='tenant1')
+        self._forget_writes()
+        before = self._reads()
+        self.db_api.image_get_all(ctxt)
+        self.db_api.image_tag_get_all(ctxt, tests.UUID1)
+        self.assertEqual((before[0], before[1] + 2), self._reads())
+
+    def test_reads_after_write_routed_to_primary(self):
+        owner = glance.context.RequestContext(tenant='tenant1')
+        other = glance.context.RequestContext(tenant='tenant2')
+        self._forget_writes()
+        self.db_api.image_tag_create(owner, tests.UUID1, 'ping')
+
+        before = self._reads()
+        # The tenant and the image it wrote to read from the primary
+        # database
+        self.db_api.image_get_all(owner)
+        self.db_api.image_get_all(glance.context.RequestContext(
+                tenant='tenant1'))
+        self.db_api.image_tag_get_all(other, tests.UUID1)
+        self.assertEqual((before[0] + 3, before[1]), self._reads())
+
+        # Other tenants' reads of other images don't
+        self.db_api.image_tag_get_all(other, tests.UUID2)
+        self.assertEqual((before[0] + 3, before[1] + 1), self._reads())
+
+    def test_reads_after_write_window_routed_to_replica(self):
+        self.config(sql_read_after_write_window=0)
+        ctxt = glance.context.RequestContext(tenant='tenant1')
+        self._forget_writes()
+        self.db_api.image_tag_create(ctxt, tests.UUID1, 'ping')
+
+        before = self._reads()
+        self.db_api.image_tag_get_all(ctxt, tests.UUID1)
+        self.assertEqual((before[0], before[1] + 1), self._reads())
+
+    def test_pool_stats(self):
+        stats = self.db_api.get_pool_stats()
+        self.assertEqual(['primary', 'replica-0'], sorted(stats.keys()))
+        self.assertTrue(stats['primary']['checkouts'] > 0)
+        self.assertTrue(stats['replica-0']['checkouts'] > 0)
+
+
+class FakeConnectionRecord(object):
+
+    def __init__(self):
+        self.info = {}
+
+
+class TestIdlePingListener(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestIdlePingListener, self).setUp()
+        self.stubs = stubout.StubOutForTesting()
+        self.addCleanup(self.stubs.UnsetAll)
+        self.pinged = []
+        self.stubs.Set(glance.db.sqlalchemy.api, 'ping_listener',
+                       lambda *args: self.pinged.append(args))
+        self.stats = {'pings': 0}
+        self.listener = glance.db.sqlalchemy.api.idle_ping_listener(
+                30, self.stats)
+        self.connection_rec = FakeConnectionRecord()
+
+    def _idle_for(self, seconds):
+        self.connection_rec.info['idle_since'] = time.time() - seconds
+
+    def test_ping_after_idle(self):
+        self._idle_for(60)
+        self.listener('conn', self.connection_rec, 'proxy')
+        self.assertEqual([('conn', self.connection_rec, 'proxy')],
+                         self.pinged)
+        self.assertEqual(1, self.stats['pings'])
+
+    def test_no_ping_when_recently_used(self):
+        self._idle_for(1)
+        self.listener('conn', self.connection_rec, 'proxy')
+        self.assertEqual([], self.pinged)
+        self.assertEqual(0, self.stats['pings'])
+
+    def test_ping_when_idle_time_unknown(self):
+        self.listener('conn', self.connection_rec, 'proxy')
+        self.assertEqual(1, self.stats['pings'])
@@ -13,9 +13,15 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import os
+import StringIO
+
 import webob
 
 import glance.api.middleware.cache
+from glance.common import wsgi
+from glance import context
+from glance import registry
 from glance.tests.unit import base
 
 
@@ -23,8 +29,9 @@ class ChecksumTestCacheFilter(glance.api.middleware.cache.CacheFilter):
     def __init__(self):
         class DummyCache(object):
             def get_caching_iter(self, image_id, image_checksum,
-                    app_iter):
+                    app_iter, image_meta=None):
                 self.image_checksum = image_checksum
+                self.image_meta = image_meta
 
         self.cache = DummyCache()
 
@@ -45,6 +52,25 @@ class TestCacheMiddleware(base.IsolatedUnitTest):
         out = glance.api.middleware.cache.CacheFilter._match_request(req)
         self.assertEqual(out, ('v1', 'GET', 'asdf'))
 
+    def test_match_v2_file(self):
+        req = webob.Request.blank('/v2/images/asdf/file')
+        out = glance.api.middleware.cache.CacheFilter._match_request(req)
+        self.assertEqual(out, ('v2', 'GET', 'asdf'))
+
+    def test_no_match_v2_metadata(self):
+        req = webob.Request.blank('/v2/images/asdf')
+        out = glance.api.middleware.cache.CacheFilter._match_request(req)
+        self.assertTrue(out is None)
+
+    def test_match_metadata_update(self):
+        req = webob.Request.blank('/v1/images/asdf', method='PUT')
+        out = glance.api.middleware.cache.CacheFilter._match_request(req)
+        self.assertEqual(out, ('v1', 'PUT', 'asdf'))
+
+        req = webob.Request.blank('/v2/images/asdf', method='PATCH')
+        out = glance.api.middleware.cache.CacheFilter._match_request(req)
+        self.assertEqual(out, ('v2', 'PUT', 'asdf'))
+
     def test_checksum_v1_header(self):
         cache_filter = ChecksumTestCacheFilter()
         headers = {"x-image-meta-checksum": "1234567890"}
@@ -52,6 +78,20 @@ class TestCacheMiddleware(base.IsolatedUnitTest):
         cache_filter._process_GET_response(resp, None)
 
         self.assertEqual("1234567890", cache_filter.cache.image_checksum)
+        self.assertEqual(None, cache_filter.cache.image_meta)
+
+    def test_image_meta_v1_headers(self):
+        cache_filter = ChecksumTestCacheFilter()
+        headers = {"x-image-meta-id": "asdf",
+                   "x-image-meta-size": "5",
+                   "x-image-meta-property-distro": "Ubuntu"}
+        resp = webob.Response(headers=headers)
+        cache_filter._process_GET_response(resp, None)
+
+        image_meta = cache_filter.cache.image_meta
+        self.assertEqual("asdf", image_meta['id'])
+        self.assertEqual(5, image_meta['size'])
+        self.assertEqual({'distro': 'Ubuntu'}, image_meta['properties'])
 
     def test_checksum_v2_header(self):
         cache_filter = ChecksumTestCacheFilter()
@@ -70,3 +110,93 @@ class TestCacheMiddleware(base.IsolatedUnitTest):
         cache_filter._process_GET_response(resp, None)
 
         self.assertEqual(None, cache_filter.cache.image_checksum)
+
+
+class TestCacheMiddlewareHit(base.IsolatedUnitTest):
+
+    image_id = 'c80a1a6c-bd1f-41c5-90ee-81afedb1d58d'
+
+    def setUp(self):
+        super(TestCacheMiddlewareHit, self).setUp()
+        self.config(image_cache_dir=os.path.join(self.test_dir, 'cache'),
+                    image_cache_driver='sqlite',
+                    image_cache_metadata_sidecar=True)
+        self.cache_filter = glance.api.middleware.cache.CacheFilter(None)
+        self.cache = self.cache_filter.cache
+        self.cache.cache_image_file(self.image_id,
+                                    StringIO.StringIO('*' * 5))
+
+        self.registry_calls = []
+
+        def fake_get_image_metadata(context, image_id):
+            self.registry_calls.append(image_id)
+            return self._image_meta(is_public=False, owner='tenant1')
+
+        self.stubs.Set(registry, 'get_image_metadata',
+                       fake_get_image_metadata)
+
+    def _image_meta(self, **kwargs):
+        image_meta = {'id': self.image_id, 'status': 'active',
+                      'size': 5, 'checksum': None, 'properties': {},
+                      'location': 'file:///tmp/%s' % self.image_id}
+        image_meta.update(kwargs)
+        return image_meta
+
+    def _get(self, tenant, environ=None):
+        req = webob.Request.blank('/v1/images/%s' % self.image_id,
+                                  environ=environ)
+        req.context = context.RequestContext(tenant=tenant)
+        return self.cache_filter.process_request(req)
+
+    def test_hit_served_with_file_wrapper(self):
+        environ = {'wsgi.file_wrapper': wsgi.FileWrapper}
+        resp = self._get('tenant1', environ)
+
+        self.assertTrue(isinstance(resp.app_iter, wsgi.FileWrapper))
+        self.assertEqual(5, resp.headers['Content-Length'])
+        self.assertEqual('*' * 5, ''.join(resp.app_iter))
+        self.assertEqual(0, self.cache.get_hit_count(self.image_id))
+        resp.app_iter.close()
+        self.assertEqual(1, self.cache.get_hit_count(self.image_id))
+
+    def test_partial_send_with_file_wrapper_not_counted(self):
+        environ = {'wsgi.file_wrapper': wsgi.FileWrapper}
+        resp = self._get('tenant1', environ)
+        resp.app_iter.close()
+        self.assertEqual(0, self.cache.get_hit_count(self.image_id))
+
+    def test_hit_served_from_sidecar(self):
+        self.cache.set_image_metadata(self.image_id,
+                                      self._image_meta(is_public=True))
+
+        resp = self._get('tenant2')
+
+        self.assertEqual([], self.registry_calls)
+        self.assertEqual(self.image_id, resp.headers['x-image-meta-id'])
+        self.assertEqual('*' * 5, ''.join(resp.app_iter))
+
+    def test_hit_not_visible_from_sidecar_uses_registry(self):
+        self.cache.set_image_metadata(
+                self.image_id, self._image_meta(is_public=False,
+                                                owner='tenant1'))
+
+        resp = self._get('tenant2')
+
+        self.assertEqual([self.image_id], self.registry_calls)
+        self.assertFalse('x-image-meta-location' in resp.headers)
+
+    def test_hit_without_sidecar_writes_sidecar(self):
+        self._get('tenant1')
+        self._get('tenant1')
+
+        self.assertEqual([self.image_id], self.registry_calls)
+        image_meta = self.cache.get_image_metadata(self.image_id)
+        self.assertFalse('location' in image_meta)
+
+    def test_metadata_update_drops_sidecar(self):
+        self.cache.set_image_metadata(self.image_id, self._image_meta())
+        resp = webob.Response()
+        self.cache_filter._process_PUT_response(resp, self.image_id)
+
+        self.assertEqual(None, self.cache.get_image_metadata(self.image_id))
+        self.assertTrue(self.cache.is_cached(self.image_id))
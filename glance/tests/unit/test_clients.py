@@ -16,8 +16,13 @@
 #    under the License.
 
 import datetime
+import errno
+import httplib
 import os
+import socket
+import StringIO
 import tempfile
+import urlparse
 
 from glance import client
 from glance.common import client as base_client
@@ -227,6 +232,19 @@ class TestRegistryClient(base.IsolatedUnitTest):
         self.assertEqual(0, image["min_ram"])
         self.assertEqual(0, image["min_disk"])
 
+    def test_connection_pool(self):
+        """Test that a pooled connection is reused across requests"""
+        pool = base_client.ConnectionPool()
+        self.client = rclient.RegistryClient("0.0.0.0",
+                                             connection_pool=pool)
+        self.client.get_images()
+        self.client.get_images()
+
+        stats = pool.get_stats()
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(0, stats['in_use'])
+
     def test_get_index_sort_name_asc(self):
         """
         Tests that the /images registry API returns list of
@@ -2122,6 +2140,126 @@ class TestClient(base.IsolatedUnitTest):
         self.assertTrue(self.client.delete_member(UUID2, 'pattieblack'))
 
 
+class FakeConnection(object):
+
+    def __init__(self, host, port, **kwargs):
+        self.host = host
+        self.port = port
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestConnectionPool(test_utils.BaseTestCase):
+
+    def test_reuses_idle_connection(self):
+        pool = base_client.ConnectionPool()
+        conn, reused = pool.get(FakeConnection, 'localhost', 9191, {})
+        self.assertFalse(reused)
+        pool.put(conn)
+
+        conn2, reused = pool.get(FakeConnection, 'localhost', 9191, {})
+        self.assertTrue(reused)
+        self.assertTrue(conn2 is conn)
+        pool.put(conn2)
+
+        stats = pool.get_stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(0.5, stats['hit_rate'])
+        self.assertEqual(1, stats['idle'])
+        self.assertEqual(0, stats['in_use'])
+
+    def test_connections_keyed_by_endpoint(self):
+        pool = base_client.ConnectionPool()
+        conn, reused = pool.get(FakeConnection, 'localhost', 9191, {})
+        pool.put(conn)
+
+        conn2, reused = pool.get(FakeConnection, 'localhost', 9191,
+                                 {'key_file': 'key.pem'})
+        self.assertFalse(reused)
+        conn3, reused = pool.get(FakeConnection, 'otherhost', 9191, {})
+        self.assertFalse(reused)
+
+    def test_not_reusable_connection_closed(self):
+        pool = base_client.ConnectionPool()
+        conn, reused = pool.get(FakeConnection, 'localhost', 9191, {})
+        pool.put(conn, reusable=False)
+        self.assertTrue(conn.closed)
+        self.assertEqual(0, pool.get_stats()['idle'])
+
+    def test_max_size(self):
+        pool = base_client.ConnectionPool(max_size=1)
+        conn, reused = pool.get(FakeConnection, 'localhost', 9191, {})
+        conn2, reused = pool.get(FakeConnection, 'localhost', 9191, {})
+        pool.put(conn)
+        pool.put(conn2)
+        self.assertFalse(conn.closed)
+        self.assertTrue(conn2.closed)
+
+    def test_expired_connection_discarded(self):
+        pool = base_client.ConnectionPool(max_idle_time=-1)
+        conn, reused = pool.get(FakeConnection, 'localhost', 9191, {})
+        pool.put(conn)
+
+        conn2, reused = pool.get(FakeConnection, 'localhost', 9191, {})
+        self.assertFalse(reused)
+        self.assertTrue(conn.closed)
+        self.assertEqual(1, pool.get_stats()['discarded'])
+
+
+class StaleConnection(FakeConnection):
+
+    """A connection whose server closes it after one response"""
+
+    fail_on_send = False
+
+    def request(self, method, path, body, headers):
+        self.requests = getattr(self, 'requests', 0) + 1
+        if self.requests > 1 and self.fail_on_send:
+            raise socket.error(errno.EPIPE, 'Broken pipe')
+
+    def getresponse(self):
+        if self.requests > 1:
+            raise httplib.BadStatusLine('')
+        return StringIO.StringIO('ok')
+
+
+class TestPooledRequest(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestPooledRequest, self).setUp()
+        self.pool = base_client.ConnectionPool()
+        self.client = base_client.BaseClient('localhost',
+                                             connection_pool=self.pool)
+        self.url = urlparse.urlparse('http://localhost:9191')
+        self.request('GET')
+
+    def tearDown(self):
+        super(TestPooledRequest, self).tearDown()
+        StaleConnection.fail_on_send = False
+
+    def request(self, method):
+        return self.client._do_pooled_request(StaleConnection, self.url,
+                                              method, '/images', None, {})
+
+    def test_idempotent_request_retried(self):
+        for method in ('GET', 'HEAD'):
+            self.assertEqual('ok', self.request(method).read())
+        self.assertEqual(3, self.pool.get_stats()['misses'])
+
+    def test_sent_request_not_retried(self):
+        for method in ('POST', 'PUT', 'DELETE'):
+            self.assertRaises(httplib.BadStatusLine, self.request, method)
+            self.request('GET')
+
+    def test_unsent_request_retried(self):
+        StaleConnection.fail_on_send = True
+        self.assertEqual('ok', self.request('POST').read())
+        self.assertEqual(2, self.pool.get_stats()['misses'])
+
+
 class TestConfigureClientFromURL(test_utils.BaseTestCase):
 
     def setUp(self):
@@ -19,10 +19,12 @@
 
 import errno
 import hashlib
+import os
 import StringIO
 
 from glance.common import exception
 from glance.common import utils
+import glance.store.filesystem
 from glance.store.filesystem import Store, ChunkedFile
 from glance.store.location import get_location_from_uri
 from glance.tests.unit import base
@@ -149,6 +151,8 @@ class TestStore(base.IsolatedUnitTest):
         self.assertRaises(exception,
                           self.store.add,
                           image_id, image_file, 0)
+        self.assertEqual([], [f for f in os.listdir(self.test_dir)
+                              if image_id in f])
 
     def test_add_storage_full(self):
         """
@@ -178,6 +182,159 @@ class TestStore(base.IsolatedUnitTest):
         """
         self._do_test_add_failure(errno.ENOTDIR, IOError)
 
+    def _do_test_add_data(self, file_contents, image_size):
+        image_id = utils.generate_uuid()
+        image_file = StringIO.StringIO(file_contents)
+
+        location, size, checksum = self.store.add(image_id,
+                                                  image_file,
+                                                  image_size)
+
+        self.assertEquals(len(file_contents), size)
+        self.assertEquals(hashlib.md5(file_contents).hexdigest(), checksum)
+        filepath = os.path.join(self.test_dir, image_id)
+        self.assertEquals(file_contents, open(filepath, 'rb').read())
+        self.assertEqual([image_id], [f for f in os.listdir(self.test_dir)
+                                      if image_id in f])
+
+    def test_add_preallocated(self):
+        """
+        Tests that a preallocated image file is cut down to the size of
+        the data written to it
+        """
+        self.config(filesystem_store_preallocate=True)
+        self.store = Store()
+        ChunkedFile.CHUNKSIZE = 1024
+        file_contents = "*" * 1024 * 5
+        self._do_test_add_data(file_contents, len(file_contents))
+        self._do_test_add_data(file_contents, len(file_contents) * 2)
+
+    def test_add_synced(self):
+        """
+        Tests that the data is synced and dropped from the page cache as
+        it is written, when configured to
+        """
+        self.config(filesystem_store_write_size=4,
+                    filesystem_store_fsync=True,
+                    filesystem_store_drop_cache=True)
+        self.store = Store()
+        self.store.sync_interval = 8192
+        syncs = []
+        dropped = []
+
+        def fake_fdatasync(fd):
+            syncs.append(os.fstat(fd).st_size)
+
+        def fake_drop_cache(fd, offset, length):
+            dropped.append((offset, length))
+
+        self.stubs.Set(glance.store.filesystem, '_fdatasync', fake_fdatasync)
+        self.stubs.Set(glance.store.filesystem, '_drop_cache',
+                       fake_drop_cache)
+
+        ChunkedFile.CHUNKSIZE = 1000
+        self._do_test_add_data("*" * 20000, 20000)
+
+        self.assertEqual([8192, 16384], syncs)
+        self.assertEqual([(0, 8192), (8192, 8192), (16384, 0)], dropped)
+
+    def test_write_chunks(self):
+        """Tests that data is written in whole multiples of blocks"""
+        chunks = ['a' * 3, 'b' * 3, 'c' * 7, 'd']
+        pieces = list(glance.store.filesystem._write_chunks(chunks, 4))
+        self.assertEqual(['aaab', 'bbcccccc', 'cd'], pieces)
+
+    def _configure_datadirs(self, weights, placement='free_space'):
+        datadirs = [os.path.join(self.test_dir, 'disk%d' % i)
+                    for i in range(len(weights))]
+        self.config(filesystem_store_datadirs=[
+                        '%s:%d' % (datadir, weight)
+                        for datadir, weight in zip(datadirs, weights)],
+                    filesystem_store_placement=placement)
+        self.store = Store()
+        return datadirs
+
+    def _add_images(self, count):
+        image_ids = []
+        for i in range(count):
+            image_id = utils.generate_uuid()
+            self.store.add(image_id, StringIO.StringIO("*" * 10), 10)
+            image_ids.append(image_id)
+        return image_ids
+
+    def test_add_hash_placement(self):
+        """
+        Tests that images are spread over the data directories by hash
+        """
+        datadirs = self._configure_datadirs([1, 1], placement='hash')
+
+        for image_id in self._add_images(20):
+            expected = max(datadirs, key=lambda d:
+                glance.store.filesystem._hash_score(image_id, d, 1))
+            self.assertTrue(os.path.exists(os.path.join(expected, image_id)))
+
+        for datadir in datadirs:
+            self.assertTrue(os.listdir(datadir))
+
+    def test_add_free_space_placement(self):
+        """
+        Tests that images are only placed in data directories with room
+        and weight
+        """
+        datadirs = self._configure_datadirs([1, 0, 1])
+        free = {datadirs[0]: 0, datadirs[1]: 100, datadirs[2]: 100}
+        self.stubs.Set(glance.store.filesystem, '_disk_usage',
+                       lambda path: (100, free[path]))
+
+        self._add_images(10)
+
+        self.assertEqual([], os.listdir(datadirs[0]))
+        self.assertEqual([], os.listdir(datadirs[1]))
+        self.assertEqual(10, len(os.listdir(datadirs[2])))
+
+    def test_add_no_room(self):
+        """
+        Tests that adding an image no data directory has room for raises
+        an appropriate exception
+        """
+        datadirs = self._configure_datadirs([1, 1])
+        self.stubs.Set(glance.store.filesystem, '_disk_usage',
+                       lambda path: (100, 5))
+        self.assertRaises(exception.StorageFull, self._add_images, 1)
+
+    def test_get_from_other_datadir(self):
+        """
+        Tests that an image moved to another data directory can still be
+        read and deleted
+        """
+        datadirs = self._configure_datadirs([1, 0])
+        image_id = self._add_images(1)[0]
+        os.rename(os.path.join(datadirs[0], image_id),
+                  os.path.join(datadirs[1], image_id))
+
+        loc = get_location_from_uri("file://%s/%s" % (datadirs[0], image_id))
+        (image_file, image_size) = self.store.get(loc)
+        self.assertEqual("*" * 10, ''.join(image_file))
+
+        self.store.delete(loc)
+        self.assertRaises(exception.NotFound, self.store.get, loc)
+
+    def test_get_stats(self):
+        """Tests that the utilization of each data directory is reported"""
+        datadirs = self._configure_datadirs([2, 1])
+        self.stubs.Set(glance.store.filesystem, '_disk_usage',
+                       lambda path: (100, 40))
+
+        stats = self.store.get_stats()
+
+        self.assertEqual('free_space', stats['placement'])
+        self.assertEqual([{'path': datadirs[0], 'weight': 2,
+                           'total_bytes': 100, 'free_bytes': 40,
+                           'used_bytes': 60},
+                          {'path': datadirs[1], 'weight': 1,
+                           'total_bytes': 100, 'free_bytes': 40,
+                           'used_bytes': 60}], stats['datadirs'])
+
     def test_delete(self):
         """
         Test we can delete an existing image in the filesystem store
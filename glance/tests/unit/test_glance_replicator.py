@@ -15,11 +15,18 @@
 #    under the License.
 
 import copy
+import hashlib
 import imp
 import json
 import os
+import shutil
 import StringIO
 import sys
+import tarfile
+import tempfile
+import threading
+
+import stubout
 
 from glance.tests import utils as test_utils
 
@@ -209,3 +216,347 @@ class ImageServiceTestCase(test_utils.BaseTestCase):
         headers, body = c.add_image(IMG_RESPONSE_ACTIVE, image_body)
         self.assertEquals(headers, IMG_RESPONSE_ACTIVE)
         self.assertEquals(c.conn.count, 1)
+
+
+class FakeOptions(object):
+    def __init__(self, **kwargs):
+        self.dontreplicate = 'created_at date deleted_at location updated_at'
+        self.metaonly = False
+        self.retries = 3
+        self.__dict__.update(kwargs)
+
+
+class LivecopyTestCase(test_utils.BaseTestCase):
+    def setUp(self):
+        super(LivecopyTestCase, self).setUp()
+        self.stubs = stubout.StubOutForTesting()
+        self.addCleanup(self.stubs.UnsetAll)
+        self.stubs.Set(glance_replicator.time, 'sleep', lambda secs: None)
+        self.journal_path = os.path.join(tempfile.mkdtemp(), 'journal')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.journal_path))
+
+    def test_journal_resumes(self):
+        journal = glance_replicator.LivecopyJournal(self.journal_path)
+        self.assertFalse(journal.is_done(IMG_RESPONSE_ACTIVE))
+        journal.record(IMG_RESPONSE_ACTIVE)
+        journal.close()
+
+        # A run killed mid-write leaves a partial line behind
+        with open(self.journal_path, 'a') as f:
+            f.write(IMG_RESPONSE_QUEUED['id'])
+
+        journal = glance_replicator.LivecopyJournal(self.journal_path)
+        self.assertTrue(journal.is_done(IMG_RESPONSE_ACTIVE))
+        self.assertFalse(journal.is_done(IMG_RESPONSE_QUEUED))
+
+        changed = copy.copy(IMG_RESPONSE_ACTIVE)
+        changed['updated_at'] = '2012-07-01T00:00:00'
+        self.assertFalse(journal.is_done(changed))
+        journal.close()
+
+    def test_progress(self):
+        progress = glance_replicator.LivecopyProgress([IMG_RESPONSE_ACTIVE,
+                                                       IMG_RESPONSE_QUEUED])
+        self.assertEqual(2, progress.images_total)
+        self.assertEqual(4660272, progress.bytes_remaining)
+
+        reader = glance_replicator.CountingReader(
+                StringIO.StringIO('x' * 10), progress.transferred)
+        reader.read(4)
+        reader.read()
+        self.assertEqual(10, progress.bytes_transferred)
+
+        progress.finished(IMG_RESPONSE_ACTIVE)
+        progress.finished(IMG_RESPONSE_QUEUED, Exception())
+        self.assertEqual(0, progress.bytes_remaining)
+        self.assertEqual([IMG_RESPONSE_QUEUED['id']], progress.failed)
+
+    def _stub_livecopy_image(self, failures, exc=IOError):
+        calls = []
+
+        def fake_livecopy_image(master_client, slave_client, image, options,
+                                progress=None):
+            calls.append((master_client, image))
+            if len(calls) <= failures:
+                raise exc('broken pipe')
+            return 0
+
+        self.stubs.Set(glance_replicator, '_livecopy_image',
+                       fake_livecopy_image)
+        self.stubs.Set(glance_replicator, '_livecopy_local',
+                       threading.local())
+        return calls
+
+    def _worker(self, journal):
+        return glance_replicator._livecopy_worker(
+                FakeOptions(mastertoken='', slavetoken=''),
+                ('localhost', '9292'), ('localhost', '9293'),
+                journal, None, IMG_RESPONSE_ACTIVE)
+
+    def test_worker_retries_on_new_connection(self):
+        calls = self._stub_livecopy_image(failures=1)
+        journal = glance_replicator.LivecopyJournal(self.journal_path)
+
+        image, error = self._worker(journal)
+        self.assertEqual(None, error)
+        self.assertEqual(2, len(calls))
+        self.assertNotEqual(calls[0][0], calls[1][0])
+        self.assertTrue(journal.is_done(IMG_RESPONSE_ACTIVE))
+
+        # The worker strips keys from a copy of the image only
+        self.assertFalse(calls[0][1] is IMG_RESPONSE_ACTIVE)
+
+    def test_worker_gives_up(self):
+        calls = self._stub_livecopy_image(failures=10)
+        journal = glance_replicator.LivecopyJournal(self.journal_path)
+
+        image, error = self._worker(journal)
+        self.assertTrue(isinstance(error, IOError))
+        self.assertEqual(4, len(calls))
+        self.assertFalse(journal.is_done(IMG_RESPONSE_ACTIVE))
+
+    def test_worker_does_not_retry_authentication_failure(self):
+        calls = self._stub_livecopy_image(
+                failures=10, exc=glance_replicator.AuthenticationException)
+        journal = glance_replicator.LivecopyJournal('')
+
+        image, error = self._worker(journal)
+        self.assertNotEqual(None, error)
+        self.assertEqual(1, len(calls))
+
+
+class FakeImageService(object):
+    def __init__(self, images=None, meta=None):
+        self.images = images or []
+        self.meta = meta or {}
+        self.changes_since = None
+        self.deleted = []
+        self.upload_status = 'active'
+
+    def get_images(self, changes_since=None):
+        self.changes_since = changes_since
+        return iter(self.images)
+
+    def get_image_meta(self, image_uuid):
+        return self.meta.get(image_uuid, {})
+
+    def delete_image(self, image_uuid):
+        self.deleted.append(image_uuid)
+
+    def get_image(self, image_uuid):
+        return StringIO.StringIO('x' * 10)
+
+    def add_image(self, image_meta, image_data):
+        image_data.read()
+        self.meta[image_meta['id']] = {'status': self.upload_status}
+        return {'status': self.upload_status}, ''
+
+
+class IncrementalTestCase(test_utils.BaseTestCase):
+    def setUp(self):
+        super(IncrementalTestCase, self).setUp()
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        self.options = FakeOptions(
+                incremental=True,
+                statefile=os.path.join(state_dir, 'state', 'marks'))
+
+    def test_changes_since_overlaps_mark(self):
+        self.assertEqual(None, glance_replicator._changes_since(None))
+        self.assertEqual('2012-06-25T02:10:35',
+                         glance_replicator._changes_since(
+                                '2012-06-25T02:10:36.123456'))
+
+    def test_get_images_from_high_water_mark(self):
+        newer = copy.copy(IMG_RESPONSE_QUEUED)
+        newer['updated_at'] = '2012-06-26T00:00:00'
+        client = FakeImageService([IMG_RESPONSE_ACTIVE, newer])
+
+        images, mark = glance_replicator._get_images(self.options, client,
+                                                     'size a:1')
+        self.assertEqual(None, client.changes_since)
+        self.assertEqual(2, len(images))
+        self.assertEqual('2012-06-26T00:00:00', mark)
+        glance_replicator._save_high_water_mark(self.options, 'size a:1',
+                                                mark)
+
+        client.images = []
+        images, next_mark = glance_replicator._get_images(self.options,
+                                                          client, 'size a:1')
+        self.assertEqual('2012-06-25T23:59:59', client.changes_since)
+        self.assertEqual(mark, next_mark)
+
+        # Marks are kept per command and servers
+        glance_replicator._get_images(self.options, client, 'size b:1')
+        self.assertEqual(None, client.changes_since)
+
+    def test_full_listing_unless_incremental(self):
+        self.options.incremental = False
+        glance_replicator._save_high_water_mark(self.options, 'size a:1',
+                                                '2012-06-26T00:00:00')
+        client = FakeImageService()
+        glance_replicator._get_images(self.options, client, 'size a:1')
+        self.assertEqual(None, client.changes_since)
+        self.assertFalse(os.path.exists(self.options.statefile))
+
+    def test_compare_is_incremental(self):
+        master_client = FakeImageService()
+        slave_client = FakeImageService(
+                meta={IMG_RESPONSE_ACTIVE['id']: IMG_RESPONSE_ACTIVE})
+        clients = {'9292': master_client, '9293': slave_client}
+        self.stubs = stubout.StubOutForTesting()
+        self.addCleanup(self.stubs.UnsetAll)
+        self.stubs.Set(glance_replicator, 'ImageService',
+                       lambda conn, token: clients[str(conn.port)])
+        self.options.mastertoken = self.options.slavetoken = ''
+
+        for changes_since in (None, '2012-06-25T02:10:35'):
+            master_client.images = [copy.copy(IMG_RESPONSE_ACTIVE)]
+            glance_replicator.replication_compare(
+                    self.options, ['localhost:9292', 'localhost:9293'])
+            self.assertEqual(changes_since, master_client.changes_since)
+
+    def test_livecopy_deletes_from_slave(self):
+        deleted = copy.copy(IMG_RESPONSE_ACTIVE)
+        deleted['deleted'] = True
+        deleted['status'] = 'deleted'
+        slave_client = FakeImageService(
+                meta={deleted['id']: {'status': 'active'}})
+
+        glance_replicator._livecopy_image(None, slave_client, deleted,
+                                          self.options)
+        self.assertEqual([deleted['id']], slave_client.deleted)
+
+        slave_client = FakeImageService()
+        glance_replicator._livecopy_image(None, slave_client, deleted,
+                                          self.options)
+        self.assertEqual([], slave_client.deleted)
+
+
+class LivecopyStatusTestCase(test_utils.BaseTestCase):
+    def setUp(self):
+        super(LivecopyStatusTestCase, self).setUp()
+        self.stubs = stubout.StubOutForTesting()
+        self.addCleanup(self.stubs.UnsetAll)
+        self.stubs.Set(glance_replicator, '_livecopy_local',
+                       threading.local())
+        self.master_client = FakeImageService()
+        self.slave_client = FakeImageService()
+        self.stubs.Set(glance_replicator, '_livecopy_clients',
+                       lambda *args, **kwargs: (self.master_client,
+                                                self.slave_client))
+        self.journal = glance_replicator.LivecopyJournal('')
+
+    def _worker(self):
+        return glance_replicator._livecopy_worker(
+                FakeOptions(), None, None, self.journal, None,
+                IMG_RESPONSE_ACTIVE)
+
+    def test_uploaded_image_is_journaled(self):
+        self.slave_client.upload_status = 'active'
+        image, error = self._worker()
+        self.assertEqual(None, error)
+        self.assertTrue(self.journal.is_done(IMG_RESPONSE_ACTIVE))
+
+    def test_image_killed_by_upload_is_not_journaled(self):
+        self.slave_client.upload_status = 'killed'
+        image, error = self._worker()
+        self.assertTrue(isinstance(error, glance_replicator.UploadException))
+        self.assertFalse(self.journal.is_done(IMG_RESPONSE_ACTIVE))
+
+    def test_inactive_slave_image_is_not_journaled(self):
+        for status in ('queued', 'saving', 'killed'):
+            self.slave_client.meta[IMG_RESPONSE_ACTIVE['id']] = {
+                'status': status}
+            image, error = self._worker()
+            self.assertTrue(isinstance(error,
+                                       glance_replicator.UploadException))
+            self.assertFalse(self.journal.is_done(IMG_RESPONSE_ACTIVE))
+
+
+class FakeArchiveImageService(FakeImageService):
+    def __init__(self, data=None, meta=None):
+        super(FakeArchiveImageService, self).__init__(meta=meta)
+        self.data = data or {}
+        self.added = {}
+        self.updated = []
+
+    def get_image(self, image_uuid):
+        return StringIO.StringIO(self.data[image_uuid])
+
+    def add_image(self, image_meta, image_data):
+        self.added[image_meta['id']] = image_data.read()
+        return {'status': 'active'}, ''
+
+    def add_image_meta(self, image_meta):
+        self.updated.append(image_meta['id'])
+        return {'status': 'active'}, ''
+
+
+class ArchiveTestCase(test_utils.BaseTestCase):
+    def setUp(self):
+        super(ArchiveTestCase, self).setUp()
+        self.stubs = stubout.StubOutForTesting()
+        self.addCleanup(self.stubs.UnsetAll)
+        self.data = 'THISISTHEIMAGEBODY'
+        self.image = copy.copy(IMG_RESPONSE_ACTIVE)
+        self.image['size'] = len(self.data)
+        self.image['checksum'] = hashlib.md5(self.data).hexdigest()
+        self.options = FakeOptions(mastertoken='', slavetoken='',
+                                   compression='gz', workers=2)
+
+    def _stub_client(self, client):
+        self.stubs.Set(glance_replicator, 'ImageService',
+                       lambda conn, auth_token: client)
+
+    def _dump(self, data):
+        self._stub_client(FakeArchiveImageService(
+                data={self.image['id']: data}))
+        archive = StringIO.StringIO()
+        failed = glance_replicator._dump_archive(
+                self.options, ('localhost', '9292'),
+                [self.image, IMG_RESPONSE_QUEUED], archive)
+        archive.seek(0)
+        return archive, failed
+
+    def test_round_trip(self):
+        archive, failed = self._dump(self.data)
+        self.assertEqual([], failed)
+
+        names = tarfile.open(fileobj=archive, mode='r|*').getnames()
+        self.assertEqual([glance_replicator.ARCHIVE_MANIFEST,
+                          self.image['id'] + '.json',
+                          self.image['id'] + '.img',
+                          IMG_RESPONSE_QUEUED['id'] + '.json'], names)
+        archive.seek(0)
+
+        slave_client = FakeArchiveImageService()
+        self._stub_client(slave_client)
+        failed = glance_replicator._load_archive(
+                self.options, ('localhost', '9293'), archive)
+        self.assertEqual([], failed)
+        self.assertEqual({self.image['id']: self.data}, slave_client.added)
+
+    def test_load_rejects_corrupt_data(self):
+        archive, failed = self._dump('THISISNOTTHEIMAGEBODY'[:len(self.data)])
+        self.assertEqual([self.image['id']], failed)
+
+        slave_client = FakeArchiveImageService()
+        self._stub_client(slave_client)
+        failed = glance_replicator._load_archive(
+                self.options, ('localhost', '9293'), archive)
+        self.assertEqual([self.image['id']], failed)
+        self.assertEqual([self.image['id']], slave_client.deleted)
+
+    def test_load_skips_present_image(self):
+        archive, failed = self._dump(self.data)
+
+        slave_meta = dict(self.image)
+        slave_client = FakeArchiveImageService(
+                meta={self.image['id']: slave_meta})
+        self._stub_client(slave_client)
+        failed = glance_replicator._load_archive(
+                self.options, ('localhost', '9293'), archive)
+        self.assertEqual([], failed)
+        self.assertEqual({}, slave_client.added)
+        self.assertEqual([], slave_client.updated)
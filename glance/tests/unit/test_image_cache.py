@@ -17,13 +17,16 @@
 
 from contextlib import contextmanager
 import hashlib
+import json
 import os
 import random
 import shutil
 import StringIO
 
+import eventlet
 import stubout
 
+from glance.common import exception
 from glance.common import utils
 from glance import image_cache
 from glance.tests import utils as test_utils
@@ -182,6 +185,63 @@ class ImageCacheTestCase(object):
             self.assertTrue(self.cache.is_cached(x),
                             "Image %s was not cached!" % x)
 
+    @skip_if_disabled
+    def test_prune_dry_run(self):
+        """
+        Test that a dry run of pruning reports what would be pruned
+        without removing anything
+        """
+        for x in xrange(0, 10):
+            FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+            self.assertTrue(self.cache.cache_image_file(x, FIXTURE_FILE))
+
+        self.assertEqual((5, 5 * 1024), self.cache.prune(dry_run=True))
+        self.assertEqual(10 * 1024, self.cache.get_cache_size())
+
+    def _cache_images_for_eviction(self):
+        """
+        Caches a large image read once, and two small images, one never
+        read and one read twice
+        """
+        sizes = {'large': 3 * 1024, 'cold': 1024, 'hot': 1024}
+        for image_id, size in sizes.items():
+            FIXTURE_FILE = StringIO.StringIO('*' * size)
+            self.assertTrue(self.cache.cache_image_file(image_id,
+                                                        FIXTURE_FILE))
+        for image_id in ('large', 'hot', 'hot'):
+            with self.cache.open_for_read(image_id) as cache_file:
+                cache_file.read()
+        return sum(sizes.values())
+
+    @skip_if_disabled
+    def test_evict_until_lfu(self):
+        """
+        Test that the lfu policy evicts the least read image first
+        """
+        total_size = self._cache_images_for_eviction()
+        evicted = self.cache.driver.evict_until(total_size - 1,
+                                                policy='lfu')
+        self.assertEqual([('cold', 1024)], evicted)
+        self.assertFalse(self.cache.is_cached('cold'))
+
+    @skip_if_disabled
+    def test_evict_until_gdsf(self):
+        """
+        Test that the gdsf policy evicts the image with the fewest hits
+        per byte first
+        """
+        total_size = self._cache_images_for_eviction()
+        evicted = self.cache.driver.evict_until(total_size - 1,
+                                                policy='gdsf')
+        self.assertEqual([('large', 3 * 1024)], evicted)
+        self.assertFalse(self.cache.is_cached('large'))
+        self.assertTrue(self.cache.is_cached('cold'))
+
+    @skip_if_disabled
+    def test_evict_until_unknown_policy(self):
+        self.assertRaises(exception.Invalid, self.cache.driver.evict_until,
+                          0, policy='random')
+
     @skip_if_disabled
     def test_queue(self):
         """
@@ -320,6 +380,105 @@ class ImageCacheTestCase(object):
         self.assertFalse(os.path.exists(incomplete_file_path))
         self.assertTrue(os.path.exists(invalid_file_path))
 
+    @skip_if_disabled
+    def test_image_metadata(self):
+        """
+        Test that image metadata stored alongside a cached image file is
+        returned while it matches the file, and removed along with it
+        """
+        self.config(image_cache_metadata_sidecar=True)
+        self._setup_fixture_file()
+        image_meta = {'id': '1', 'size': FIXTURE_LENGTH, 'properties': {}}
+
+        self.assertEqual(None, self.cache.get_image_metadata(1))
+        self.cache.set_image_metadata(1, image_meta)
+        self.assertEqual(image_meta, self.cache.get_image_metadata(1))
+
+        self.cache.set_image_metadata(1, {'id': '1', 'size': 1})
+        self.assertEqual(None, self.cache.get_image_metadata(1))
+
+        self.cache.set_image_metadata(1, image_meta)
+        self.cache.delete_cached_image(1)
+        self.assertFalse(os.path.exists(
+                os.path.join(self.cache_dir, 'metadata', '1')))
+
+    @skip_if_disabled
+    def test_image_metadata_concurrent_writes(self):
+        """
+        Test that writes of an image's metadata which overlap don't share
+        a temporary file
+        """
+        self.config(image_cache_metadata_sidecar=True)
+        self._setup_fixture_file()
+        image_meta = {'id': '1', 'size': FIXTURE_LENGTH, 'properties': {}}
+        real_dump = json.dump
+        writes = []
+
+        def fake_dump(obj, fp):
+            writes.append(obj)
+            if len(writes) == 1:
+                # Another writer stores the image's metadata meanwhile
+                self.cache.set_image_metadata(1, {'id': '1', 'size': 1})
+            real_dump(obj, fp)
+
+        stubs = stubout.StubOutForTesting()
+        self.addCleanup(stubs.UnsetAll)
+        stubs.Set(json, 'dump', fake_dump)
+        self.cache.set_image_metadata(1, image_meta)
+
+        self.assertEqual(2, len(writes))
+        self.assertEqual(image_meta, self.cache.get_image_metadata(1))
+
+    @skip_if_disabled
+    def test_image_metadata_failed_write(self):
+        """
+        Test that a failed write of image metadata leaves the record
+        already stored, and nothing else, behind
+        """
+        self.config(image_cache_metadata_sidecar=True)
+        self._setup_fixture_file()
+        image_meta = {'id': '1', 'size': FIXTURE_LENGTH, 'properties': {}}
+        self.cache.set_image_metadata(1, image_meta)
+
+        def fake_dump(obj, fp):
+            fp.write('{"id": ')
+            raise IOError('No space left on device')
+
+        stubs = stubout.StubOutForTesting()
+        self.addCleanup(stubs.UnsetAll)
+        stubs.Set(json, 'dump', fake_dump)
+        self.assertRaises(IOError, self.cache.set_image_metadata, 1,
+                          {'id': '1', 'size': 1})
+
+        self.assertEqual(image_meta, self.cache.get_image_metadata(1))
+        self.assertEqual(['1'], os.listdir(
+                os.path.join(self.cache_dir, 'metadata')))
+
+    @skip_if_disabled
+    def test_image_metadata_disabled(self):
+        """
+        Test that image metadata is neither stored nor returned unless
+        metadata sidecars are enabled
+        """
+        self._setup_fixture_file()
+        self.cache.set_image_metadata(1, {'id': '1', 'size': FIXTURE_LENGTH})
+        self.assertEqual(None, self.cache.get_image_metadata(1))
+
+    @skip_if_disabled
+    def test_caching_iterator_stores_image_metadata(self):
+        """
+        Test that the caching iterator stores the supplied image metadata
+        once the image file is cached
+        """
+        self.config(image_cache_metadata_sidecar=True)
+        data = ['a', 'b', 'c']
+        image_meta = {'id': '1', 'size': 3, 'properties': {}}
+
+        caching_iter = self.cache.get_caching_iter('1', None, iter(data),
+                                                   image_meta)
+        self.assertEqual(data, list(caching_iter))
+        self.assertEqual(image_meta, self.cache.get_image_metadata('1'))
+
 
 class TestImageCacheXattr(test_utils.BaseTestCase,
                           ImageCacheTestCase):
@@ -370,6 +529,78 @@ class TestImageCacheXattr(test_utils.BaseTestCase,
         if os.path.exists(self.cache_dir):
             shutil.rmtree(self.cache_dir)
 
+    def _read(self, cache, image_id):
+        with cache.open_for_read(image_id) as cache_file:
+            cache_file.read()
+
+    @skip_if_disabled
+    def test_index_shared_between_processes(self):
+        """
+        Test that images added and read through one cache are seen by
+        another cache sharing the directory
+        """
+        other_cache = image_cache.ImageCache()
+        for image_id in (1, 2):
+            self.cache.cache_image_file(image_id,
+                                        StringIO.StringIO(FIXTURE_DATA))
+
+        self.assertEqual(FIXTURE_LENGTH * 2, other_cache.get_cache_size())
+        self.assertEqual(('1', FIXTURE_LENGTH),
+                         other_cache.driver.get_least_recently_accessed())
+
+        self._read(other_cache, 1)
+        self.assertEqual(('2', FIXTURE_LENGTH),
+                         self.cache.driver.get_least_recently_accessed())
+
+        other_cache.delete_cached_image(2)
+        self.assertEqual(FIXTURE_LENGTH, self.cache.get_cache_size())
+        self.assertEqual(('1', FIXTURE_LENGTH),
+                         self.cache.driver.get_least_recently_accessed())
+
+        self.cache.delete_all_cached_images()
+        self.assertEqual(0, other_cache.get_cache_size())
+        self.assertEqual(None,
+                         other_cache.driver.get_least_recently_accessed())
+
+    @skip_if_disabled
+    def test_index_built_from_cached_files(self):
+        """
+        Test that a missing index is rebuilt from the cached files
+        """
+        for image_id in (1, 2):
+            self.cache.cache_image_file(image_id,
+                                        StringIO.StringIO(FIXTURE_DATA))
+        shutil.rmtree(os.path.join(self.cache_dir, 'index'))
+
+        cache = image_cache.ImageCache()
+        self.assertEqual(FIXTURE_LENGTH * 2, cache.get_cache_size())
+
+    @skip_if_disabled
+    def test_index_compaction(self):
+        """
+        Test that the journal is compacted once it holds many more
+        records than images, without losing track of any image
+        """
+        from glance.image_cache.drivers import xattr as xattr_driver
+        self.stubs = stubout.StubOutForTesting()
+        self.addCleanup(self.stubs.UnsetAll)
+        self.stubs.Set(xattr_driver, 'JOURNAL_COMPACT_SLACK', 10)
+
+        for image_id in (1, 2):
+            self.cache.cache_image_file(image_id,
+                                        StringIO.StringIO(FIXTURE_DATA))
+        journal_path = os.path.join(self.cache_dir, 'index', 'journal')
+        for x in xrange(20):
+            self._read(self.cache, 1)
+
+        other_cache = image_cache.ImageCache()
+        self.assertEqual(FIXTURE_LENGTH * 2, self.cache.get_cache_size())
+        self.assertEqual(2, len(open(journal_path).readlines()))
+
+        self.assertEqual(FIXTURE_LENGTH * 2, other_cache.get_cache_size())
+        self.assertEqual(('2', FIXTURE_LENGTH),
+                         other_cache.driver.get_least_recently_accessed())
+
 
 class TestImageCacheSqlite(test_utils.BaseTestCase,
                            ImageCacheTestCase):
@@ -411,6 +642,96 @@ class TestImageCacheSqlite(test_utils.BaseTestCase,
         if os.path.exists(self.cache_dir):
             shutil.rmtree(self.cache_dir)
 
+    def test_hits_written_in_batches(self):
+        """
+        Test that hits are counted in memory and only written to the
+        database once the flush interval has passed, or hits are read
+        """
+        self.config(image_cache_sqlite_hit_flush_interval=3600)
+        self.cache.cache_image_file(1, StringIO.StringIO(FIXTURE_DATA))
+        for x in xrange(3):
+            with self.cache.open_for_read(1) as cache_file:
+                cache_file.read()
+
+        with self.cache.driver.get_db() as db:
+            cur = db.execute("SELECT hits FROM cached_images")
+            self.assertEqual(0, cur.fetchone()[0])
+
+        self.assertEqual(3, self.cache.get_hit_count(1))
+        with self.cache.driver.get_db() as db:
+            cur = db.execute("SELECT hits FROM cached_images")
+            self.assertEqual(3, cur.fetchone()[0])
+
+    def test_hits_kept_when_flush_fails(self):
+        """
+        Test that hits which could not be written to the database are
+        written by a later flush
+        """
+        self.config(image_cache_sqlite_hit_flush_interval=3600)
+        self.cache.cache_image_file(1, StringIO.StringIO(FIXTURE_DATA))
+        for x in xrange(3):
+            with self.cache.open_for_read(1) as cache_file:
+                cache_file.read()
+
+        self.cache.driver._get_connection().timeout_seconds = 0.1
+        conn = self._lock_db()
+        self.assertRaises(eventlet.Timeout, self.cache.driver.flush_hits)
+        conn.close()
+
+        self.assertEqual(3, self.cache.get_hit_count(1))
+
+    def _lock_db(self):
+        """Takes the write lock on the cache database until closed"""
+        import sqlite3
+        conn = sqlite3.connect(self.cache.driver.db_path,
+                               isolation_level=None)
+        conn.execute('BEGIN IMMEDIATE')
+        self.addCleanup(conn.close)
+        return conn
+
+    def test_evict_until_waits_for_lock(self):
+        """
+        Test that evicting waits for another writer to finish
+        """
+        total_size = self._cache_images_for_eviction()
+        conn = self._lock_db()
+        eventlet.spawn_after(0.1, conn.close)
+        evicted = self.cache.driver.evict_until(total_size - 1,
+                                                policy='lfu')
+        self.assertEqual([('cold', 1024)], evicted)
+        self.assertFalse(self.cache.is_cached('cold'))
+        with self.cache.driver.get_db() as db:
+            cur = db.execute("SELECT image_id FROM cached_images "
+                             "WHERE image_id = 'cold'")
+            self.assertEqual(None, cur.fetchone())
+
+    def test_evict_until_failure_keeps_files(self):
+        """
+        Test that the files of images are kept when their records could
+        not be removed
+        """
+        total_size = self._cache_images_for_eviction()
+        self.cache.driver._get_connection().timeout_seconds = 0.1
+        conn = self._lock_db()
+        self.assertRaises(eventlet.Timeout, self.cache.driver.evict_until,
+                          total_size - 1, policy='lfu')
+        conn.close()
+
+        self.assertTrue(os.path.exists(
+                self.cache.driver.get_image_filepath('cold')))
+        self.assertTrue(self.cache.is_cached('cold'))
+
+    def test_wal_journal_not_cached_image(self):
+        """
+        Test that the database's write-ahead log is not taken for a
+        cached image file
+        """
+        self.cache.cache_image_file(1, StringIO.StringIO(FIXTURE_DATA))
+        self.assertTrue(os.path.exists(
+                os.path.join(self.cache_dir, 'cache.db-wal')))
+        self.assertEqual(FIXTURE_LENGTH, self.cache.get_cache_size())
+        self.assertEqual(1, self.cache.delete_all_cached_images())
+
     def test_gate_caching_iter_good_checksum(self):
         image = "12345678990abcdefghijklmnop"
         image_id = 123
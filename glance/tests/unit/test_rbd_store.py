@@ -0,0 +1,179 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack, LLC
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Tests the sparse reads and writes of the RBD backend store"""
+
+import hashlib
+import StringIO
+import threading
+
+from glance.store import rbd as rbd_store
+from glance.tests import utils as test_utils
+
+
+class FakeImage(object):
+    """An RBD image held in memory, which remembers what was done to it."""
+
+    def __init__(self, data='', extents=None):
+        self.data = data
+        self.extents = extents
+        self.writes = []
+        self.reads = []
+
+    def write(self, data, offset):
+        self.writes.append((offset, len(data)))
+        end = offset + len(data)
+        self.data = self.data[:offset].ljust(offset, '\0') + data + \
+                    self.data[end:]
+
+    def read(self, offset, length):
+        self.reads.append((offset, length))
+        return self.data[offset:offset + length].ljust(length, '\0')
+
+
+class SlowImage(FakeImage):
+    """An image whose reads and writes wait for each other to start."""
+
+    def __init__(self, data='', in_flight=2):
+        super(SlowImage, self).__init__(data)
+        self.lock = threading.Lock()
+        self.started = 0
+        self.in_flight = in_flight
+        self.all_started = threading.Event()
+        self.max_in_flight = 0
+
+    def _wait_for_others(self):
+        with self.lock:
+            self.started += 1
+            self.max_in_flight = max(self.max_in_flight, self.started)
+            if self.started >= self.in_flight:
+                self.all_started.set()
+        # Only returns early if the calls were made one at a time
+        self.all_started.wait(1)
+
+    def write(self, data, offset):
+        self._wait_for_others()
+        with self.lock:
+            super(SlowImage, self).write(data, offset)
+
+    def read(self, offset, length):
+        self._wait_for_others()
+        with self.lock:
+            return super(SlowImage, self).read(offset, length)
+
+
+class FakeDiffImage(FakeImage):
+
+    def diff_iterate(self, offset, length, from_snapshot, iterate_cb):
+        for (extent_offset, extent_length) in self.extents:
+            iterate_cb(extent_offset, extent_length, True)
+
+
+class TestSparseWrites(test_utils.BaseTestCase):
+
+    def test_nonzero_extents(self):
+        data = 'a' * 4 + '\0' * 8 + 'b' * 2 + '\0' * 2 + 'c'
+        self.assertEqual([(0, 4), (12, 5)],
+                         rbd_store._nonzero_extents(data, block_size=4))
+
+    def test_nonzero_extents_all_zeros(self):
+        self.assertEqual([], rbd_store._nonzero_extents('\0' * 10,
+                                                        block_size=4))
+        self.assertEqual([], rbd_store._nonzero_extents(''))
+
+    def test_write_sparse_skips_zeros(self):
+        block = rbd_store.ZERO_BLOCK_SIZE
+        data = 'x' * block + '\0' * (block * 3) + 'y' * 10
+        image = FakeImage()
+        checksum = hashlib.md5()
+
+        bytes_skipped = rbd_store._write_sparse(image,
+                                                StringIO.StringIO(data),
+                                                len(data), block * 2,
+                                                checksum)
+
+        self.assertEqual(block * 3, bytes_skipped)
+        self.assertEqual([(0, block), (block * 4, 10)], image.writes)
+        self.assertEqual(data, image.data.ljust(len(data), '\0'))
+        self.assertEqual(hashlib.md5(data).hexdigest(), checksum.hexdigest())
+
+    def test_write_sparse_with_window(self):
+        block = rbd_store.ZERO_BLOCK_SIZE
+        data = 'x' * block + '\0' * block + 'y' * block * 2
+        image = SlowImage(in_flight=2)
+        checksum = hashlib.md5()
+
+        bytes_skipped = rbd_store._write_sparse(image,
+                                                StringIO.StringIO(data),
+                                                len(data), block * 2,
+                                                checksum, window=2)
+
+        self.assertEqual(block, bytes_skipped)
+        self.assertEqual(2, image.max_in_flight)
+        self.assertEqual([(0, block), (block * 2, block * 2)],
+                         sorted(image.writes))
+        self.assertEqual(data, image.data)
+        self.assertEqual(hashlib.md5(data).hexdigest(), checksum.hexdigest())
+
+
+class TestSparseReads(test_utils.BaseTestCase):
+
+    def test_read_sparse_skips_holes(self):
+        data = 'x' * 4 + '\0' * 8 + 'y' * 2
+        image = FakeDiffImage(data, extents=[(12, 2), (0, 4)])
+
+        chunks = list(rbd_store._read_sparse(image, len(data), 4))
+
+        self.assertEqual(['x' * 4, '\0' * 4, '\0' * 4, 'y' * 2], chunks)
+        self.assertEqual([(0, 4), (12, 2)], image.reads)
+
+    def test_read_sparse_extent_spanning_chunks(self):
+        data = '\0' * 2 + 'x' * 4 + '\0' * 6
+        image = FakeDiffImage(data, extents=[(2, 4)])
+
+        self.assertEqual(data,
+                         ''.join(rbd_store._read_sparse(image, len(data), 4)))
+        self.assertEqual([(0, 4), (4, 4)], image.reads)
+
+    def test_read_sparse_without_diff_iterate(self):
+        data = 'x' * 4 + '\0' * 4
+        image = FakeImage(data)
+
+        self.assertEqual(data,
+                         ''.join(rbd_store._read_sparse(image, len(data), 4)))
+        self.assertEqual([(0, 4), (4, 4)], image.reads)
+
+    def test_read_sparse_with_window(self):
+        data = 'x' * 4 + 'y' * 4 + 'z' * 2
+        image = SlowImage(data, in_flight=3)
+
+        chunks = list(rbd_store._read_sparse(image, len(data), 4, window=3))
+
+        self.assertEqual(['x' * 4, 'y' * 4, 'z' * 2], chunks)
+        self.assertEqual(3, image.max_in_flight)
+        self.assertEqual([(0, 4), (4, 4), (8, 2)], sorted(image.reads))
+
+    def test_read_sparse_closed_early(self):
+        data = 'x' * 16
+        image = SlowImage(data, in_flight=2)
+
+        reader = rbd_store._read_sparse(image, len(data), 4, window=2)
+        self.assertEqual('x' * 4, reader.next())
+        reader.close()
+
+        # The reads started ahead have finished, none were started after
+        self.assertEqual(3, len(image.reads))
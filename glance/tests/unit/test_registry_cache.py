@@ -0,0 +1,179 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack, LLC
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import time
+
+import stubout
+
+from glance.common import exception
+from glance import context
+from glance import registry
+from glance.registry import cache
+from glance.tests import utils as test_utils
+
+
+UUID1 = 'c80a1a6c-bd1f-41c5-90ee-81afedb1d58d'
+UUID2 = 'a85abd86-55b3-4d5b-b0b4-5d0a6e6042fc'
+UUID3 = '971ec09a-8067-4bc8-a91f-ae3557f1c4c7'
+
+
+def _image(image_id, status='active'):
+    return {'id': image_id, 'status': status, 'properties': {}}
+
+
+class TestMetadataCache(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestMetadataCache, self).setUp()
+        self.context = context.RequestContext(tenant='tenant1')
+        self.cache = cache.MetadataCache(max_size=2, ttl=60)
+
+    def test_get_miss_and_hit(self):
+        self.assertEqual(None, self.cache.get(self.context, UUID1))
+        self.cache.set(self.context, UUID1, _image(UUID1))
+        self.assertEqual(_image(UUID1), self.cache.get(self.context, UUID1))
+
+        stats = self.cache.get_stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(0.5, stats['hit_rate'])
+        self.assertEqual(1, stats['size'])
+
+    def test_get_returns_copy(self):
+        self.cache.set(self.context, UUID1, _image(UUID1))
+        image_meta = self.cache.get(self.context, UUID1)
+        image_meta['properties']['foo'] = 'bar'
+        self.assertEqual({},
+                         self.cache.get(self.context, UUID1)['properties'])
+
+    def test_only_active_images_cached(self):
+        self.cache.set(self.context, UUID1, _image(UUID1, 'queued'))
+        self.assertEqual(None, self.cache.get(self.context, UUID1))
+
+    def test_entries_keyed_by_context(self):
+        other = context.RequestContext(tenant='tenant2')
+        admin = context.RequestContext(tenant='tenant1', is_admin=True)
+        self.cache.set(self.context, UUID1, _image(UUID1))
+        self.assertEqual(None, self.cache.get(other, UUID1))
+        self.assertEqual(None, self.cache.get(admin, UUID1))
+
+    def test_least_recently_used_evicted(self):
+        self.cache.set(self.context, UUID1, _image(UUID1))
+        self.cache.set(self.context, UUID2, _image(UUID2))
+        self.cache.get(self.context, UUID1)
+        self.cache.set(self.context, UUID3, _image(UUID3))
+
+        self.assertNotEqual(None, self.cache.get(self.context, UUID1))
+        self.assertEqual(None, self.cache.get(self.context, UUID2))
+        self.assertNotEqual(None, self.cache.get(self.context, UUID3))
+        self.assertEqual(1, self.cache.get_stats()['evictions'])
+
+    def test_expired_entries_not_served(self):
+        self.cache.set(self.context, UUID1, _image(UUID1))
+        now = time.time()
+        self.stubs = stubout.StubOutForTesting()
+        self.addCleanup(self.stubs.UnsetAll)
+        self.stubs.Set(time, 'time', lambda: now + 61)
+        self.assertEqual(None, self.cache.get(self.context, UUID1))
+        self.assertEqual(0, self.cache.get_stats()['size'])
+
+    def test_invalidate_drops_every_context(self):
+        other = context.RequestContext(tenant='tenant2')
+        self.cache.set(self.context, UUID1, _image(UUID1))
+        self.cache.set(other, UUID1, _image(UUID1))
+        self.cache.invalidate(UUID1)
+
+        self.assertEqual(None, self.cache.get(self.context, UUID1))
+        self.assertEqual(None, self.cache.get(other, UUID1))
+        self.assertEqual(2, self.cache.get_stats()['invalidations'])
+
+
+class FakeRegistryClient(object):
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def get_image(self, image_id):
+        self.calls.append(('get_image', image_id))
+        return _image(image_id)
+
+    def update_image(self, image_id, image_meta, purge_props):
+        self.calls.append(('update_image', image_id))
+        if 'racing_read' in image_meta:
+            # Another request reads the image before the write lands
+            registry.get_image_metadata(image_meta['racing_read'], image_id)
+        if image_meta.get('fail'):
+            raise exception.NotFound()
+        return image_meta
+
+
+class TestRegistryMetadataCache(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestRegistryMetadataCache, self).setUp()
+        self.stubs = stubout.StubOutForTesting()
+        self.addCleanup(self.stubs.UnsetAll)
+        self.calls = []
+        self.stubs.Set(registry, 'get_registry_client',
+                       lambda cxt: FakeRegistryClient(self.calls))
+        self.context = context.RequestContext(tenant='tenant1')
+
+    def _configure(self, cache_size):
+        self.config(registry_metadata_cache_size=cache_size)
+        registry.configure_registry_client()
+        self.addCleanup(setattr, registry, '_METADATA_CACHE', None)
+
+    def test_cache_disabled_by_default(self):
+        self._configure(0)
+        registry.get_image_metadata(self.context, UUID1)
+        registry.get_image_metadata(self.context, UUID1)
+        self.assertEqual(2, len(self.calls))
+        self.assertEqual({}, registry.get_metadata_cache_stats())
+
+    def test_get_image_metadata_read_through(self):
+        self._configure(10)
+        registry.get_image_metadata(self.context, UUID1)
+        image_meta = registry.get_image_metadata(self.context, UUID1)
+        self.assertEqual(UUID1, image_meta['id'])
+        self.assertEqual([('get_image', UUID1)], self.calls)
+        self.assertEqual(1, registry.get_metadata_cache_stats()['hits'])
+
+    def test_update_invalidates(self):
+        self._configure(10)
+        registry.get_image_metadata(self.context, UUID1)
+        registry.update_image_metadata(self.context, UUID1, {})
+        registry.get_image_metadata(self.context, UUID1)
+        self.assertEqual([('get_image', UUID1),
+                          ('update_image', UUID1),
+                          ('get_image', UUID1)], self.calls)
+
+    def test_update_invalidates_racing_read(self):
+        self._configure(10)
+        registry.update_image_metadata(self.context, UUID1,
+                                       {'racing_read': self.context})
+        registry.get_image_metadata(self.context, UUID1)
+        self.assertEqual([('update_image', UUID1),
+                          ('get_image', UUID1),
+                          ('get_image', UUID1)], self.calls)
+
+    def test_failed_update_invalidates(self):
+        self._configure(10)
+        self.assertRaises(exception.NotFound,
+                          registry.update_image_metadata, self.context,
+                          UUID1, {'racing_read': self.context, 'fail': True})
+        registry.get_image_metadata(self.context, UUID1)
+        self.assertEqual(3, len(self.calls))
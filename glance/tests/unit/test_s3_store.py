@@ -20,13 +20,16 @@
 import hashlib
 import StringIO
 
+import boto.exception
 import boto.s3.connection
+import boto.s3.key
 import stubout
 
 from glance.common import exception
 from glance.common import utils
 from glance.openstack.common import cfg
 from glance.store.location import get_location_from_uri
+import glance.store.s3
 from glance.store.s3 import Store, get_s3_location
 from glance.store import UnsupportedBackend
 from glance.tests.unit import base
@@ -59,6 +62,7 @@ def stub_out_s3(stubs):
             self.name = name
             self.data = None
             self.size = 0
+            self.etag = None
             self.BufferSize = 1024
 
         def close(self):
@@ -84,6 +88,7 @@ def stub_out_s3(stubs):
             for bytes in fp:
                 self.data.write(bytes)
             self.size = self.data.len
+            self.etag = '"%s"' % hashlib.md5(self.data.getvalue()).hexdigest()
             # Reset the buffer to start
             self.data.seek(0)
             self.read = self.data.read
@@ -91,6 +96,37 @@ def stub_out_s3(stubs):
         def get_file(self):
             return self.data
 
+        def get_contents_as_string(self, headers=None):
+            data = self.bucket.keys[self.name].data.getvalue()
+            start, end = headers['Range'][len('bytes='):].split('-')
+            return data[int(start):int(end) + 1]
+
+    class FakeMultiPartUpload:
+        """
+        Acts like a ``boto.s3.multipart.MultiPartUpload``
+        """
+        def __init__(self, bucket, key_name):
+            self.bucket = bucket
+            self.key_name = key_name
+            self.parts = {}
+            self.cancelled = False
+
+        def upload_part_from_file(self, fp, part_num):
+            if part_num == self.bucket.failing_part:
+                raise boto.exception.S3ResponseError(500, 'Internal Error')
+            self.parts[part_num] = fp.read()
+
+        def complete_upload(self):
+            data = ''.join(self.parts[i] for i in sorted(self.parts))
+            key = self.bucket.new_key(self.key_name)
+            key.set_contents_from_file(StringIO.StringIO(data))
+            # The ETag of an object uploaded in parts isn't its MD5
+            key.etag = '"%s-%d"' % (hashlib.md5(data).hexdigest(),
+                                    len(self.parts))
+
+        def cancel_upload(self):
+            self.cancelled = True
+
     class FakeBucket:
         """
         Acts like a ``boto.s3.bucket.Bucket``
@@ -98,6 +134,8 @@ def stub_out_s3(stubs):
         def __init__(self, name, keys=None):
             self.name = name
             self.keys = keys or {}
+            self.uploads = []
+            self.failing_part = None
 
         def __str__(self):
             return self.name
@@ -119,6 +157,19 @@ def stub_out_s3(stubs):
             self.keys[key_name] = new_key
             return new_key
 
+        def copy_key(self, new_key_name, src_bucket_name, src_key_name):
+            src_key = fake_get_bucket(None, src_bucket_name).keys[src_key_name]
+            new_key = self.new_key(new_key_name)
+            new_key.set_contents_from_file(
+                    StringIO.StringIO(src_key.data.getvalue()))
+            new_key.etag = src_key.etag
+            return new_key
+
+        def initiate_multipart_upload(self, key_name):
+            upload = FakeMultiPartUpload(self, key_name)
+            self.uploads.append(upload)
+            return upload
+
     fixture_buckets = {'glance': FakeBucket('glance')}
     b = fixture_buckets['glance']
     k = b.new_key(FAKE_UUID)
@@ -139,6 +190,7 @@ def stub_out_s3(stubs):
               '__init__', fake_connection_constructor)
     stubs.Set(boto.s3.connection.S3Connection,
               'get_bucket', fake_get_bucket)
+    stubs.Set(boto.s3.key, 'Key', FakeKey)
 
 
 def format_s3_location(user, key, authurl, bucket, obj):
@@ -187,6 +239,23 @@ class TestStore(base.StoreClearingUnitTest):
             data += chunk
         self.assertEqual(expected_data, data)
 
+    def test_get_ranges(self):
+        """
+        Test that an image can be retrieved as a number of byte ranges
+        read concurrently, and that the data comes back in order
+        """
+        self.store.download_concurrency = 3
+        self.store.download_chunk_size = 1000
+        loc = get_location_from_uri(
+            "s3://user:key@auth_address/glance/%s" % FAKE_UUID)
+        (image_s3, image_size) = self.store.get(loc)
+
+        self.assertEqual(image_size, FIVE_KB)
+
+        chunks = list(image_s3)
+        self.assertEqual(6, len(chunks))
+        self.assertEqual("*" * FIVE_KB, ''.join(chunks))
+
     def test_get_non_existing(self):
         """
         Test that trying to retrieve a s3 that doesn't exist
@@ -232,6 +301,143 @@ class TestStore(base.StoreClearingUnitTest):
         self.assertEquals(expected_s3_contents, new_image_contents.getvalue())
         self.assertEquals(expected_s3_size, new_image_s3_size)
 
+    def _get_bucket(self):
+        conn = boto.s3.connection.S3Connection(host='localhost')
+        return conn.get_bucket('glance')
+
+    def _add_multipart(self, image_id, image_s3, image_size):
+        self.store.large_object_size = 1024
+        self.store.large_object_chunk_size = 1024
+        self.store.large_object_concurrency = 3
+        return self.store.add(image_id, image_s3, image_size)
+
+    def test_add_multipart(self):
+        """
+        Test that a large image, or one of unknown size, is streamed to
+        S3 as a multipart upload
+        """
+        expected_s3_size = FIVE_KB
+        expected_s3_contents = ''.join(chr(i % 256)
+                                       for i in xrange(expected_s3_size))
+        expected_checksum = hashlib.md5(expected_s3_contents).hexdigest()
+        bucket = self._get_bucket()
+
+        for image_size in (expected_s3_size, 0):
+            image_id = utils.generate_uuid()
+            image_s3 = StringIO.StringIO(expected_s3_contents)
+
+            location, size, checksum = self._add_multipart(image_id,
+                                                           image_s3,
+                                                           image_size)
+
+            self.assertEquals(expected_s3_size, size)
+            self.assertEquals(expected_checksum, checksum)
+            upload = bucket.uploads[-1]
+            self.assertEquals(image_id, upload.key_name)
+            self.assertEquals([1, 2, 3, 4, 5], sorted(upload.parts))
+            self.assertFalse(upload.cancelled)
+
+            loc = get_location_from_uri(location)
+            (new_image_s3, new_image_size) = self.store.get(loc)
+            self.assertEquals(expected_s3_contents, new_image_s3.getvalue())
+
+    def test_add_multipart_part_limit(self):
+        """
+        Test that a multipart upload uses larger parts rather than more
+        parts than S3 allows
+        """
+        self.stubs.Set(glance.store.s3, 'MAX_LARGE_OBJECT_PARTS', 2)
+        self.stubs.Set(glance.store.s3, 'LARGE_OBJECT_PARTS_PER_DOUBLING', 1)
+        expected_s3_contents = "*" * FIVE_KB
+        bucket = self._get_bucket()
+
+        # Parts of at least 2.5KB, in whole 1KB reads, for a known size,
+        # and of 1, 2 and then 4KB for an unknown size
+        for image_size, parts in ((FIVE_KB, [3072, 2048]),
+                                  (0, [1024, 2048, 2048])):
+            image_s3 = StringIO.StringIO(expected_s3_contents)
+            location, size, checksum = self._add_multipart(
+                    utils.generate_uuid(), image_s3, image_size)
+
+            self.assertEquals(FIVE_KB, size)
+            upload = bucket.uploads[-1]
+            self.assertEquals(parts, [len(upload.parts[i])
+                                      for i in sorted(upload.parts)])
+
+    def test_add_multipart_part_fails(self):
+        """
+        Test that a multipart upload is aborted when a part fails
+        """
+        image_id = utils.generate_uuid()
+        bucket = self._get_bucket()
+        bucket.failing_part = 3
+
+        image_s3 = StringIO.StringIO("*" * FIVE_KB)
+        self.assertRaises(boto.exception.S3ResponseError,
+                          self._add_multipart, image_id, image_s3, FIVE_KB)
+
+        self.assertTrue(bucket.uploads[-1].cancelled)
+        loc = get_location_from_uri(
+            "s3://user:key@auth_address/glance/%s" % image_id)
+        self.assertRaises(exception.NotFound, self.store.get, loc)
+
+    def test_copy(self):
+        """Test that S3 copies an image for the same access key itself"""
+        expected_s3_contents = "*" * FIVE_KB
+        expected_checksum = hashlib.md5(expected_s3_contents).hexdigest()
+        source_location, size, checksum = self.store.add(
+                utils.generate_uuid(),
+                StringIO.StringIO(expected_s3_contents), FIVE_KB)
+
+        expected_image_id = utils.generate_uuid()
+        expected_location = format_s3_location(
+            S3_CONF['s3_store_access_key'],
+            S3_CONF['s3_store_secret_key'],
+            S3_CONF['s3_store_host'],
+            S3_CONF['s3_store_bucket'],
+            expected_image_id)
+
+        location, size, checksum = self.store.copy(
+                expected_image_id, get_location_from_uri(source_location),
+                FIVE_KB)
+
+        self.assertEquals(expected_location, location)
+        self.assertEquals(FIVE_KB, size)
+        self.assertEquals(expected_checksum, checksum)
+
+        loc = get_location_from_uri(expected_location)
+        (new_image_s3, new_image_size) = self.store.get(loc)
+        self.assertEquals(expected_s3_contents, new_image_s3.getvalue())
+
+    def test_copy_multipart(self):
+        """
+        Test that an image uploaded in parts is copied without a checksum
+        """
+        source_location, size, checksum = self._add_multipart(
+                utils.generate_uuid(), StringIO.StringIO("*" * FIVE_KB),
+                FIVE_KB)
+
+        location, size, checksum = self.store.copy(
+                utils.generate_uuid(), get_location_from_uri(source_location),
+                FIVE_KB)
+
+        self.assertEquals(FIVE_KB, size)
+        self.assertEquals(None, checksum)
+
+    def test_copy_from_other_access_key(self):
+        """Test that images held for other access keys aren't copied"""
+        loc = get_location_from_uri(
+            "s3://other:key@localhost:8080/glance/%s" % FAKE_UUID)
+        self.assertRaises(NotImplementedError, self.store.copy,
+                          utils.generate_uuid(), loc, FIVE_KB)
+
+    def test_copy_with_wrong_secret_key(self):
+        """Test that images aren't copied for a location with a bad key"""
+        loc = get_location_from_uri(
+            "s3://user:wrong@localhost:8080/glance/%s" % FAKE_UUID)
+        self.assertRaises(NotImplementedError, self.store.copy,
+                          utils.generate_uuid(), loc, FIVE_KB)
+
     def test_add_host_variations(self):
         """
         Test that having http(s):// in the s3serviceurl in config
@@ -320,6 +526,15 @@ class TestStore(base.StoreClearingUnitTest):
         """
         self.assertTrue(self._option_required('s3_store_host'))
 
+    def test_large_object_chunk_size_too_small(self):
+        """
+        Tests that a multipart chunk size below the S3 minimum part size
+        disables the add method
+        """
+        self.config(s3_store_large_object_chunk_size=4)
+        self.store = Store()
+        self.assertEqual(self.store.add, self.store.add_disabled)
+
     def test_delete(self):
         """
         Test we can delete an existing image in the s3 store
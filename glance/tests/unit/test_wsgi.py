@@ -15,6 +15,13 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import json
+import socket
+import StringIO
+import tempfile
+
+import eventlet.wsgi
+import stubout
 import webob
 
 from glance.common import exception
@@ -143,6 +150,40 @@ class JSONResponseSerializerTest(test_utils.BaseTestCase):
         self.assertEqual(response.content_type, 'application/json')
         self.assertEqual(response.body, '{"key": "value"}')
 
+    def test_to_json_iter(self):
+        fixture = {"images": ({"id": i} for i in xrange(3)), "key": "value"}
+        pieces = list(wsgi.JSONResponseSerializer().to_json_iter(fixture,
+                                                                 'images'))
+        self.assertEqual('{"images": [', pieces[0])
+        self.assertEqual('{"images": [{"id": 0}, {"id": 1}, {"id": 2}], '
+                         '"key": "value"}', ''.join(pieces))
+
+    def test_to_json_iter_chunks(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.addCleanup(self.stubs.UnsetAll)
+        self.stubs.Set(wsgi, 'JSON_STREAM_CHUNK_SIZE', 20)
+        fixture = {"images": [{"id": i} for i in xrange(4)]}
+        pieces = list(wsgi.JSONResponseSerializer().to_json_iter(fixture,
+                                                                 'images'))
+        self.assertEqual(['{"images": [',
+                          '{"id": 0}, {"id": 1}',
+                          ', {"id": 2}, {"id": 3}',
+                          ']}'], pieces)
+        self.assertEqual(fixture, json.loads(''.join(pieces)))
+
+    def test_to_json_iter_empty(self):
+        fixture = {"images": []}
+        pieces = wsgi.JSONResponseSerializer().to_json_iter(fixture, 'images')
+        self.assertEqual('{"images": []}', ''.join(pieces))
+
+    def test_stream(self):
+        fixture = {"images": iter([{"id": 1}])}
+        response = webob.Response()
+        wsgi.JSONResponseSerializer().stream(response, fixture, 'images')
+        self.assertEqual('application/json', response.content_type)
+        self.assertEqual(None, response.content_length)
+        self.assertEqual({"images": [{"id": 1}]}, json.loads(response.body))
+
 
 class JSONRequestDeserializerTest(test_utils.BaseTestCase):
 
@@ -243,3 +284,83 @@ class TestHelpers(test_utils.BaseTestCase):
                 self.assertEqual(v, result[k])
             else:
                 self.assertFalse(k in result)
+
+
+class FileWrapperTest(test_utils.BaseTestCase):
+
+    def test_iter(self):
+        closed = []
+        file_wrapper = wsgi.FileWrapper(StringIO.StringIO('*' * 10), 4)
+        file_wrapper.add_close_callback(closed.append)
+
+        self.assertEqual(['****', '****', '**'], list(file_wrapper))
+        self.assertEqual(10, file_wrapper.bytes_sent)
+
+        file_wrapper.close()
+        file_wrapper.close()
+        self.assertEqual([file_wrapper], closed)
+
+    def test_iter_short_file(self):
+        file_wrapper = wsgi.FileWrapper(StringIO.StringIO('*' * 10), 4)
+        file_wrapper.length = 11
+        self.assertRaises(IOError, list, file_wrapper)
+
+    def test_sendfile(self):
+        if not wsgi.SENDFILE_SUPPORTED:
+            return
+
+        with tempfile.TemporaryFile() as image_file:
+            image_file.write('*' * 100000)
+            image_file.seek(0)
+            sender, receiver = socket.socketpair()
+            try:
+                file_wrapper = wsgi.FileWrapper(image_file)
+                file_wrapper.length = 100000
+                file_wrapper.sendfile(sender)
+                sender.close()
+
+                received = []
+                chunk = receiver.recv(65536)
+                while chunk:
+                    received.append(chunk)
+                    chunk = receiver.recv(65536)
+            finally:
+                receiver.close()
+
+        self.assertEqual('*' * 100000, ''.join(received))
+        self.assertEqual(100000, file_wrapper.bytes_sent)
+
+
+class SendfileApplicationTest(test_utils.BaseTestCase):
+
+    def _call(self, headers):
+        sent = []
+        file_wrapper = wsgi.FileWrapper(StringIO.StringIO('*' * 10))
+
+        def application(environ, start_response):
+            start_response('200 OK', headers)
+            return file_wrapper
+
+        def sendfile_response(status, headers, file_wrapper):
+            sent.append((status, headers, file_wrapper))
+
+        environ = {'REQUEST_METHOD': 'GET',
+                   'glance.sendfile_response': sendfile_response}
+        app = wsgi.sendfile_application(application, None)
+        result = app(environ, lambda *args: None)
+        return result, file_wrapper, sent
+
+    def test_file_wrapper_sent(self):
+        headers = [('Content-Length', '10')]
+        result, file_wrapper, sent = self._call(headers)
+
+        self.assertEqual(eventlet.wsgi.ALREADY_HANDLED, result)
+        self.assertEqual([('200 OK', headers, file_wrapper)], sent)
+        self.assertTrue(file_wrapper.closed)
+
+    def test_file_wrapper_without_length_not_sent(self):
+        result, file_wrapper, sent = self._call([])
+
+        self.assertEqual(file_wrapper, result)
+        self.assertEqual([], sent)
+        self.assertFalse(file_wrapper.closed)
@@ -15,6 +15,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import contextlib
 import datetime
 import hashlib
 import httplib
@@ -33,12 +34,15 @@ from glance.api.v1 import router
 import glance.common.config
 from glance.common import utils
 import glance.context
+import glance.db
 from glance.db.sqlalchemy import api as db_api
 from glance.db.sqlalchemy import models as db_models
 from glance.openstack.common import cfg
 from glance.openstack.common import timeutils
+from glance import registry
 from glance.registry.api import v1 as rserver
 import glance.store.filesystem
+from glance.store import rbd as rbd_store
 from glance.tests.unit import base
 from glance.tests import utils as test_utils
 
@@ -1974,6 +1978,72 @@ class TestRegistryAPI(base.IsolatedUnitTest):
         res = req.get_response(self.api)
         self.assertEquals(res.status_int, webob.exc.HTTPUnauthorized.code)
 
+    def test_make_image_dict(self):
+        """
+        Tests that an image's dict has its loaded attributes, with
+        datetimes formatted, and its undeleted properties
+        """
+        image = db_api.image_get(self.context, UUID1)
+        image_dict = rserver.images.make_image_dict(image)
+
+        self.assertEqual(set(glance.db.IMAGE_ATTRS) | set(['properties']),
+                         set(image_dict.keys()))
+        self.assertEqual(image['created_at'].isoformat(),
+                         image_dict['created_at'])
+        self.assertEqual(None, image_dict['deleted_at'])
+        self.assertEqual({'type': 'kernel'}, image_dict['properties'])
+
+    def test_make_image_dict_expired_attrs(self):
+        """
+        Tests that an image's dict has the attributes its model has not
+        loaded, or has expired, read from the database
+        """
+        session = db_api.get_session()
+        image = session.query(db_models.Image).get(UUID1)
+        session.expire(image, ['name', 'size'])
+        image_dict = rserver.images.make_image_dict(image)
+
+        self.assertEqual(set(glance.db.IMAGE_ATTRS) | set(['properties']),
+                         set(image_dict.keys()))
+        self.assertEqual('fake image #1', image_dict['name'])
+        self.assertEqual(13, image_dict['size'])
+
+    def test_make_image_dict_from_dict(self):
+        """Tests making an image's dict from a driver's plain dict"""
+        created_at = timeutils.utcnow()
+        image = {'id': UUID1,
+                 'name': 'fake image #1',
+                 'created_at': created_at,
+                 'properties': [
+                     {'name': 'type', 'value': 'kernel', 'deleted': False},
+                     {'name': 'arch', 'value': 'x86', 'deleted': True}]}
+        image_dict = rserver.images.make_image_dict(image)
+        self.assertEqual({'id': UUID1,
+                          'name': 'fake image #1',
+                          'created_at': created_at.isoformat(),
+                          'properties': {'type': 'kernel'}}, image_dict)
+
+    def test_get_stats(self):
+        """Tests that admins can see the database connection pool stats"""
+        req = webob.Request.blank('/stats')
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, 200)
+
+        primary = json.loads(res.body)['db_pools']['primary']
+        self.assertTrue(primary['checkouts'] > 0)
+        for key in ('overflow_checkouts', 'checkout_timeouts',
+                    'checkout_time', 'checkout_time_max',
+                    'checkout_time_avg', 'pings', 'reads'):
+            self.assertTrue(key in primary)
+
+    def test_get_stats_not_admin(self):
+        """Tests that other users can't see the stats"""
+        self.api = test_utils.FakeAuthMiddleware(rserver.API(self.mapper),
+                                                     is_admin=False)
+        req = webob.Request.blank('/stats')
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, webob.exc.HTTPForbidden.code)
+
 
 class TestGlanceAPI(base.IsolatedUnitTest):
     def setUp(self):
@@ -2055,6 +2125,111 @@ class TestGlanceAPI(base.IsolatedUnitTest):
             for value in ('aki', 'ari', 'ami'):
                 self._do_test_defaulted_format(key, value)
 
+    def test_get_stats(self):
+        """Tests that admins can see the filesystem store's utilization"""
+        req = webob.Request.blank('/stats')
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, 200)
+
+        datadirs = json.loads(res.body)['stores']['file']['datadirs']
+        self.assertEquals([self.test_dir], [d['path'] for d in datadirs])
+        for key in ('weight', 'total_bytes', 'free_bytes', 'used_bytes'):
+            self.assertTrue(key in datadirs[0])
+
+    def test_get_stats_registry_connections(self):
+        """Tests that admins can see the registry connection pool stats"""
+        req = webob.Request.blank('/images/%s' % UUID2)
+        req.method = 'HEAD'
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, 200)
+
+        req = webob.Request.blank('/stats')
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, 200)
+
+        pool = json.loads(res.body)['registry_connections']
+        self.assertTrue(pool['hits'] + pool['misses'] > 0)
+        for key in ('hit_rate', 'average_wait_time', 'idle', 'in_use'):
+            self.assertTrue(key in pool)
+
+    def test_get_stats_metadata_cache(self):
+        """Tests that admins can see the image metadata cache stats"""
+        self.config(registry_metadata_cache_size=10)
+        registry.configure_registry_client()
+        self.addCleanup(setattr, registry, '_METADATA_CACHE', None)
+        for x in xrange(2):
+            req = webob.Request.blank('/images/%s' % UUID2)
+            req.method = 'HEAD'
+            res = req.get_response(self.api)
+            self.assertEquals(res.status_int, 200)
+
+        req = webob.Request.blank('/stats')
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, 200)
+
+        cache = json.loads(res.body)['metadata_cache']
+        self.assertEquals(1, cache['misses'])
+        self.assertEquals(1, cache['hits'])
+        self.assertEquals(1, cache['size'])
+
+    def test_get_stats_not_admin(self):
+        """Tests that other users can't see the store stats"""
+        self.api = test_utils.FakeAuthMiddleware(router.API(self.mapper),
+                                                 is_admin=False)
+        req = webob.Request.blank('/stats')
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, webob.exc.HTTPForbidden.code)
+
+    def _do_test_add_copy_from(self, checksum=None):
+        copies = []
+
+        def fake_copy_within_backend(store, image_id, uri, size):
+            copies.append((uri, size))
+            return ('file:///tmp/glance-tests/copied', size, None)
+
+        def fake_get_from_backend(context, uri):
+            return (iter(['*' * 5]), 5)
+
+        self.stubs.Set(images, 'copy_within_backend',
+                       fake_copy_within_backend)
+        self.stubs.Set(images, 'get_from_backend', fake_get_from_backend)
+
+        fixture_headers = {'x-image-meta-name': 'fake image #3',
+                           'x-image-meta-disk-format': 'vhd',
+                           'x-image-meta-container-format': 'ovf',
+                           'x-image-meta-size': '5',
+                           'x-glance-api-copy-from':
+                               'http://example.com/image.tar.gz'}
+        if checksum:
+            fixture_headers['x-image-meta-checksum'] = checksum
+
+        req = webob.Request.blank("/images")
+        req.method = 'POST'
+        for k, v in fixture_headers.iteritems():
+            req.headers[k] = v
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, httplib.CREATED)
+
+        res_body = json.loads(res.body)['image']
+        self.assertEquals('active', res_body['status'])
+        self.assertEquals(5, res_body['size'])
+        return copies, res_body
+
+    def test_add_copy_from_within_store(self):
+        """Tests an image the store copies itself isn't read"""
+        copies, res_body = self._do_test_add_copy_from()
+
+        self.assertEquals([('http://example.com/image.tar.gz', 5)], copies)
+        self.assertEquals(None, res_body['checksum'])
+
+    def test_add_copy_from_with_checksum(self):
+        """Tests an image is read to check its supplied checksum"""
+        checksum = hashlib.md5('*' * 5).hexdigest()
+        copies, res_body = self._do_test_add_copy_from(checksum)
+
+        self.assertEquals([], copies)
+        self.assertEquals(checksum, res_body['checksum'])
+
     def test_bad_disk_format(self):
         fixture_headers = {'x-image-meta-store': 'bad',
                    'x-image-meta-name': 'bogus',
@@ -3027,6 +3202,88 @@ class TestGlanceAPI(base.IsolatedUnitTest):
         res = req.get_response(self.api)
         self.assertEquals(res.status_int, 200)
 
+    def _stub_rbd(self, children):
+        """Stubs out RBD, with an image which has the given clones"""
+        removed = []
+
+        class FakeImage(object):
+            def __init__(self, ioctx, name, snapshot=None):
+                pass
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def list_children(self):
+                return children
+
+            def unprotect_snap(self, name):
+                pass
+
+            def remove_snap(self, name):
+                pass
+
+        class FakeRBD(object):
+            def remove(self, ioctx, name):
+                removed.append(name)
+
+        class FakeRBDModule(object):
+            Image = FakeImage
+            RBD = FakeRBD
+            ImageNotFound = ImageBusy = type('Error', (Exception,), {})
+
+        @contextlib.contextmanager
+        def fake_open_ioctx(conf_file, user, pool):
+            yield (None, None)
+
+        if not hasattr(rbd_store, 'rbd'):
+            rbd_store.rbd = None
+            self.addCleanup(delattr, rbd_store, 'rbd')
+        self.stubs.Set(rbd_store, 'rbd', FakeRBDModule)
+        self.stubs.Set(rbd_store, '_open_ioctx', fake_open_ioctx)
+        return removed
+
+    def test_delete_cloned_image(self):
+        """
+        Tests that an RBD image which has been cloned is neither deleted
+        nor marked deleted until its clones are gone
+        """
+        image_id = _gen_uuid()
+        fixture = {'id': image_id,
+                   'name': 'cloned image',
+                   'status': 'active',
+                   'disk_format': 'raw',
+                   'container_format': 'bare',
+                   'is_public': False,
+                   'size': 13,
+                   'location': 'rbd://fsid/images/%s/snap' % image_id,
+                   'properties': {}}
+        db_api.image_create(self.context, fixture)
+        children = [('images', _gen_uuid())]
+        removed = self._stub_rbd(children)
+
+        req = webob.Request.blank("/images/%s" % image_id)
+        req.method = 'DELETE'
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, httplib.CONFLICT)
+        self.assertEquals([], removed)
+
+        req = webob.Request.blank("/images/%s" % image_id)
+        req.method = 'HEAD'
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, 200)
+        self.assertEquals('active', res.headers['x-image-meta-status'])
+
+        # Once the clone is deleted, so can the image be
+        del children[:]
+        req = webob.Request.blank("/images/%s" % image_id)
+        req.method = 'DELETE'
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, 200)
+        self.assertEquals([image_id], removed)
+
     def test_delete_protected_image(self):
         fixture_headers = {'x-image-meta-store': 'file',
                            'x-image-meta-name': 'fake image #3',
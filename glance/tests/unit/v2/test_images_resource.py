@@ -16,6 +16,7 @@
 import datetime
 import json
 
+import stubout
 import webob
 
 import glance.api.v2.images
@@ -102,6 +103,24 @@ class TestImagesController(test_utils.BaseTestCase):
         expected = set([UUID3])
         self.assertEqual(actual, expected)
 
+    def test_index_loads_tags_for_all_images_at_once(self):
+        calls = []
+
+        def fake_image_tag_get_all_by_images(context, image_ids):
+            calls.append(image_ids)
+            return dict((image_id, ['ping']) for image_id in image_ids)
+
+        self.stubs = stubout.StubOutForTesting()
+        self.addCleanup(self.stubs.UnsetAll)
+        self.stubs.Set(self.db, 'image_tag_get_all_by_images',
+                       fake_image_tag_get_all_by_images)
+        self.config(limit_param_default=3, api_limit_max=3)
+        request = unit_test_utils.get_fake_request()
+        output = self.controller.index(request)
+        self.assertEqual([[UUID3, UUID2, UUID1]], calls)
+        self.assertEqual([['ping']] * 3,
+                         [image['tags'] for image in output['images']])
+
     def test_index_return_parameters(self):
         self.config(limit_param_default=1, api_limit_max=3)
         request = unit_test_utils.get_fake_request()
@@ -0,0 +1,312 @@
+#!/usr/bin/python
+
+"""
+Times listing a page of images from the registry database, comparing
+image_get_all with the query it used to run, which joined in every
+image's properties before paging and compared the marker with an
+OR-of-ANDs predicate.
+
+Listings filtered on image properties are timed too, comparing one
+EXISTS subquery per property against the unindexed values with a single
+grouped semi-join through the index on property names and values. The
+query plans of both are printed.
+
+Each size is benchmarked against a freshly populated database, which
+is dropped afterwards, so don't point --benchmark-connection at a real
+one. By default a temporary sqlite database is used.
+"""
+
+import datetime
+import imp
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import sqlalchemy
+import sqlalchemy.event
+import sqlalchemy.orm
+import sqlalchemy.sql
+
+# If ../glance/__init__.py exists, add ../ to Python search path, so that
+# it will override what happens to be installed in /usr/(local/)lib/python...
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                   os.pardir,
+                                   os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'glance', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+import glance.context
+import glance.db
+from glance.openstack.common import cfg
+import glance.db.sqlalchemy.api as db_api
+from glance.db.sqlalchemy import models
+
+
+MIGRATIONS = os.path.join(os.path.dirname(db_api.__file__),
+                          'migrate_repo', 'versions')
+INDEX_MIGRATION = os.path.join(MIGRATIONS, '016_add_image_list_indexes.py')
+PROPERTY_INDEX_MIGRATION = os.path.join(
+        MIGRATIONS, '017_add_image_property_value_index.py')
+
+# Properties which images are filtered on, as a function of the number of
+# the image, and how many different values each one takes
+FILTERED_PROPERTIES = {
+    'os_distro': lambda i: 'distro-%d' % (i % 10),
+    'arch': lambda i: 'arch-%d' % (i % 3),
+    'build': lambda i: 'build-%d' % (i % 1000),
+}
+
+PROPERTY_FILTERS = [
+    ('common filter', {'os_distro': 'distro-1', 'arch': 'arch-1'}),
+    ('rare filter', {'os_distro': 'distro-1', 'build': 'build-1'}),
+]
+
+INSERT_BATCH_SIZE = 10000
+
+
+def populate(engine, count, properties):
+    """Create the schema, as migrated, and fill it with images."""
+    models.unregister_models(engine)
+    models.register_models(engine)
+    migration = imp.load_source('add_image_list_indexes', INDEX_MIGRATION)
+    migration.upgrade(engine)
+
+    start = datetime.datetime(2012, 1, 1)
+    image_ids = []
+    images = []
+    image_properties = []
+    for i in xrange(count):
+        image_id = '%08x-0000-4000-8000-%012x' % (i, i)
+        image_ids.append(image_id)
+        # Every tenth image shares a created_at with the one before, so
+        # paging has to fall back to the id to break ties
+        created_at = start + datetime.timedelta(seconds=i - i // 10)
+        images.append({'id': image_id,
+                       'name': 'image-%d' % i,
+                       'disk_format': 'raw',
+                       'container_format': 'bare',
+                       'size': i,
+                       'status': 'active',
+                       'is_public': i % 2 == 0,
+                       'owner': 'tenant-%d' % (i % 100),
+                       'min_disk': 0,
+                       'min_ram': 0,
+                       'protected': False,
+                       'created_at': created_at,
+                       'updated_at': created_at,
+                       'deleted': i % 20 == 0})
+        values = [(name, value(i))
+                  for (name, value) in FILTERED_PROPERTIES.items()]
+        values.extend([('property-%d' % j, 'value-%d' % j)
+                       for j in xrange(properties)])
+        for (name, value) in values:
+            image_properties.append({'image_id': image_id,
+                                     'name': name,
+                                     'value': value,
+                                     'created_at': created_at,
+                                     'updated_at': created_at,
+                                     'deleted': False})
+
+        if len(images) >= INSERT_BATCH_SIZE or i == count - 1:
+            engine.execute(models.Image.__table__.insert(), images)
+            if image_properties:
+                engine.execute(models.ImageProperty.__table__.insert(),
+                               image_properties)
+            images = []
+            image_properties = []
+
+    return image_ids
+
+
+def old_image_get_all(context, marker=None, limit=None, properties=None):
+    """image_get_all as it was, for the default admin listing."""
+    session = db_api.get_session()
+    query = session.query(models.Image).\
+            options(sqlalchemy.orm.joinedload(models.Image.properties)).\
+            filter_by(deleted=False).\
+            filter(models.Image.status != 'killed')
+
+    for (k, v) in (properties or {}).items():
+        query = query.filter(models.Image.properties.any(name=k,
+                                                         value=v,
+                                                         deleted=False))
+
+    sort_keys = ['created_at', 'created_at', 'id']
+    for sort_key in sort_keys:
+        query = query.order_by(sqlalchemy.desc(getattr(models.Image,
+                                                       sort_key)))
+
+    if marker is not None:
+        marker_image = db_api.image_get(context, marker)
+        criteria_list = []
+        for i in xrange(len(sort_keys)):
+            crit_attrs = []
+            for j in xrange(i):
+                crit_attrs.append(getattr(models.Image, sort_keys[j]) ==
+                                  getattr(marker_image, sort_keys[j]))
+            crit_attrs.append(getattr(models.Image, sort_keys[i]) <
+                              getattr(marker_image, sort_keys[i]))
+            criteria_list.append(sqlalchemy.sql.and_(*crit_attrs))
+        query = query.filter(sqlalchemy.sql.or_(*criteria_list))
+
+    if limit is not None:
+        query = query.limit(limit)
+
+    return query.all()
+
+
+def new_image_get_all(context, marker=None, limit=None, properties=None):
+    filters = {'deleted': False}
+    if properties:
+        filters['properties'] = properties
+    return db_api.image_get_all(context, filters=filters,
+                                marker=marker, limit=limit)
+
+
+class StatementRecorder(object):
+    """Records the first sorted query run against an engine while active,
+    which is the one listing images rather than looking anything up.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.active = False
+        self.statement = None
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', self)
+
+    def __call__(self, conn, cursor, statement, parameters, context,
+                 executemany):
+        if (self.active and self.statement is None and
+            'ORDER BY' in statement):
+            self.statement = (statement, parameters)
+
+    def explain(self, func, *args, **kwargs):
+        """Returns the plan of the listing query func runs."""
+        self.active = True
+        self.statement = None
+        try:
+            func(*args, **kwargs)
+        finally:
+            self.active = False
+
+        statement, parameters = self.statement
+        if self.engine.name == 'sqlite':
+            explain = 'EXPLAIN QUERY PLAN '
+        else:
+            explain = 'EXPLAIN '
+        rows = self.engine.execute(explain + statement, parameters)
+        return '\n'.join(' '.join(str(column) for column in row)
+                         for row in rows)
+
+
+def timed(func, repeat, *args, **kwargs):
+    """Returns the best of repeat runs of func, in milliseconds."""
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        result = func(*args, **kwargs)
+        elapsed = (time.time() - start) * 1000
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def benchmark(context, image_ids, limit, repeat):
+    # A marker from the start of the listing, and one half way through it
+    markers = [('first page', None),
+               ('middle page', image_ids[len(image_ids) // 2 + 1])]
+    for description, marker in markers:
+        old_ms, old_images = timed(old_image_get_all, repeat, context,
+                                   marker=marker, limit=limit)
+        new_ms, new_images = timed(new_image_get_all, repeat, context,
+                                   marker=marker, limit=limit)
+        assert ([image['id'] for image in old_images] ==
+                [image['id'] for image in new_images])
+        print ('  %-13s old %9.2f ms   new %9.2f ms   %6.1fx'
+               % (description, old_ms, new_ms, old_ms / max(new_ms, 0.001)))
+
+
+def benchmark_properties(context, engine, recorder, limit, repeat,
+                         print_plans):
+    results = {}
+    plans = {}
+
+    # Time the old query before the property index exists, as it would
+    # have run, and then the new one with it
+    for version in ('old', 'new'):
+        if version == 'new':
+            migration = imp.load_source('add_image_property_value_index',
+                                        PROPERTY_INDEX_MIGRATION)
+            migration.upgrade(engine)
+
+        func = {'old': old_image_get_all, 'new': new_image_get_all}[version]
+        for description, properties in PROPERTY_FILTERS:
+            results[(version, description)] = timed(
+                    func, repeat, context, limit=limit,
+                    properties=properties)
+            plans[(version, description)] = recorder.explain(
+                    func, context, limit=limit, properties=properties)
+
+    for description, properties in PROPERTY_FILTERS:
+        old_ms, old_images = results[('old', description)]
+        new_ms, new_images = results[('new', description)]
+        assert ([image['id'] for image in old_images] ==
+                [image['id'] for image in new_images])
+        print ('  %-13s old %9.2f ms   new %9.2f ms   %6.1fx'
+               % (description, old_ms, new_ms, old_ms / max(new_ms, 0.001)))
+
+    if print_plans:
+        for description, properties in PROPERTY_FILTERS:
+            for version in ('old', 'new'):
+                print '  %s plan for %s:' % (version, description)
+                for line in plans[(version, description)].splitlines():
+                    print '    %s' % line
+
+
+if __name__ == '__main__':
+    config = cfg.CONF
+    extra_cli_opts = [
+        cfg.StrOpt('benchmark-connection',
+                   help='SQLAlchemy connection string of a scratch database'),
+        cfg.ListOpt('counts', default=['10000', '100000', '1000000'],
+                    help='Numbers of images to benchmark with'),
+        cfg.IntOpt('properties', default=4,
+                   help=('Number of properties each image has besides '
+                         'those it is filtered on')),
+        cfg.IntOpt('limit', default=25,
+                   help='Number of images in each page'),
+        cfg.IntOpt('repeat', default=5,
+                   help='Number of times to time each query'),
+        cfg.BoolOpt('plans', default=True,
+                    help='Print the query plans of property filters'),
+    ]
+    config.register_cli_opts(extra_cli_opts)
+    config(project='glance', prog='glance-registry')
+
+    tmp_dir = None
+    if config.benchmark_connection:
+        config.set_override('sql_connection', config.benchmark_connection)
+    else:
+        tmp_dir = tempfile.mkdtemp()
+        config.set_override('sql_connection',
+                            'sqlite:///%s/glance.sqlite' % tmp_dir)
+
+    try:
+        db_api.configure_db()
+        context = glance.context.RequestContext(is_admin=True)
+        recorder = StatementRecorder(db_api._ENGINE)
+
+        for count in config.counts:
+            print '%s images' % count
+            image_ids = populate(db_api._ENGINE, int(count),
+                                 config.properties)
+            image_ids.reverse()
+            benchmark(context, image_ids, config.limit, config.repeat)
+            benchmark_properties(context, db_api._ENGINE, recorder,
+                                 config.limit, config.repeat, config.plans)
+        models.unregister_models(db_api._ENGINE)
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir)
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+
+"""
+Times serializing a page of detailed image metadata in the registry and
+deserializing it in the registry client, comparing the way it is done
+now with the way it used to be: building each image's dict by checking
+the model's keys() for every attribute, formatting datetimes through a
+callback from the JSON encoder and decoding with the standard library's
+json module.
+
+The images are created in an in-memory sqlite database and listed with
+image_get_all, as the registry would list them, before being timed.
+"""
+
+import datetime
+import json
+import os
+import sys
+import time
+
+# If ../glance/__init__.py exists, add ../ to Python search path, so that
+# it will override what happens to be installed in /usr/(local/)lib/python...
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                   os.pardir,
+                                   os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'glance', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+import glance.context
+import glance.db
+from glance.common import crypt
+from glance.common import utils
+from glance.common import wsgi
+from glance.openstack.common import cfg
+import glance.db.sqlalchemy.api as db_api
+from glance.db.sqlalchemy import models
+from glance.registry.api.v1 import images
+
+
+ENCRYPTION_KEY = '1234567890123456'
+
+
+def populate(context, count, properties, encrypt):
+    models.unregister_models(db_api._ENGINE)
+    models.register_models(db_api._ENGINE)
+    for i in xrange(count):
+        location = 'file:///var/lib/glance/images/image-%d' % i
+        if encrypt:
+            location = crypt.urlsafe_encrypt(ENCRYPTION_KEY, location, 64)
+        db_api.image_create(context, {
+            'name': 'image-%d' % i,
+            'status': 'active',
+            'disk_format': 'raw',
+            'container_format': 'bare',
+            'size': i,
+            'checksum': '%032x' % i,
+            'is_public': True,
+            'location': location,
+            'properties': dict(('property-%d' % j, 'value-%d' % j)
+                               for j in xrange(properties)),
+        })
+
+
+def old_make_image_dict(image):
+    """make_image_dict as it was."""
+    def _fetch_attrs(d, attrs):
+        return dict([(a, d[a]) for a in attrs
+                    if a in d.keys()])
+
+    properties = dict((p['name'], p['value'])
+                      for p in image['properties'] if not p['deleted'])
+
+    image_dict = _fetch_attrs(image, glance.db.IMAGE_ATTRS)
+
+    image_dict['properties'] = properties
+    return image_dict
+
+
+def old_serialize(image_refs):
+    def sanitizer(obj):
+        if isinstance(obj, datetime.datetime):
+            return obj.isoformat()
+        return obj
+
+    image_dicts = [old_make_image_dict(i) for i in image_refs]
+    return json.dumps(dict(images=image_dicts), default=sanitizer)
+
+
+def new_serialize(image_refs):
+    image_dicts = [images.make_image_dict(i) for i in image_refs]
+    return wsgi.JSONResponseSerializer().to_json(dict(images=image_dicts))
+
+
+def old_deserialize(body, key):
+    image_list = json.loads(body)['images']
+    for image in image_list:
+        if (key is not None and 'location' in image.keys()
+            and image['location'] is not None):
+            image['location'] = crypt.urlsafe_decrypt(key, image['location'])
+    return image_list
+
+
+def new_deserialize(body, key):
+    image_list = utils.json_loads(body)['images']
+    for image in image_list:
+        if key is not None and image.get('location') is not None:
+            image['location'] = crypt.urlsafe_decrypt(key, image['location'])
+    return image_list
+
+
+def timed(func, repeat, *args, **kwargs):
+    """Returns the best of repeat runs of func, in milliseconds."""
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        result = func(*args, **kwargs)
+        elapsed = (time.time() - start) * 1000
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def report(description, old_ms, new_ms):
+    print ('  %-13s old %9.2f ms   new %9.2f ms   %6.1fx'
+           % (description, old_ms, new_ms, old_ms / max(new_ms, 0.001)))
+
+
+def benchmark(context, repeat, key):
+    image_refs = db_api.image_get_all(context)
+
+    old_ms, old_body = timed(old_serialize, repeat, image_refs)
+    new_ms, new_body = timed(new_serialize, repeat, image_refs)
+    assert json.loads(old_body) == json.loads(new_body)
+    report('serialize', old_ms, new_ms)
+
+    old_ms, old_images = timed(old_deserialize, repeat, new_body, key)
+    new_ms, new_images = timed(new_deserialize, repeat, new_body, key)
+    assert old_images == new_images
+    report('deserialize', old_ms, new_ms)
+
+
+if __name__ == '__main__':
+    config = cfg.CONF
+    extra_cli_opts = [
+        cfg.ListOpt('counts', default=['100', '1000'],
+                    help='Numbers of images to benchmark with'),
+        cfg.IntOpt('properties', default=5,
+                   help='Number of properties each image has'),
+        cfg.IntOpt('repeat', default=5,
+                   help='Number of times to time each step'),
+        cfg.BoolOpt('encrypt', default=True,
+                    help='Encrypt image locations, as '
+                         'metadata_encryption_key would'),
+    ]
+    config.register_cli_opts(extra_cli_opts)
+    config(project='glance', prog='glance-registry')
+    config.set_override('sql_connection', 'sqlite://')
+
+    db_api.configure_db()
+    context = glance.context.RequestContext(is_admin=True)
+    key = ENCRYPTION_KEY if config.encrypt else None
+
+    print 'JSON decoder: %s' % ('simplejson' if utils.simplejson
+                                else 'json')
+    for count in config.counts:
+        print '%s images' % count
+        populate(context, int(count), config.properties, config.encrypt)
+        benchmark(context, config.repeat, key)